@@ -0,0 +1,355 @@
+import argparse
+import importlib
+import json
+import logging
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+V1 = os.path.join(ROOT, 'v1')
+V2 = os.path.join(ROOT, 'v2')
+SIMULATE = os.path.join(ROOT, 'simulate')
+
+sys.path.insert(0, SIMULATE)
+from fake_gpsd import parse_time  # noqa: E402
+from sim_gps import generate_track, write_gpsd_json  # noqa: E402
+
+SAMPLE_TPV = {
+    "class": "TPV", "device": "/dev/fake", "mode": 3, "time": "2024-06-01T12:00:00.000Z",
+    "lat": 65.01236, "lon": 25.46816, "alt": 15.2, "climb": 0.1, "speed": 14.5, "track": 181.4,
+    "epx": 3.0, "epy": 4.0, "epv": 6.0
+}
+SAMPLE_SKY = {"class": "SKY", "satellites": [{"PRN": n, "used": n < 9} for n in range(12)]}
+
+
+def load_module(directory, name):
+    """
+    Imports a module of v1 or v2. Both have their own settings and helper
+    modules, so they are imported in isolation and removed from sys.modules.
+    """
+    local = {f[:-3] for f in os.listdir(directory) if f.endswith('.py')}
+    saved = {m: sys.modules.pop(m) for m in local if m in sys.modules}
+    cwd = os.getcwd()
+    sys.path.insert(0, directory)
+    os.chdir(directory)
+    try:
+        module = importlib.import_module(name)
+    finally:
+        sys.path.remove(directory)
+        os.chdir(cwd)
+        for m in local:
+            sys.modules.pop(m, None)
+        sys.modules.update(saved)
+    return module
+
+
+class PublishResult:
+    rc = 0
+    mid = 0
+
+    def wait_for_publish(self, timeout=None):
+        pass
+
+    def is_published(self):
+        return True
+
+
+class StubClient:
+    """
+    In-process stand-in for paho.mqtt.client.Client. Records the publish time
+    of each message, parsing is left until the run is over.
+
+    Args:
+        stop_after (int): Raise KeyboardInterrupt after this many messages on
+            topics ending with stop_topic, which ends the v1 main loop.
+        stop_topic (str): Suffix of the topics counted.
+    """
+
+    def __init__(self, stop_after=None, stop_topic='attributes'):
+        self.stop_after = stop_after
+        self.stop_topic = stop_topic
+        self.messages = []
+        self.count = 0
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self.messages.append((time.time(), topic, payload))
+        if topic.endswith(self.stop_topic):
+            self.count += 1
+            if self.stop_after and self.count >= self.stop_after:
+                raise KeyboardInterrupt
+        return PublishResult()
+
+    def latencies(self):
+        # Fix time is the wall clock time the fake gpsd sent the report
+        return [sent - parse_time(json.loads(payload)['time'])
+                for sent, topic, payload in self.messages if topic.endswith(self.stop_topic)]
+
+
+class FakeGpsdProcess:
+    """
+    Runs simulate/fake_gpsd.py in a subprocess, so its CPU time is not
+    counted for the pipeline.
+    """
+
+    def __init__(self, trace, speed):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            self.port = s.getsockname()[1]
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.join(SIMULATE, 'fake_gpsd.py'), trace, '--port', str(self.port),
+             '--speed', str(speed), '--current-time', '--loop'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("Fake gpsd did not start")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.process.terminate()
+        self.process.wait()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+
+def max_rss_kb():
+    # Peak resident memory of this process. Linux keeps ru_maxrss of the parent
+    # across exec, VmHWM starts from zero
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def summarize(client, elapsed, cpu, latency=True):
+    result = {
+        'fixes': client.count,
+        'fixes_per_second': round(client.count / elapsed, 1),
+        'cpu_us_per_fix': round(cpu / client.count * 1e6, 1),
+        'max_rss_kb': max_rss_kb()
+    }
+    if latency:
+        latencies = client.latencies()
+        result['latency_p50_ms'] = round(percentile(latencies, 50) * 1000, 3)
+        result['latency_p99_ms'] = round(percentile(latencies, 99) * 1000, 3)
+    return result
+
+
+def run_v2(app, port, fixes):
+    client = StubClient()
+    app.brokers[:] = [{'host': 'stub', 'port': 0, 'client': client, 'connected': True}]
+    stream = app.GpsStream(port=port)
+    started = time.perf_counter()
+    cpu = time.process_time()
+    for packet in stream:
+        gps_data = app.get_gps_data(packet)
+        if gps_data:
+            app.process_gps_data(gps_data)
+        app.flush_batch()
+        if client.count >= fixes:
+            break
+    stream.close()
+    return client, time.perf_counter() - started, time.process_time() - cpu
+
+
+class StubEnricher:
+    def request(self, latitude, longitude, bearing, way_id=None):
+        pass
+
+    def latest(self):
+        return {'address': {'road': 'Kirkkokatu', 'city': 'Oulu', 'postcode': '90100', 'country_code': 'fi'},
+                'speed_limit': 50, 'age': 0.0}
+
+    def pending(self):
+        return 0
+
+    def shutdown(self):
+        pass
+
+
+def make_v1_status(gps2mqtt, port=None):
+    """
+    Creates the v1 Status without network lookups, cache files or brokers.
+    """
+    gps2mqtt.GEOCACHE['path'] = None
+    gps2mqtt.GPS_STREAM.update({'enabled': True, 'port': port or 2947})
+    status = gps2mqtt.Status()
+    status._enricher = StubEnricher()
+    return status
+
+
+def run_v1(gps2mqtt, port, fixes):
+    client = StubClient(stop_after=fixes, stop_topic=gps2mqtt._mqtt_topic)
+    status = make_v1_status(gps2mqtt, port)
+    status.brokers[:] = [{'host': 'stub', 'port': 0, 'client': client, 'connected': True}]
+    gps2mqtt.helpers.connect_brokers = lambda status: status
+    started = time.perf_counter()
+    cpu = time.process_time()
+    # Returns when the stub client raises KeyboardInterrupt
+    gps2mqtt.main_loop(status)
+    return client, time.perf_counter() - started, time.process_time() - cpu
+
+
+# Pipeline name: (directory, module, run function)
+PIPELINES = {'v2': (V2, 'app', run_v2), 'v1': (V1, 'gps2mqtt', run_v1)}
+
+
+def pipeline(name, run, module, trace, latency_rate, latency_fixes, throughput_fixes):
+    logging.warning(f"{name}: latency at {latency_rate} fixes/s")
+    with FakeGpsdProcess(trace, latency_rate / 10) as gpsd:
+        result = summarize(*run(module, gpsd.port, latency_fixes))
+    logging.warning(f"{name}: max throughput")
+    with FakeGpsdProcess(trace, 1000000) as gpsd:
+        throughput = summarize(*run(module, gpsd.port, throughput_fixes), latency=False)
+    result['max_fixes_per_second'] = throughput['fixes_per_second']
+    result['cpu_us_per_fix'] = throughput['cpu_us_per_fix']
+    result['max_rss_kb'] = throughput['max_rss_kb']
+    return result
+
+
+def pipeline_process(name, trace, args, directory):
+    """
+    Runs the pipeline of v1 or v2 in a child process, so max_rss_kb is the
+    peak memory of that pipeline alone and not of both.
+    """
+    output = os.path.join(directory, f'{name}.json')
+    subprocess.check_call([sys.executable, os.path.abspath(__file__), '--pipeline', name, '--trace', trace,
+                           '--output', output, '--latency-rate', str(args.latency_rate),
+                           '--latency-fixes', str(args.latency_fixes),
+                           '--throughput-fixes', str(args.throughput_fixes), '--log-level', args.log_level])
+    with open(output, 'r') as f:
+        return json.load(f)
+
+
+def micro(function, number):
+    return round(timeit.timeit(function, number=number) / number * 1e6, 3)
+
+
+def microbenchmarks(app, gps2mqtt, number):
+    results = {}
+    packet = app.gpsd.GpsResponse.from_json({'active': 1, 'tpv': [SAMPLE_TPV], 'sky': [SAMPLE_SKY]})
+    data = app.get_gps_data(packet)
+    results['v2.get_gps_data'] = micro(lambda: app.get_gps_data(packet), number)
+    results['v2.json_dumps'] = micro(lambda: json.dumps(data), number)
+    for encoding, result in load_module(V2, 'payload').compare(data, number).items():
+        results[f'v2.encode_{encoding}'] = result['encode_us']
+
+    status = make_v1_status(gps2mqtt)
+    status.data = {'latitude': 65.0123, 'longitude': 25.4681}
+    results['v1.update_buffers'] = micro(lambda: status.update_buffers(52.0, 181.0), number)
+    results['v1.calculate_bearing'] = micro(lambda: status.calculate_bearing(65.0124, 25.4683), number)
+    rolling = load_module(V1, 'rolling')
+    speeds = rolling.RollingWindow(5000)
+    bearings = rolling.BearingWindow(5000)
+    results['v1.rolling_window_5000'] = micro(lambda: (speeds.append(52.0), bearings.append(181.0)), number)
+    return results
+
+
+def git_commit():
+    # Short hash of HEAD, with -dirty if tracked files have uncommitted changes
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+        changes = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                          cwd=ROOT, text=True)
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return f"{commit}-dirty" if changes.strip() else commit
+
+
+def flatten(results, prefix=''):
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, (int, float)):
+            values[f'{prefix}{key}'] = value
+    return values
+
+
+def compare(old_path, new):
+    with open(old_path, 'r') as f:
+        old = json.load(f)
+    if old.get('arguments') != new['arguments']:
+        print(f"Warning: {old_path} was measured with {old.get('arguments', 'unknown arguments')}")
+    print(f"{'metric':<40}{old['commit']:>14}{new['commit']:>14}{'change':>10}")
+    old_values = flatten({'pipeline': old['pipeline'], 'micro': old['micro']})
+    new_values = flatten({'pipeline': new['pipeline'], 'micro': new['micro']})
+    for key, value in new_values.items():
+        if key in old_values and old_values[key]:
+            change = (value - old_values[key]) / old_values[key] * 100
+            print(f"{key:<40}{old_values[key]:>14}{value:>14}{change:>9.1f}%")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the fix to MQTT pipeline of v1 and v2')
+    parser.add_argument('--output', help='Result file, default benchmark/results/<commit>.json')
+    parser.add_argument('--compare', help='Earlier result file to compare with')
+    parser.add_argument('--latency-rate', type=float, default=100, help='Fixes per second in the latency run')
+    parser.add_argument('--latency-fixes', type=int, default=1000)
+    parser.add_argument('--throughput-fixes', type=int, default=20000)
+    parser.add_argument('--micro-number', type=int, default=20000, help='Calls per microbenchmark')
+    parser.add_argument('--log-level', default='WARNING', help='Log level of the benchmarked code')
+    parser.add_argument('--pipeline', choices=PIPELINES, help=argparse.SUPPRESS)
+    parser.add_argument('--trace', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.pipeline:
+        # Child process of pipeline_process
+        directory, name, run = PIPELINES[args.pipeline]
+        module = load_module(directory, name)
+        logging.getLogger().setLevel(args.log_level)
+        result = pipeline(args.pipeline, run, module, args.trace,
+                          args.latency_rate, args.latency_fixes, args.throughput_fixes)
+        with open(args.output, 'w') as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    app = load_module(V2, 'app')
+    gps2mqtt = load_module(V1, 'gps2mqtt')
+    logging.getLogger().setLevel(args.log_level)
+
+    with tempfile.TemporaryDirectory() as directory:
+        trace = os.path.join(directory, 'trace.json')
+        write_gpsd_json(trace, generate_track(65.0124, 25.4682, 3600, rate=10, seed=1))
+        results = {
+            'commit': git_commit(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'arguments': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+            'pipeline': {
+                'v2': pipeline_process('v2', trace, args, directory),
+                'v1': pipeline_process('v1', trace, args, directory)
+            },
+            'micro': microbenchmarks(app, gps2mqtt, args.micro_number)
+        }
+
+    print(json.dumps(results, indent=4))
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         f"{results['commit']}.json")
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {output}")
+    if args.compare:
+        compare(args.compare, results)
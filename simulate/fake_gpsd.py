@@ -0,0 +1,264 @@
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+from datetime import datetime, timezone
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+VERSION = {"class": "VERSION", "release": "3.25", "rev": "fake", "proto_major": 3, "proto_minor": 15}
+DEVICE = {"class": "DEVICE", "path": "/dev/fake", "driver": "fake", "activated": "", "native": 0}
+KNOTS = 0.514444  # m/s
+
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def format_time(seconds, digits=3):
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:digits - 6 or None] + 'Z'
+
+
+def nmea_valid(sentence):
+    if not sentence.startswith('$') or '*' not in sentence:
+        return False
+    body, checksum = sentence[1:].rsplit('*', 1)
+    value = 0
+    for char in body.encode('ascii', 'replace'):
+        value ^= char
+    try:
+        return value == int(checksum[:2], 16)
+    except ValueError:
+        return False
+
+
+def nmea_degrees(value, hemisphere):
+    if not value:
+        return None
+    dot = value.index('.')
+    degrees = float(value[:dot - 2]) + float(value[dot - 2:]) / 60
+    return -degrees if hemisphere in ('S', 'W') else degrees
+
+
+def read_nmea(path):
+    """
+    Converts GGA and RMC sentences to (time, report) pairs. Each RMC sentence
+    gives a TPV report, with altitude and satellites from the latest GGA.
+    """
+    gga = None
+    with open(path, 'r', errors='replace') as f:
+        for line in f:
+            sentence = line.strip()
+            if not nmea_valid(sentence):
+                continue
+            fields = sentence[1:].split('*')[0].split(',')
+            kind = fields[0][2:]
+            if kind == 'GGA':
+                gga = fields
+            elif kind == 'RMC' and len(fields) >= 10 and fields[1] and fields[9]:
+                clock, date = fields[1], fields[9]
+                seconds = datetime(2000 + int(date[4:6]), int(date[2:4]), int(date[0:2]),
+                                   int(clock[0:2]), int(clock[2:4]), tzinfo=timezone.utc).timestamp() + float(clock[4:])
+                tpv = {"class": "TPV", "device": DEVICE['path'], "mode": 1, "time": format_time(seconds)}
+                if fields[2] == 'A':
+                    tpv.update({
+                        "mode": 2,
+                        "lat": nmea_degrees(fields[3], fields[4]),
+                        "lon": nmea_degrees(fields[5], fields[6]),
+                        "speed": round(float(fields[7] or 0) * KNOTS, 3),
+                        "track": float(fields[8] or 0),
+                        "epx": 5.0, "epy": 5.0
+                    })
+                    if gga and gga[6] not in ('', '0') and gga[9]:
+                        tpv.update({"mode": 3, "alt": float(gga[9]), "climb": 0.0, "epv": 8.0})
+                if gga and gga[7]:
+                    satellites = int(gga[7])
+                    yield seconds, {"class": "SKY", "device": DEVICE['path'], "satellites": [
+                        {"PRN": n + 1, "used": True, "ss": 30} for n in range(satellites)]}
+                yield seconds, tpv
+
+
+def read_json(path):
+    """
+    Reads recorded gpsd reports (e.g. gpspipe -w, or sim_gps.py --format json)
+    as (time, report) pairs. Reports without time get the time of the previous one.
+    """
+    seconds = None
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                report = json.loads(line)
+            except ValueError:
+                continue
+            if report.get('class') not in ('TPV', 'SKY'):
+                continue
+            if report.get('time'):
+                seconds = parse_time(report['time'])
+            if seconds is not None:
+                yield seconds, report
+
+
+def read_trace(path):
+    return read_nmea(path) if path.endswith('.nmea') else read_json(path)
+
+
+class FakeGpsd:
+    """
+    Replays a trace over the gpsd JSON socket protocol.
+
+    Clients in JSON watch mode get every report as it is replayed, and
+    ?POLL; returns the latest TPV and SKY like gpsd does for gpsd-py3.
+
+    Args:
+        path (str): .nmea file or gpsd JSON report lines.
+        speed (float): Replay speed, 1 is real time.
+        loop (bool): Start over at the end of the trace.
+        no_fix_every (float): Trace seconds between injected no-fix periods, 0 to disable.
+        no_fix_duration (float): Trace seconds a no-fix period lasts.
+        malformed (float): Probability of sending a malformed line before a report.
+        current_time (bool): Replace report times with the time they are sent.
+    """
+
+    def __init__(self, path, speed=1.0, loop=False, no_fix_every=0, no_fix_duration=10,
+                 malformed=0.0, current_time=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.no_fix_every = no_fix_every
+        self.no_fix_duration = no_fix_duration
+        self.malformed = malformed
+        self.current_time = current_time
+        self.tpv = None
+        self.sky = None
+        self.sent = 0
+        self._watchers = set()
+
+    def _report(self, seconds, report, start):
+        if self.current_time and 'time' in report:
+            # Microseconds, so clients can measure latency from the report time
+            report = dict(report, time=format_time(time.time(), 6))
+        if (report['class'] == 'TPV' and self.no_fix_every
+                and (seconds - start) % self.no_fix_every < self.no_fix_duration):
+            report = {"class": "TPV", "device": report.get('device', DEVICE['path']), "mode": 1,
+                      "time": report.get('time')}
+        return report
+
+    async def _broadcast(self, line):
+        for writer in list(self._watchers):
+            writer.write(line)
+            if writer.transport.get_write_buffer_size() > 256 * 1024:
+                # Slow the replay down to the client, drop it if it stops reading
+                try:
+                    await asyncio.wait_for(writer.drain(), 5)
+                except (asyncio.TimeoutError, ConnectionError):
+                    logging.warning("Client too slow, disconnecting")
+                    self._watchers.discard(writer)
+                    writer.close()
+
+    async def replay(self):
+        """
+        Replays the trace, pacing reports by their recorded times.
+        """
+        while True:
+            start = None
+            started = time.monotonic()
+            for seconds, report in read_trace(self.path):
+                if start is None:
+                    start = seconds
+                delay = started + (seconds - start) / self.speed - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                elif self.sent % 100 == 0:
+                    # Behind schedule, still let clients be served
+                    await asyncio.sleep(0)
+                report = self._report(seconds, report, start)
+                if report['class'] == 'TPV':
+                    self.tpv = report
+                else:
+                    self.sky = report
+                if self.malformed and random.random() < self.malformed:
+                    await self._broadcast(random.choice(
+                        (b'{"class":"TPV","mode":3,"lat":\n', b'\x00\xff garbage\n', b'{"class":}\n')))
+                await self._broadcast(json.dumps(report).encode('utf-8') + b'\n')
+                self.sent += 1
+            if not self.loop:
+                logging.info(f"Trace replayed, {self.sent} reports sent")
+                return
+            await asyncio.sleep(0)
+
+    def _poll(self):
+        if self.tpv is None:
+            return {"class": "POLL", "time": format_time(time.time()), "active": 0, "tpv": [], "sky": []}
+        return {"class": "POLL", "time": format_time(time.time()), "active": 1,
+                "tpv": [self.tpv], "sky": [self.sky or {"class": "SKY", "satellites": []}]}
+
+    async def handle_client(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        logging.info(f"Client connected: {peer}")
+        writer.write(json.dumps(VERSION).encode('utf-8') + b'\n')
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                for command in line.decode('utf-8', 'replace').replace(';', '\n').splitlines():
+                    command = command.strip()
+                    if command.startswith('?WATCH'):
+                        watch = {"enable": True, "json": False}
+                        if '=' in command:
+                            try:
+                                watch.update(json.loads(command.split('=', 1)[1]))
+                            except ValueError:
+                                writer.write(b'{"class":"ERROR","message":"Invalid WATCH"}\n')
+                                continue
+                        writer.write(json.dumps({"class": "DEVICES", "devices": [DEVICE]}).encode('utf-8') + b'\n')
+                        writer.write(json.dumps(dict(watch, **{"class": "WATCH"})).encode('utf-8') + b'\n')
+                        if watch['enable'] and watch['json']:
+                            self._watchers.add(writer)
+                        else:
+                            self._watchers.discard(writer)
+                    elif command.startswith('?POLL'):
+                        writer.write(json.dumps(self._poll()).encode('utf-8') + b'\n')
+                    elif command.startswith('?DEVICES'):
+                        writer.write(json.dumps({"class": "DEVICES", "devices": [DEVICE]}).encode('utf-8') + b'\n')
+                    elif command.startswith('?VERSION'):
+                        writer.write(json.dumps(VERSION).encode('utf-8') + b'\n')
+                    elif command:
+                        writer.write(b'{"class":"ERROR","message":"Unrecognized request"}\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._watchers.discard(writer)
+            writer.close()
+            logging.info(f"Client disconnected: {peer}")
+
+    async def serve(self, host='127.0.0.1', port=2947):
+        server = await asyncio.start_server(self.handle_client, host, port)
+        logging.info(f"Fake gpsd listening on {host}:{port}, replaying {self.path} at {self.speed}x")
+        async with server:
+            await self.replay()
+            # Keep answering polls with the last fix after the trace ends
+            await server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay an NMEA or gpsd JSON trace over the gpsd protocol')
+    parser.add_argument('trace', help='.nmea file or gpsd JSON report lines')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2947)
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, e.g. 1 to 1000')
+    parser.add_argument('--loop', action='store_true', help='Start over at the end of the trace')
+    parser.add_argument('--no-fix-every', type=float, default=0, help='Trace seconds between no-fix periods')
+    parser.add_argument('--no-fix-duration', type=float, default=10, help='Trace seconds of each no-fix period')
+    parser.add_argument('--malformed', type=float, default=0.0, help='Probability of a malformed line per report')
+    parser.add_argument('--current-time', action='store_true', help='Send reports with the current time')
+    args = parser.parse_args()
+    gpsd = FakeGpsd(args.trace, args.speed, args.loop, args.no_fix_every, args.no_fix_duration,
+                    args.malformed, args.current_time)
+    try:
+        asyncio.run(gpsd.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
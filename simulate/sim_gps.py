@@ -1,101 +1,231 @@
-import math
-import random
+import argparse
+import time
+
+import numpy as np
 
 # Constants
 EARTH_RADIUS = 6371  # in kilometers
+KNOTS = 1.852  # km/h
+
 
 def calculate_distance(lat1, lon1, lat2, lon2):
     """
-    Calculates the distance between two GPS coordinates using the haversine formula.
+    Calculates the distance (km) between GPS coordinates using the haversine formula.
+    Works on scalars and NumPy arrays.
     """
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat / 2) * math.sin(dlat / 2) + math.cos(math.radians(lat1)) \
-        * math.cos(math.radians(lat2)) * math.sin(dlon / 2) * math.sin(dlon / 2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-    distance = EARTH_RADIUS * c
-    return distance
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return EARTH_RADIUS * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
 
 def calculate_bearing(lat1, lon1, lat2, lon2):
     """
-    Calculates the initial bearing (in degrees) from the first point to the second point.
+    Calculates the initial bearing (in degrees) from the first points to the second points.
+    Works on scalars and NumPy arrays.
     """
-    dlon = math.radians(lon2 - lon1)
-    lat1_rad = math.radians(lat1)
-    lat2_rad = math.radians(lat2)
-    y = math.sin(dlon) * math.cos(lat2_rad)
-    x = math.cos(lat1_rad) * math.sin(lat2_rad) - math.sin(lat1_rad) * math.cos(lat2_rad) * math.cos(dlon)
-    bearing = (math.atan2(y, x) * 180 / math.pi + 360) % 360
-    return bearing
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    dlon = lon2 - lon1
+    y = np.sin(dlon) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(y, x)) + 360) % 360
 
-def generate_curvy_route(start_lat, start_lon, end_lat, end_lon, num_waypoints, max_speed):
+
+def random_waypoints(start_lat, start_lon, count, step=0.05, rng=None):
     """
-    Generates a curvy route with at least a 90-degree turn, including bearing values.
+    Generates a random walk of count waypoints starting at the given position.
     """
-    waypoints = []
-
-    # Calculate the total distance between start and end points
-    total_distance = calculate_distance(start_lat, start_lon, end_lat, end_lon)
-
-    # Generate intermediate waypoints along the route
-    waypoints.append((start_lat, start_lon))
-    current_lat, current_lon = start_lat, start_lon
+    rng = rng or np.random.default_rng()
+    offsets = rng.uniform(-step, step, size=(count, 2))
+    offsets[0] = 0
+    return start_lat + np.cumsum(offsets[:, 0]), start_lon + np.cumsum(offsets[:, 1])
 
-    for _ in range(num_waypoints - 2):
-        # Generate random latitude and longitude offsets
-        lat_offset = random.uniform(-0.05, 0.05)
-        lon_offset = random.uniform(-0.05, 0.05)
 
-        # Calculate the new waypoint coordinates
-        current_lat += lat_offset
-        current_lon += lon_offset
-
-        # Add the new waypoint to the list
-        waypoints.append((current_lat, current_lon))
-
-    waypoints.append((end_lat, end_lon))
-
-    # Calculate the distance between each waypoint
-    distances = [calculate_distance(*waypoints[i], *waypoints[i+1]) for i in range(num_waypoints-1)]
-
-    # Calculate the time required to travel each distance segment based on the desired speed
-    times = [distance / max_speed for distance in distances]
-
-    # Calculate the bearing between each pair of consecutive waypoints
-    bearings = [calculate_bearing(*waypoints[i], *waypoints[i+1]) for i in range(num_waypoints-1)]
+def random_route(start_lat, start_lon, length, rng):
+    """
+    Generates random walk waypoints until the route is at least length metres.
 
-    # Generate simulated GPS data
-    gps_data = []
-    current_speed = 0
+    Returns:
+        tuple: Latitudes, longitudes and the distance along the route in metres at each waypoint.
+    """
+    lats = np.array([start_lat])
+    lons = np.array([start_lon])
+    route = np.zeros(1)
+    while route[-1] < length:
+        # Legs average about 3.3 km, add a few more than the remaining length needs
+        count = int((length - route[-1]) / 3000) + 2
+        more_lats, more_lons = random_waypoints(lats[-1], lons[-1], count + 1, rng=rng)
+        leg_lengths = calculate_distance(more_lats[:-1], more_lons[:-1], more_lats[1:], more_lons[1:]) * 1000
+        lats = np.concatenate((lats, more_lats[1:]))
+        lons = np.concatenate((lons, more_lons[1:]))
+        route = np.concatenate((route, route[-1] + np.cumsum(leg_lengths)))
+    return lats, lons, route
 
-    print(f"{bearings}")
 
-    for i in range(num_waypoints):
-        lat, lon = waypoints[i]
-        distance_traveled = sum(distances[:i+1])
-        elapsed_time = sum(times[:i+1])
-        current_speed = max_speed
-        bearing = bearings[i]
-        gps_data.append({
-            'latitude': lat,
-            'longitude': lon,
-            'speed': current_speed,
-            'elapsed_time': elapsed_time,
-            'bearing': bearing
-        })
+def generate_curvy_route(start_lat, start_lon, end_lat, end_lon, num_waypoints, max_speed):
+    """
+    Generates a curvy route with at least a 90-degree turn, including bearing values.
+    """
+    lats, lons = random_waypoints(start_lat, start_lon, num_waypoints - 1)
+    lats = np.append(lats, end_lat)
+    lons = np.append(lons, end_lon)
+
+    # Distance and bearing of each leg, elapsed time at each waypoint at the desired speed
+    distances = calculate_distance(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    bearings = calculate_bearing(lats[:-1], lons[:-1], lats[1:], lons[1:])
+    bearings = np.append(bearings, bearings[-1])
+    elapsed_times = np.concatenate(([0], np.cumsum(distances / max_speed)))
+
+    return [{
+        'latitude': lat,
+        'longitude': lon,
+        'speed': max_speed,
+        'elapsed_time': elapsed_time,
+        'bearing': bearing
+    } for lat, lon, elapsed_time, bearing in zip(lats.tolist(), lons.tolist(), elapsed_times.tolist(), bearings.tolist())]
+
+
+def speed_profile(samples, rate, max_speed, rng, stop_probability=0.1):
+    """
+    Generates a speed profile (km/h) of samples at rate Hz: cruising speeds
+    held for 30-300 s, some of them stops, with ~20 s acceleration ramps.
+    """
+    levels = []
+    lengths = []
+    total = 0
+    while total < samples:
+        length = int(rng.uniform(30, 300) * rate)
+        levels.append(0.0 if rng.random() < stop_probability else rng.uniform(0.4, 1.0) * max_speed)
+        lengths.append(length)
+        total += length
+    speeds = np.repeat(levels, lengths)[:samples]
+    window = max(1, int(20 * rate))
+    padded = np.concatenate((np.full(window, speeds[0]), speeds))
+    smoothed = np.convolve(padded, np.ones(window) / window, mode='valid')[1:samples + 1]
+    return np.maximum(smoothed, 0)
+
+
+def generate_track(start_lat, start_lon, duration, rate=10, max_speed=80, seed=None, start_time=None):
+    """
+    Generates a track sampled at a fixed rate along a random route.
+
+    Args:
+        start_lat (float): Start latitude.
+        start_lon (float): Start longitude.
+        duration (float): Track length in seconds.
+        rate (float): Samples per second.
+        max_speed (float): Max speed in km/h.
+        seed (int): Random seed for a reproducible track.
+        start_time (float): Time of the first sample, seconds since epoch.
+
+    Returns:
+        dict: NumPy arrays time, latitude, longitude, altitude, speed (km/h) and bearing.
+    """
+    rng = np.random.default_rng(seed)
+    samples = int(duration * rate)
+    speeds = speed_profile(samples, rate, max_speed, rng)
+    travelled = np.cumsum(speeds / 3.6 / rate)  # metres
+
+    lats, lons, route = random_route(start_lat, start_lon, travelled[-1], rng)
+    legs = len(route) - 1
+    leg_bearings = calculate_bearing(lats[:-1], lons[:-1], lats[1:], lons[1:])
+
+    leg = np.clip(np.searchsorted(route, travelled, side='right') - 1, 0, legs - 1)
+    altitude = 50 + 30 * np.sin(travelled / 2000) + rng.normal(0, 0.5, samples)
+    return {
+        'time': (start_time or time.time()) + np.arange(samples) / rate,
+        'latitude': np.interp(travelled, route, lats),
+        'longitude': np.interp(travelled, route, lons),
+        'altitude': altitude,
+        'speed': speeds,
+        'bearing': leg_bearings[leg]
+    }
+
+
+def iso_times(seconds):
+    """
+    Formats seconds since epoch as gpsd style ISO 8601 strings.
+    """
+    return np.datetime_as_string((seconds * 1000).astype('datetime64[ms]'), unit='ms')
 
-    return gps_data
 
-# Example usage
-start_latitude = 37.7749
-start_longitude = -122.4194
-end_latitude = 34.0522
-end_longitude = -118.2437
-num_waypoints = 10
-max_speed = 60  # km/h
+def write_gpsd_json(path, track, chunk=100000):
+    """
+    Writes a track as gpsd TPV JSON lines, one chunk at a time.
+    """
+    with open(path, 'w') as f:
+        for start in range(0, len(track['time']), chunk):
+            part = slice(start, start + chunk)
+            lines = []
+            for t, lat, lon, alt, speed, bearing in zip(
+                    iso_times(track['time'][part]).tolist(),
+                    track['latitude'][part].tolist(), track['longitude'][part].tolist(),
+                    track['altitude'][part].round(1).tolist(), (track['speed'][part] / 3.6).round(2).tolist(),
+                    track['bearing'][part].round(1).tolist()):
+                lines.append(f'{{"class":"TPV","device":"sim","mode":3,"time":"{t}Z","lat":{lat:.7f},'
+                             f'"lon":{lon:.7f},"alt":{alt},"climb":0.0,"speed":{speed},"track":{bearing},'
+                             f'"epx":3.0,"epy":3.0,"epv":5.0}}\n')
+            f.write(''.join(lines))
+
+
+def nmea_coordinates(values):
+    # Degrees and decimal minutes, e.g. 6500.7416 for 65.01236
+    minutes = np.round(np.abs(values) * 60, 4)
+    degrees = np.floor(minutes / 60)
+    return degrees.astype(int), minutes - degrees * 60
+
+
+def nmea_checksums(bodies):
+    """
+    Computes the XOR checksums of NMEA sentence bodies in one NumPy pass.
+    """
+    data = np.frombuffer(''.join(bodies).encode('ascii'), dtype=np.uint8)
+    starts = np.concatenate(([0], np.cumsum([len(body) for body in bodies])[:-1]))
+    return np.bitwise_xor.reduceat(data, starts)
 
-gps_data = generate_curvy_route(start_latitude, start_longitude, end_latitude, end_longitude, num_waypoints, max_speed)
 
-# Print the simulated GPS data
-for point in gps_data:
-    print(f"Latitude: {point['latitude']}, Longitude: {point['longitude']}, Speed: {point['speed']}, Elapsed Time: {point['elapsed_time']}, Bearing: {point['bearing']}")
\ No newline at end of file
+def write_nmea(path, track, chunk=100000):
+    """
+    Writes a track as NMEA GGA and RMC sentences, one chunk at a time.
+    """
+    with open(path, 'w') as f:
+        for start in range(0, len(track['time']), chunk):
+            part = slice(start, start + chunk)
+            times = iso_times(track['time'][part]).tolist()
+            lat_deg, lat_min = nmea_coordinates(track['latitude'][part])
+            lon_deg, lon_min = nmea_coordinates(track['longitude'][part])
+            bodies = []
+            for t, lad, lam, ns, lod, lom, ew, alt, knots, bearing in zip(
+                    times, lat_deg.tolist(), lat_min.tolist(),
+                    np.where(track['latitude'][part] >= 0, 'N', 'S').tolist(),
+                    lon_deg.tolist(), lon_min.tolist(),
+                    np.where(track['longitude'][part] >= 0, 'E', 'W').tolist(),
+                    track['altitude'][part].tolist(), (track['speed'][part] / KNOTS).tolist(),
+                    track['bearing'][part].tolist()):
+                clock = t[11:13] + t[14:16] + t[17:19] + '.' + t[20:22]
+                date = t[8:10] + t[5:7] + t[2:4]
+                latitude = f'{lad:02d}{lam:07.4f},{ns}'
+                longitude = f'{lod:03d}{lom:07.4f},{ew}'
+                bodies.append(f'GPGGA,{clock},{latitude},{longitude},1,10,0.9,{alt:.1f},M,0.0,M,,')
+                bodies.append(f'GPRMC,{clock},A,{latitude},{longitude},{knots:.2f},{bearing:.1f},{date},,,A')
+            checksums = nmea_checksums(bodies).tolist()
+            f.write(''.join(f'${body}*{checksum:02X}\r\n' for body, checksum in zip(bodies, checksums)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a simulated GPS track')
+    parser.add_argument('output', help='Output file')
+    parser.add_argument('--format', choices=('nmea', 'json'), default='json',
+                        help='NMEA sentences or gpsd TPV JSON lines')
+    parser.add_argument('--hours', type=float, default=1, help='Track length in hours')
+    parser.add_argument('--rate', type=float, default=10, help='Samples per second')
+    parser.add_argument('--max-speed', type=float, default=80, help='Max speed in km/h')
+    parser.add_argument('--start', type=float, nargs=2, default=(65.0124, 25.4682), metavar=('LAT', 'LON'))
+    parser.add_argument('--seed', type=int, default=None, help='Random seed')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    track = generate_track(args.start[0], args.start[1], args.hours * 3600, args.rate, args.max_speed, args.seed)
+    generated = time.perf_counter()
+    (write_nmea if args.format == 'nmea' else write_gpsd_json)(args.output, track)
+    print(f"{len(track['time'])} samples generated in {generated - started:.2f} s, "
+          f"written in {time.perf_counter() - generated:.2f} s")
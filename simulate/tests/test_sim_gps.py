@@ -0,0 +1,32 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sim_gps import calculate_distance, generate_track  # noqa: E402
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_position_advances_while_moving(seed):
+    track = generate_track(65.0, 25.5, 24 * 3600, rate=10, seed=seed, start_time=0)
+    latitude, longitude, speed = track['latitude'], track['longitude'], track['speed']
+    moved = calculate_distance(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:]) * 1000
+
+    moving = speed[1:] > 0
+    assert moving.sum() > len(moving) / 2
+    assert (moved[moving] > 0).all()
+    # Straight line distance between samples is at most the distance driven,
+    # give or take interpolating in degrees
+    assert (moved <= speed[1:] / 3.6 / 10 * 1.001 + 1e-6).all()
+    assert (moved[~moving] == 0).all()
+
+
+def test_route_is_as_long_as_the_drive():
+    track = generate_track(65.0, 25.5, 3 * 3600, rate=1, max_speed=120, seed=3, start_time=0)
+    driven = np.sum(track['speed'][1:] / 3.6) / 1000
+    straight = calculate_distance(track['latitude'][:-1], track['longitude'][:-1],
+                                  track['latitude'][1:], track['longitude'][1:]).sum()
+    assert straight == pytest.approx(driven, rel=0.02)
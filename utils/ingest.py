@@ -0,0 +1,382 @@
+import argparse
+import csv
+import json
+import logging
+import math
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+import paho.mqtt.client as mqtt
+
+logging.basicConfig(
+    format='%(asctime)s %(levelname)-8s %(message)s',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+COLUMNS = ('time', 'latitude', 'longitude', 'altitude', 'speed', 'bearing', 'gps_accuracy', 'satellites')
+SCALE = 10000000  # Coordinates are stored as integers, 1e-7 degrees is about 1 cm
+# Columns of the v2 batch messages in the order of COLUMNS, after time
+BATCH_COLUMNS = ('lat', 'lon', 'alt', 'speed', 'bearing', 'acc')
+
+SCHEMA = (
+    # The time in ms is the rowid, so rows are clustered by time and
+    # time range queries are index range scans
+    "CREATE TABLE IF NOT EXISTS fixes (t INTEGER PRIMARY KEY, lat INTEGER, lon INTEGER, "
+    "alt REAL, speed REAL, bearing REAL, acc REAL, sats INTEGER)",
+    # Time range and bounding box of each inserted batch, so bounding box
+    # queries only scan the time ranges that can match
+    "CREATE TABLE IF NOT EXISTS chunks (start INTEGER, end INTEGER, min_lat INTEGER, max_lat INTEGER, "
+    "min_lon INTEGER, max_lon INTEGER, count INTEGER)",
+    "CREATE INDEX IF NOT EXISTS chunks_end ON chunks (end)"
+)
+
+
+def parse_time(value):
+    """
+    Converts an ISO 8601 time string to ms since epoch.
+    """
+    return round(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+
+
+def _scaled(value):
+    return None if value is None else round(value * SCALE)
+
+
+def _number(value):
+    return None if value is None or (isinstance(value, float) and math.isnan(value)) else value
+
+
+def fix_row(data):
+    """
+    Converts a fix from the attributes topic to a table row.
+
+    Returns:
+        tuple: The row, or None if the fix has no time or position.
+    """
+    if not data.get('time') or data.get('latitude') is None or data.get('longitude') is None:
+        return None
+    return (parse_time(data['time']), _scaled(data['latitude']), _scaled(data['longitude']),
+            _number(data.get('altitude')), _number(data.get('speed')), _number(data.get('bearing')),
+            _number(data.get('gps_accuracy')), data.get('satellites'))
+
+
+def batch_rows(batch):
+    """
+    Converts a columnar batch message of the v2 batch topic to table rows.
+    """
+    rows = []
+    t = batch['t0']
+    columns = [batch.get(column) or [None] * len(batch['dt']) for column in BATCH_COLUMNS]
+    for dt, lat, lon, alt, speed, bearing, acc in zip(batch['dt'], *columns):
+        t += dt
+        if lat is not None and lon is not None:
+            rows.append((t, _scaled(lat), _scaled(lon), alt, speed, bearing, acc, None))
+    return rows
+
+
+def partition_name(t):
+    """
+    Returns the monthly partition of a time in ms since epoch, e.g. 2024-06.
+    """
+    tm = time.gmtime(t / 1000)
+    return f"{tm.tm_year:04d}-{tm.tm_mon:02d}"
+
+
+def month_starts(start, end):
+    """
+    Yields the partition names between two times in ms since epoch.
+    """
+    tm = time.gmtime(start / 1000)
+    year, month = tm.tm_year, tm.tm_mon
+    last = partition_name(end)
+    while True:
+        name = f"{year:04d}-{month:02d}"
+        yield name
+        if name >= last:
+            return
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def merge_ranges(ranges):
+    """
+    Merges overlapping (start, end) ranges.
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return merged
+
+
+class FixStore:
+    """
+    Append-only store of fleet positions in SQLite files partitioned by
+    device and month: <directory>/<device>/<YYYY-MM>.sqlite.
+
+    Fixes are buffered in memory and written with one executemany per
+    partition, in WAL mode. Fixes with a time already stored are ignored,
+    so replayed messages are not duplicated.
+
+    Args:
+        directory (str): Root directory of the store.
+        flush_size (int): Buffered fixes that trigger a flush.
+    """
+
+    def __init__(self, directory, flush_size=5000):
+        self.directory = directory
+        self.flush_size = flush_size
+        self.received = 0
+        self.written = 0
+        self.rejected = 0
+        self._pending = {}
+        self._pending_count = 0
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.flush_needed = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def device_name(device):
+        """
+        Returns the device id as a safe directory name.
+        """
+        name = re.sub(r'[^A-Za-z0-9_.-]', '_', device)
+        return '_' + name if name.startswith('.') or not name else name
+
+    def add(self, device, rows):
+        """
+        Buffers rows of a device for the next flush.
+        """
+        if not rows:
+            return
+        with self._lock:
+            self._pending.setdefault(device, []).extend(rows)
+            self._pending_count += len(rows)
+            self.received += len(rows)
+            if self._pending_count >= self.flush_size:
+                self.flush_needed.set()
+
+    def add_message(self, topic, payload):
+        """
+        Buffers a fix or batch message from gps_module/<device>/attributes or
+        gps_module/<device>/batch.
+        """
+        parts = topic.split('/')
+        if len(parts) < 3:
+            return
+        try:
+            data = json.loads(payload)
+            if parts[-1] == 'batch':
+                rows = batch_rows(data)
+            else:
+                row = fix_row(data)
+                rows = [row] if row else []
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            logging.debug(f"Ignoring malformed message on {topic}: {e}")
+            self.rejected += 1
+            return
+        self.add(parts[-2], rows)
+
+    def _connection(self, device, partition):
+        key = (device, partition)
+        db = self._connections.get(key)
+        if db is None:
+            directory = os.path.join(self.directory, self.device_name(device))
+            os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(os.path.join(directory, f"{partition}.sqlite"), check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            for statement in SCHEMA:
+                db.execute(statement)
+            self._connections[key] = db
+        return db
+
+    def flush(self):
+        """
+        Writes the buffered fixes, one transaction per partition.
+
+        Returns:
+            int: Number of fixes written.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._pending_count = 0
+            self.flush_needed.clear()
+        written = 0
+        with self._write_lock:
+            for device, rows in pending.items():
+                partitions = {}
+                for row in rows:
+                    partitions.setdefault(partition_name(row[0]), []).append(row)
+                for partition, part in partitions.items():
+                    db = self._connection(device, partition)
+                    lats = [row[1] for row in part]
+                    lons = [row[2] for row in part]
+                    with db:
+                        cursor = db.executemany("INSERT OR IGNORE INTO fixes VALUES (?, ?, ?, ?, ?, ?, ?, ?)", part)
+                        db.execute("INSERT INTO chunks VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                   (min(row[0] for row in part), max(row[0] for row in part),
+                                    min(lats), max(lats), min(lons), max(lons), len(part)))
+                    written += cursor.rowcount
+        self.written += written
+        return written
+
+    def close(self):
+        self.flush()
+        with self._write_lock:
+            for db in self._connections.values():
+                db.close()
+            self._connections.clear()
+
+    def devices(self):
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.isdir(os.path.join(self.directory, name)))
+
+    def query(self, device, start, end, bbox=None):
+        """
+        Yields the stored fixes of a device in time order.
+
+        Args:
+            device (str): Device id.
+            start (int): Start time in ms since epoch, inclusive.
+            end (int): End time in ms since epoch, inclusive.
+            bbox (tuple): Optional (south, west, north, east) in degrees.
+
+        Yields:
+            tuple: A row with the values of COLUMNS, time in ms since epoch.
+        """
+        directory = os.path.join(self.directory, self.device_name(device))
+        for partition in month_starts(start, end):
+            path = os.path.join(directory, f"{partition}.sqlite")
+            if not os.path.exists(path):
+                continue
+            db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+            try:
+                if bbox is None:
+                    rows = db.execute("SELECT * FROM fixes WHERE t BETWEEN ? AND ? ORDER BY t", (start, end))
+                    for row in rows:
+                        yield (row[0], row[1] / SCALE, row[2] / SCALE) + row[3:]
+                    continue
+                south, west, north, east = (_scaled(value) for value in bbox)
+                chunks = db.execute(
+                    "SELECT start, end FROM chunks WHERE end >= ? AND start <= ? AND max_lat >= ? "
+                    "AND min_lat <= ? AND max_lon >= ? AND min_lon <= ?",
+                    (start, end, south, north, west, east)).fetchall()
+                for chunk_start, chunk_end in merge_ranges(chunks):
+                    rows = db.execute(
+                        "SELECT * FROM fixes WHERE t BETWEEN ? AND ? AND lat BETWEEN ? AND ? "
+                        "AND lon BETWEEN ? AND ? ORDER BY t",
+                        (max(start, chunk_start), min(end, chunk_end), south, north, west, east))
+                    for row in rows:
+                        yield (row[0], row[1] / SCALE, row[2] / SCALE) + row[3:]
+            finally:
+                db.close()
+
+
+def serve(store, host, port, topics, flush_interval):
+    """
+    Subscribes to the fix topics and writes the fixes until interrupted.
+    """
+    def on_connect(client, userdata, flags, reason_code, properties=None):
+        logging.info(f"Connected to {host}:{port} with result code {reason_code}")
+        for topic in topics:
+            client.subscribe(topic)
+
+    def on_message(client, userdata, msg):
+        store.add_message(msg.topic, msg.payload)
+
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.reconnect_delay_set(min_delay=1, max_delay=120)
+    client.connect_async(host, port, 30)
+    client.loop_start()
+    last_log = time.monotonic()
+    try:
+        while True:
+            store.flush_needed.wait(flush_interval)
+            started = time.perf_counter()
+            written = store.flush()
+            if written:
+                logging.debug(f"Wrote {written} fixes in {time.perf_counter() - started:.3f} s")
+            if time.monotonic() - last_log >= 60:
+                logging.info(f"{store.received} fixes received, {store.written} written, "
+                             f"{store.rejected} malformed messages")
+                last_log = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        client.disconnect()
+        client.loop_stop()
+        store.close()
+
+
+def benchmark(directory, devices, fixes):
+    """
+    Measures the ingest rate without a broker, from JSON messages to disk.
+    """
+    store = FixStore(directory)
+    start = parse_time('2024-06-01T00:00:00Z')
+    messages = []
+    for n in range(fixes):
+        data = {'latitude': 65.0 + n * 1e-6, 'longitude': 25.4 + n * 1e-6, 'altitude': 20.0, 'climb': 0.0,
+                'speed': 50.0, 'bearing': 90.0, 'satellites': 9, 'sats_valid': 9, 'gps_accuracy': 4.2,
+                'time': datetime.fromtimestamp((start + n // devices * 100) / 1000, timezone.utc)
+                .strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'}
+        messages.append((f"gps_module/device{n % devices}/attributes", json.dumps(data).encode('utf-8')))
+    started = time.perf_counter()
+    for topic, payload in messages:
+        store.add_message(topic, payload)
+        if store.flush_needed.is_set():
+            store.flush()
+    store.close()
+    elapsed = time.perf_counter() - started
+    print(f"{store.written} fixes of {devices} devices written in {elapsed:.2f} s, {store.written / elapsed:.0f} fixes/s")
+    started = time.perf_counter()
+    rows = sum(1 for _ in store.query('device0', start, start + 3600000, (65.0, 25.4, 65.05, 25.45)))
+    print(f"Bounding box query of device0 returned {rows} fixes in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Store fleet positions from MQTT and query them')
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='Subscribe and store fixes')
+    serve_parser.add_argument('directory', help='Store directory')
+    serve_parser.add_argument('--host', default='localhost')
+    serve_parser.add_argument('--port', type=int, default=1883)
+    serve_parser.add_argument('--topic', action='append',
+                              help='Topics to subscribe, default gps_module/+/attributes and gps_module/+/batch')
+    serve_parser.add_argument('--flush-interval', type=float, default=1, help='Max seconds between writes')
+    serve_parser.add_argument('--flush-size', type=int, default=5000, help='Buffered fixes that trigger a write')
+    query_parser = commands.add_parser('query', help='Print stored fixes as CSV')
+    query_parser.add_argument('directory', help='Store directory')
+    query_parser.add_argument('device', help='Device id')
+    query_parser.add_argument('--start', required=True, help='ISO 8601 time, e.g. 2024-06-01T00:00:00Z')
+    query_parser.add_argument('--end', required=True, help='ISO 8601 time')
+    query_parser.add_argument('--bbox', type=float, nargs=4, metavar=('SOUTH', 'WEST', 'NORTH', 'EAST'))
+    bench_parser = commands.add_parser('bench', help='Measure the ingest rate')
+    bench_parser.add_argument('directory', help='Scratch store directory')
+    bench_parser.add_argument('--devices', type=int, default=100)
+    bench_parser.add_argument('--fixes', type=int, default=200000)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(FixStore(args.directory, args.flush_size), args.host, args.port,
+              args.topic or ['gps_module/+/attributes', 'gps_module/+/batch'], args.flush_interval)
+    elif args.command == 'query':
+        writer = csv.writer(sys.stdout)
+        writer.writerow(COLUMNS)
+        for row in FixStore(args.directory).query(args.device, parse_time(args.start), parse_time(args.end),
+                                                  args.bbox):
+            writer.writerow(row)
+    else:
+        benchmark(args.directory, args.devices, args.fixes)
@@ -0,0 +1,99 @@
+import math
+import time
+
+from payload import parse_time
+
+BATCH_VERSION = 1
+# Batch column name, fix field, decimals
+COLUMNS = (
+    ('lat', 'latitude', 7),
+    ('lon', 'longitude', 7),
+    ('alt', 'altitude', 1),
+    ('speed', 'speed', 1),
+    ('bearing', 'bearing', 1),
+    ('acc', 'gps_accuracy', 1)
+)
+
+
+def _round(value, decimals):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    return round(value, decimals)
+
+
+class FixBatcher:
+    """
+    Collects fixes into columnar batch messages. A batch is complete when it
+    has max_fixes fixes or its first fix is max_delay seconds old.
+
+    Batches look like {"v": 1, "host": ..., "t0": first time in ms since epoch,
+    "dt": [ms from the previous fix, ...], "lat": [...], "lon": [...], ...}
+
+    Args:
+        max_fixes (int): Fixes per batch.
+        max_delay (float): Max seconds a fix waits in the batch.
+    """
+
+    def __init__(self, max_fixes=50, max_delay=5):
+        self.max_fixes = max_fixes
+        self.max_delay = max_delay
+        self._fixes = []
+        self._started = 0
+        self.flushed = []  # fixes of the last batch returned by flush()
+
+    def __len__(self):
+        return len(self._fixes)
+
+    def add(self, data, now=None):
+        """
+        Adds a fix.
+
+        Returns:
+            dict: The completed batch, or None if the batch is not complete yet.
+        """
+        if now is None:
+            now = time.monotonic()
+        if not self._fixes:
+            self._started = now
+        self._fixes.append(data)
+        if len(self._fixes) >= self.max_fixes or self.due(now):
+            return self.flush()
+        return None
+
+    def due(self, now=None):
+        """
+        Checks if the oldest fix in the batch has waited max_delay seconds.
+        """
+        if now is None:
+            now = time.monotonic()
+        return bool(self._fixes) and now - self._started >= self.max_delay
+
+    def latest(self):
+        return self._fixes[-1] if self._fixes else None
+
+    def flush(self):
+        """
+        Returns the collected fixes as a batch and starts a new one.
+
+        Returns:
+            dict: The batch, or None if there are no fixes.
+        """
+        if not self._fixes:
+            return None
+        fixes = self._fixes
+        self._fixes = []
+        self.flushed = fixes
+
+        times = []
+        for data in fixes:
+            seconds = parse_time(data.get('time'))
+            times.append(round((time.time() if math.isnan(seconds) else seconds) * 1000))
+        batch = {
+            'v': BATCH_VERSION,
+            'host': fixes[-1].get('host'),
+            't0': times[0],
+            'dt': [0] + [current - previous for previous, current in zip(times, times[1:])]
+        }
+        for column, field, decimals in COLUMNS:
+            batch[column] = [_round(data.get(field), decimals) for data in fixes]
+        return batch
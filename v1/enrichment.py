@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from time import time
+
+import helpers
+from metrics import histogram, timed
+
+
+class CoalescingTask:
+    """
+    Runs a lookup on an executor so that at most one call is in flight.
+    Requests made while a call runs replace each other, so only the newest
+    arguments are looked up next.
+
+    Args:
+        executor (Executor): Executor running the lookups.
+        name (str): Name used in log messages.
+        function (callable): The lookup. A None result keeps the previous result.
+    """
+
+    def __init__(self, executor, name, function):
+        self.name = name
+        self.result = None
+        self.updated = 0
+        self._executor = executor
+        self._function = function
+        self._lock = threading.Lock()
+        self._pending = None
+        self._running = False
+
+    @property
+    def busy(self):
+        return self._running
+
+    def submit(self, *args):
+        with self._lock:
+            self._pending = args
+            if self._running:
+                return
+            self._running = True
+        self._executor.submit(self._run)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                args = self._pending
+                self._pending = None
+                if args is None:
+                    self._running = False
+                    return
+            try:
+                result = self._function(*args)
+            except Exception as e:
+                logging.error(f"{self.name} lookup failed: {e}")
+                continue
+            if result is not None:
+                with self._lock:
+                    self.result = result
+                    self.updated = time()
+
+
+class Enricher:
+    """
+    Looks up address, speed limit and road weather in the background so slow
+    services do not delay publishing fixes. Requests with the way id of a map
+    matched road look up its address and speed limit once per way.
+
+    Args:
+        status (Status): Tracker status holding the geocoders and caches.
+        max_workers (int): Size of the lookup thread pool.
+    """
+
+    def __init__(self, status, max_workers=2):
+        self._status = status
+        self._ways = OrderedDict()  # (lookup, way id): result
+        self._ways_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='enrichment')
+        self._tasks = [
+            CoalescingTask(self._executor, 'address', self._lookup_address),
+            CoalescingTask(self._executor, 'speed_limit', self._lookup_speed_limit)
+        ]
+        if status.road_weather:
+            self._tasks.append(CoalescingTask(self._executor, 'weather', self._lookup_weather))
+
+    def _by_way(self, name, way_id, function, *args):
+        # Result of a lookup per way id, the first lookup on a way is kept
+        if way_id is None:
+            return function(*args)
+        with self._ways_lock:
+            result = self._ways.get((name, way_id))
+            if result is not None:
+                self._ways.move_to_end((name, way_id))
+                return result
+        result = function(*args)
+        if result:
+            with self._ways_lock:
+                self._ways[(name, way_id)] = result
+                if len(self._ways) > 4096:
+                    self._ways.popitem(last=False)
+        return result
+
+    def _lookup_address(self, latitude, longitude, bearing, way_id=None):
+        address = self._by_way('address', way_id, helpers.perform_reverse_geocoding, self._status, latitude,
+                               longitude)
+        logging.info(f"{address}")
+        if address:
+            self._status.last_address_fetch = time()
+        return address
+
+    def _lookup_speed_limit(self, latitude, longitude, bearing, way_id=None):
+        return self._by_way('speed_limit', way_id, helpers.get_speed_limit, self._status, latitude, longitude,
+                            bearing)
+
+    @timed(histogram('gps_stage_seconds', 'Seconds spent per pipeline stage', stage='road_weather'))
+    def _lookup_weather(self, latitude, longitude, bearing, way_id=None):
+        return self._status.road_weather.lookup(latitude, longitude)
+
+    def request(self, latitude, longitude, bearing, way_id=None):
+        """
+        Requests enrichment of a position, on the way way_id if it is map
+        matched. Replaces any request not yet started.
+        """
+        for task in self._tasks:
+            task.submit(latitude, longitude, bearing, way_id)
+
+    def latest(self):
+        """
+        Returns the newest lookup results by name, and 'age' in seconds of the
+        oldest of them, -1 if nothing has been looked up yet.
+        """
+        results = {}
+        updated = []
+        for task in self._tasks:
+            if task.updated:
+                results[task.name] = task.result
+                updated.append(task.updated)
+        results['age'] = round(time() - min(updated), 1) if updated else -1
+        return results
+
+    def pending(self):
+        """
+        Returns the number of lookups running or waiting to run.
+        """
+        return sum(task.busy for task in self._tasks)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+import json
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from time import time
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash(latitude, longitude, precision=7):
+    """
+    Encodes a position as a geohash string.
+
+    Precision 7 is a cell of about 150 x 150 m, precision 8 about 38 x 19 m.
+    """
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    bit_count = 0
+    even = True
+    while len(chars) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = bits * 2 + 1
+                lon_range[0] = mid
+            else:
+                bits = bits * 2
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = bits * 2 + 1
+                lat_range[0] = mid
+            else:
+                bits = bits * 2
+                lat_range[1] = mid
+        even = not even
+        bit_count += 1
+        if bit_count == 5:
+            chars.append(GEOHASH_BASE32[bits])
+            bits = 0
+            bit_count = 0
+    return ''.join(chars)
+
+
+class GeoCache:
+    """
+    Two-tier cache of lookup results keyed by geohash cell: an in-memory LRU
+    in front of an SQLite table that survives restarts.
+
+    Args:
+        path (str): SQLite database file. Several caches can share one file.
+        name (str): Table name of this cache.
+        precision (int): Geohash precision of the cache key.
+        ttl (float): Seconds an entry stays valid.
+        max_entries (int): Max entries on disk, the least recently used are evicted.
+        memory_entries (int): Max entries in the in-memory LRU.
+    """
+
+    def __init__(self, path, name, precision=7, ttl=30 * 86400, max_entries=100000, memory_entries=1024):
+        self.name = name
+        self.precision = precision
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            f"CREATE TABLE IF NOT EXISTS {name} "
+            "(key TEXT PRIMARY KEY, value TEXT, stored REAL, accessed REAL)")
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {name}_accessed ON {name} (accessed)")
+        self._db.commit()
+
+    def key(self, latitude, longitude):
+        return geohash(latitude, longitude, self.precision)
+
+    def get(self, latitude, longitude):
+        """
+        Returns the cached value for the cell of a position, or None on a miss.
+        """
+        key = self.key(latitude, longitude)
+        now = time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+
+            row = self._db.execute(
+                f"SELECT value, stored FROM {self.name} WHERE key = ?", (key,)).fetchone()
+            if row is None or now - row[1] > self.ttl:
+                self.misses += 1
+                logging.debug(f"{self.name} cache miss {key}")
+                return None
+            self._db.execute(f"UPDATE {self.name} SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            value = json.loads(row[0])
+            self._remember(key, value, row[1])
+            self.disk_hits += 1
+            return value
+
+    def contains(self, latitude, longitude):
+        """
+        Checks if the cell of a position is cached without touching the counters.
+        """
+        key = self.key(latitude, longitude)
+        now = time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                return True
+            row = self._db.execute(
+                f"SELECT stored FROM {self.name} WHERE key = ?", (key,)).fetchone()
+            return row is not None and now - row[0] <= self.ttl
+
+    def put(self, latitude, longitude, value):
+        """
+        Stores a value for the cell of a position.
+        """
+        key = self.key(latitude, longitude)
+        now = time()
+        with self._lock:
+            self._remember(key, value, now)
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.name} (key, value, stored, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now))
+            self._puts += 1
+            if self._puts % 100 == 0:
+                self._evict(now)
+            self._db.commit()
+
+    def _remember(self, key, value, stored):
+        self._memory[key] = (value, stored)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, now):
+        self._db.execute(f"DELETE FROM {self.name} WHERE stored < ?", (now - self.ttl,))
+        count = self._db.execute(f"SELECT COUNT(*) FROM {self.name}").fetchone()[0]
+        if count > self.max_entries:
+            # Drop 10% extra so eviction does not run on every put
+            remove = count - int(self.max_entries * 0.9)
+            self._db.execute(
+                f"DELETE FROM {self.name} WHERE key IN "
+                f"(SELECT key FROM {self.name} ORDER BY accessed LIMIT ?)", (remove,))
+            self.evictions += remove
+            logging.info(f"{self.name} cache evicted {remove} entries")
+
+    def stats(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+
+from osm_extract import NodeStore, ROAD_TYPES, log_progress, read_osm, way_segments
+from segment_index import SegmentIndex, SegmentIndexWriter
+
+ROADS_FILE = 'roads.idx'
+PLACES_FILE = 'places.idx'
+POSTCODES_FILE = 'postcodes.idx'
+META_FILE = 'meta.json'
+
+CITY_PLACES = ('city', 'town', 'village', 'hamlet')
+SUBURB_PLACES = ('suburb', 'quarter', 'neighbourhood')
+
+
+class OfflineGeocoder:
+    """
+    Reverse geocoder backed by memory-mapped indexes built from an OSM extract.
+
+    Returns the same address keys as Nominatim: road, city, postcode, suburb
+    and country_code.
+
+    Args:
+        directory (str): Directory written by build().
+        road_radius (float): Max distance to the road in metres.
+        city_radius (float): Max distance to the city/town/village node in metres.
+        suburb_radius (float): Max distance to the suburb node in metres.
+        postcode_radius (float): Max distance to a postcode address in metres.
+    """
+
+    def __init__(self, directory, road_radius=50, city_radius=10000, suburb_radius=2000,
+                 postcode_radius=1000):
+        self.roads = SegmentIndex(os.path.join(directory, ROADS_FILE))
+        self.places = SegmentIndex(os.path.join(directory, PLACES_FILE))
+        self.postcodes = SegmentIndex(os.path.join(directory, POSTCODES_FILE))
+        with open(os.path.join(directory, META_FILE), 'r') as meta_file:
+            self.meta = json.load(meta_file)
+        self.road_radius = road_radius
+        self.city_radius = city_radius
+        self.suburb_radius = suburb_radius
+        self.postcode_radius = postcode_radius
+
+    def _nearest_place(self, latitude, longitude, radius, kinds):
+        for match in self.places.nearest(latitude, longitude, radius):
+            if match.segment.extra in kinds:
+                return match.segment.name
+        return None
+
+    def reverse(self, latitude, longitude):
+        """
+        Looks up the address of a point.
+
+        Returns:
+            dict: Address with Nominatim keys.
+            None: If the point is outside the extract.
+        """
+        address = {}
+        roads = self.roads.nearest(latitude, longitude, self.road_radius, limit=1)
+        if roads:
+            address['road'] = roads[0].segment.name
+            if roads[0].segment.extra:
+                address['postcode'] = roads[0].segment.extra
+        city = self._nearest_place(latitude, longitude, self.city_radius, CITY_PLACES)
+        if city:
+            address['city'] = city
+        suburb = self._nearest_place(latitude, longitude, self.suburb_radius, SUBURB_PLACES)
+        if suburb:
+            address['suburb'] = suburb
+        if 'postcode' not in address:
+            postcodes = self.postcodes.nearest(latitude, longitude, self.postcode_radius, limit=1)
+            if postcodes:
+                address['postcode'] = postcodes[0].segment.name
+        if not address:
+            return None
+        if self.meta.get('country_code'):
+            address['country_code'] = self.meta['country_code']
+        return address
+
+
+def build(extract, directory, country_code=''):
+    """
+    Builds the geocoder indexes from an OSM XML extract.
+
+    Args:
+        extract (str): Path of the .osm/.osm.bz2/.osm.gz extract.
+        directory (str): Output directory.
+        country_code (str): Country code of the extract, e.g. 'fi'.
+    """
+    os.makedirs(directory, exist_ok=True)
+    nodes = NodeStore()
+    roads = SegmentIndexWriter(cell_size=100)
+    places = SegmentIndexWriter(cell_size=2000)
+    postcodes = SegmentIndexWriter(cell_size=500)
+
+    for element in read_osm(extract):
+        if element[0] == 'node':
+            _, node_id, latitude, longitude, tags = element
+            nodes.add(node_id, latitude, longitude)
+            log_progress('node', len(nodes))
+            if tags.get('place') in CITY_PLACES + SUBURB_PLACES and tags.get('name'):
+                places.add_point(latitude, longitude, node_id, tags['name'], tags['place'])
+            if tags.get('addr:postcode'):
+                postcodes.add_point(latitude, longitude, node_id, tags['addr:postcode'])
+            continue
+
+        _, way_id, refs, tags = element
+        if tags.get('addr:postcode'):
+            position = nodes.get(refs[0]) if refs else None
+            if position:
+                postcodes.add_point(position[0], position[1], refs[0], tags['addr:postcode'])
+        if tags.get('highway') not in ROAD_TYPES:
+            continue
+        name = tags.get('name') or tags.get('ref')
+        if not name:
+            continue
+        for node1, lat1, lon1, node2, lat2, lon2 in way_segments(nodes, refs):
+            roads.add(lat1, lon1, lat2, lon2, way_id, node1, node2, name, tags.get('postal_code', ''))
+
+    roads.write(os.path.join(directory, ROADS_FILE))
+    places.write(os.path.join(directory, PLACES_FILE))
+    postcodes.write(os.path.join(directory, POSTCODES_FILE))
+    with open(os.path.join(directory, META_FILE), 'w') as meta_file:
+        json.dump({'extract': os.path.basename(extract), 'country_code': country_code}, meta_file)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Build the offline reverse geocoder from an OSM extract')
+    parser.add_argument('extract', help='OSM XML extract (.osm, .osm.bz2 or .osm.gz)')
+    parser.add_argument('directory', help='Output directory for the index files')
+    parser.add_argument('--country-code', default='', help='Country code of the extract, e.g. fi')
+    args = parser.parse_args()
+    build(args.extract, args.directory, args.country_code.lower())
@@ -4,8 +4,9 @@ import json
 import logging
 import os
 import random
+import threading
 
-from time import sleep, time
+from time import perf_counter, sleep, time
 
 import gpsd as _gpsd
 import paho.mqtt.client as mqtt
@@ -13,14 +14,31 @@ from geographiclib.geodesic import Geodesic
 from geopy.geocoders import Nominatim
 
 import helpers
+import http_client
+import metrics
+from batch import FixBatcher
+from enrichment import Enricher
+from geocache import GeoCache
+from geocoder import OfflineGeocoder
+from kalman import KalmanFilter
+from map_matcher import MapMatcher
+from gps_stream import GpsStream
+from payload import get_codec
+from prefetch import Prefetcher
+from profiler import SignalProfiler
+from road_weather import RoadWeather
+from rolling import BearingWindow, RollingWindow
+from spool import Spool
+from speed_limits import SpeedLimitIndex
+from triplog import TripLog
+from zm_overlay import ZmOverlay
 # TODO: cli option to enable hw reset switch
 # from gpiozero import Button
-from settings import (BEARING_BUFFER_SIZE, DEGREE_THRESHOLD,
-                      MQTT_RETRY_CONNECT, SPEED_BUFFER_SIZE, SPEED_THRESHOLD,
-                      STREET_THRESHOLD, TIME_THRESHOLD, _brokers, _mqtt_topic,
+from settings import (BATCH, BEARING_BUFFER_SIZE, DEGREE_THRESHOLD, ENRICHMENT_WORKERS,
+                      DISCOVERY, GEOCACHE, GEOCODER, GPS_STREAM, HTTP, KALMAN, MAP_MATCHER,
+                      METRICS, MQTT_RETRY_CONNECT, PAYLOAD, PREFETCH, PROFILER, ROAD_WEATHER, SPEED_BUFFER_SIZE, SPEED_LIMITS, SPEED_THRESHOLD,
+                      SPOOL, STREET_THRESHOLD, TIME_THRESHOLD, TRIPLOG, _brokers, _mqtt_topic,
                       _zm_api)
-if _zm_api['enabled']:
-    import telnetlib
 
 
 logging.basicConfig(
@@ -36,15 +54,59 @@ if 'DEBUG' in os.environ:
 class Status:
 
     def __init__(self):
-        user_agent = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz_') for _ in range(16))
-        logging.info(f"User agent {user_agent}")
-        self._geolocator = Nominatim(user_agent=user_agent)
+        http_client.configure(HTTP)
+
+        self._geocoder = None
+        if GEOCODER['index']:
+            self._geocoder = OfflineGeocoder(GEOCODER['index'])
+            logging.info(f"Offline geocoder loaded from {GEOCODER['index']}")
+
+        self._speed_limits = None
+        if SPEED_LIMITS['index']:
+            self._speed_limits = SpeedLimitIndex(SPEED_LIMITS['index'], SPEED_LIMITS['radius'])
+            logging.info(f"Speed limit index loaded from {SPEED_LIMITS['index']}")
+
+        self._map_matcher = None
+        if MAP_MATCHER['index']:
+            self._map_matcher = MapMatcher(MAP_MATCHER['index'], MAP_MATCHER['radius'], MAP_MATCHER['candidates'],
+                                           MAP_MATCHER['sigma'], MAP_MATCHER['beta'])
+            logging.info(f"Road graph loaded from {MAP_MATCHER['index']}")
+
+        self._address_cache = self._speed_limit_cache = None
+        if GEOCACHE['path']:
+            self._address_cache = GeoCache(GEOCACHE['path'], 'address',
+                                           memory_entries=GEOCACHE['memory_entries'], **GEOCACHE['address'])
+            self._speed_limit_cache = GeoCache(GEOCACHE['path'], 'speed_limit',
+                                               memory_entries=GEOCACHE['memory_entries'], **GEOCACHE['speed_limit'])
+
+        self._road_weather = None
+        if ROAD_WEATHER['enabled']:
+            self._road_weather = RoadWeather(ROAD_WEATHER['stations_path'], ROAD_WEATHER['ttl'],
+                                             ROAD_WEATHER['max_distance'], ROAD_WEATHER['candidates'],
+                                             ROAD_WEATHER['station_list_ttl'])
+
+        self._geolocator = None
+        if not self._geocoder or GEOCODER['nominatim_fallback']:
+            user_agent = ''.join(random.choice('abcdefghijklmnopqrstuvwxyz_') for _ in range(16))
+            logging.info(f"User agent {user_agent}")
+            self._geolocator = Nominatim(user_agent=user_agent)
 
         # Connect to gpsd
-        self.gpsd.connect()
+        self._gps_stream = None
+        if GPS_STREAM['enabled']:
+            self._gps_stream = GpsStream(GPS_STREAM['host'], GPS_STREAM['port'],
+                                         GPS_STREAM['decimation'], GPS_STREAM['min_interval'])
+        else:
+            self.gpsd.connect()
 
         # settings
         self._brokers = _brokers
+        if SPOOL['enabled']:
+            os.makedirs(SPOOL['directory'], exist_ok=True)
+            for broker in self._brokers:
+                broker['spool'] = Spool(os.path.join(SPOOL['directory'], f"{broker['host']}_{broker['port']}.spool"),
+                                        SPOOL['max_bytes'], SPOOL['slot_size'])
+                broker['replay_lock'] = threading.Lock()
         self._mqtt_topic = _mqtt_topic
 
         self._last_connect_fail = 0
@@ -52,71 +114,58 @@ class Status:
 
         self._zm_api = _zm_api
 
-        self._speed_buffer = []
-        self._bearing_buffer = []
+        self._speed_window = RollingWindow(SPEED_BUFFER_SIZE)
+        self._bearing_window = BearingWindow(BEARING_BUFFER_SIZE)
 
         self._data = {}
 
+        self._enricher = Enricher(self, ENRICHMENT_WORKERS)
+
+        self._prefetcher = None
+        if PREFETCH['enabled'] and GEOCACHE['path']:
+            self._prefetcher = Prefetcher(self, PREFETCH['horizon'], PREFETCH['min_horizon'],
+                                          PREFETCH['interval'], PREFETCH['budget'])
+
         if 'SIMGPS' in os.environ:
             self._mqtt_topic = f"test-{self._mqtt_topic}"
 
-        if (_zm_api['enabled']):
-            self.zm_connect()
+        self._kalman = None
+        if KALMAN['enabled']:
+            self._kalman = KalmanFilter(KALMAN['acceleration'], min_speed=KALMAN['min_speed'],
+                                        max_gap=KALMAN['max_gap'])
 
-    def zm_connect(self):
-        # Establish a Telnet connection
-        try:
-            logging.debug(
-                f"Connecting telnet {_zm_api['host']}:{_zm_api['port']}")
-            self._tn = telnetlib.Telnet(_zm_api['host'], _zm_api['port'])
-            logging.debug("Telnet connected!")
-        except Exception as e:
-            logging.error(
-                "Unable to connect zoneminder. Is zmtrigger running?")
-            self._tn = None
+        self._triplog = None
+        if TRIPLOG['enabled']:
+            self._triplog = TripLog(TRIPLOG['directory'], TRIPLOG['flush_interval'], TRIPLOG['fsync_interval'],
+                                    max_bytes=TRIPLOG['max_bytes'], compact_after=TRIPLOG['compact_after'],
+                                    compact_interval=TRIPLOG['compact_interval'])
+
+        self._batcher = None
+        if BATCH['enabled']:
+            self._batcher = FixBatcher(BATCH['max_fixes'], BATCH['max_delay'])
+
+        self._zm_overlay = None
+        if _zm_api['enabled']:
+            self._zm_overlay = ZmOverlay(_zm_api['host'], _zm_api['port'], _zm_api['monitors'])
 
     def update_buffers(self, speed, bearing):
-        self._speed_buffer.append(speed)
-        self._bearing_buffer.append(bearing)
+        self._speed_window.append(speed)
+        self._bearing_window.append(bearing)
         average_speed = -1
         bearing_difference = -1
 
-        if len(self._speed_buffer) > SPEED_BUFFER_SIZE:
-            self._speed_buffer.pop(0)
-            average_speed = sum(self._speed_buffer) / len(self._speed_buffer)
+        # Report only once the buffers have been filled, as before
+        if self._speed_window.count > SPEED_BUFFER_SIZE:
+            average_speed = self._speed_window.mean()
 
-        if len(self._bearing_buffer) > BEARING_BUFFER_SIZE:
-            self._bearing_buffer.pop(0)
-            bearing_difference = abs(
-                max(self._bearing_buffer) - min(self._bearing_buffer) )
+        if self._bearing_window.count > BEARING_BUFFER_SIZE:
+            bearing_difference = self._bearing_window.spread()
 
-            if bearing_difference > 180:
-                bearing_difference = 360 - bearing_difference
-
-        logging.debug(
-            f"speed: {self._speed_buffer} ({average_speed}), bearing: {self._bearing_buffer} ({bearing_difference})")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                f"speed: {self._speed_window.values()} ({average_speed}), bearing: {self._bearing_window.values()} ({bearing_difference})")
         return average_speed, bearing_difference
 
-
-    def update_zm(self, text, retry=True):
-        host = self._zm_api['host']
-        port = self._zm_api['port']
-
-        for m in self._zm_api['monitors']:
-            text = helpers.convert_umlaut_characters(text)
-            payload = f"{m}|show||||{text}".encode('utf-8')
-            # Send raw text
-            try:
-                # Sending as ASCII, adding carriage return and newline
-                self._tn.write(payload + b'\r\n')
-                logging.debug(f"Sent: {payload}")
-            except Exception as e:
-                logging.error(f"{e} Reconnecting")
-                if retry == True:
-                    self.zm_connect()
-                    self.update_zm(text, retry=False)
-                    logging.error(f"Unable to send {payload}")
-
     def calculate_bearing(self, lat1, lon1):
         # Calculate bearing based on difference to previous coordinates
         try:
@@ -135,16 +184,65 @@ class Status:
     def gpsd(self):
         return _gpsd
 
-    # Getter for 'tn' object
+    # Getter for 'gps_stream' object
+    @property
+    def gps_stream(self):
+        return self._gps_stream
+
+    @property
+    def kalman(self):
+        return self._kalman
+
+    @property
+    def triplog(self):
+        return self._triplog
+
+    @property
+    def batcher(self):
+        return self._batcher
+
     @property
-    def tn(self):
-        return self._tn
+    def zm_overlay(self):
+        return self._zm_overlay
 
     # Getter for 'geolocator' object
     @property
     def geolocator(self):
         return self._geolocator
 
+    # Getter for 'geocoder' object
+    @property
+    def geocoder(self):
+        return self._geocoder
+
+    @property
+    def enricher(self):
+        return self._enricher
+
+    @property
+    def prefetcher(self):
+        return self._prefetcher
+
+    @property
+    def map_matcher(self):
+        return self._map_matcher
+
+    @property
+    def speed_limits(self):
+        return self._speed_limits
+
+    @property
+    def road_weather(self):
+        return self._road_weather
+
+    @property
+    def address_cache(self):
+        return self._address_cache
+
+    @property
+    def speed_limit_cache(self):
+        return self._speed_limit_cache
+
     @property
     def brokers(self):
         # logging.debug(f"brokers: {self._brokers}")
@@ -184,13 +282,91 @@ class Status:
         self._data = contents
 
 
+stage_seconds = {stage: metrics.histogram('gps_stage_seconds', 'Seconds spent per pipeline stage', stage=stage)
+                 for stage in ('gpsd', 'map_matching', 'encode', 'publish')}
+fix_age = metrics.histogram('gps_fix_age_seconds', 'Seconds from the fix time to publish',
+                            (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+fixes_total = metrics.counter('gps_fixes', 'Reports with a 2D or 3D fix')
+no_fix_total = metrics.counter('gps_no_fix', 'Reports without a fix')
+metrics.gauge('mqtt_publish_in_flight', 'Published messages not yet acknowledged',
+              helpers.publish_tracker.in_flight)
+
+# Optional compact payload published in parallel to the JSON attributes
+encode_payload = get_codec(PAYLOAD['encoding'])[0] if PAYLOAD['encoding'] else None
+
+
+def read_packets(status):
+    # Stream every fix from gpsd as it arrives, or poll once a second
+    if status.gps_stream is None:
+        while True:
+            with metrics.timed(stage_seconds['gpsd']):
+                packet = status.gpsd.get_current()
+            yield packet
+            sleep(1)
+
+    while True:
+        try:
+            yield from status.gps_stream
+        except OSError as e:
+            logging.error(f"gpsd stream failed: {e}")
+            status.gps_stream.close()
+            sleep(1)
+
+
+def publish_fix(status, json_data, messages):
+    # Publish one fix to each MQTT broker
+    for brokers in status.brokers:
+        if status.last_connect_fail > 0 and time() - status.last_connect_fail > MQTT_RETRY_CONNECT:
+            status = helpers.retry_mqtt_connect(status)
+        logging.debug(f"Topic: {status.mqtt_topic}")
+        rc = mqtt.MQTT_ERR_SUCCESS
+        with metrics.timed(stage_seconds['publish']):
+            for topic, message in messages:
+                started = perf_counter()
+                info = brokers['client'].publish(topic, message)
+                helpers.publish_tracker.sent(brokers['client'], info.mid, started)
+                if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                    rc = info.rc
+        if brokers.get('spool'):
+            # paho drops QoS 0 messages while disconnected, keep them for the history topic.
+            # With batching the fixes are spooled by publish_batch
+            if rc != mqtt.MQTT_ERR_SUCCESS:
+                if not status.batcher:
+                    brokers['spool'].append(json_data.encode('utf-8'))
+            else:
+                helpers.start_replay(brokers, SPOOL['history_topic'], SPOOL['replay_batch'], SPOOL['replay_rate'])
+    return status
+
+
+def publish_batch(status, batch, fixes):
+    # Publish a columnar batch to each MQTT broker, spool its fixes for the brokers that fail
+    payload = json.dumps(batch, separators=(',', ':'))
+    for brokers in status.brokers:
+        info = brokers['client'].publish(BATCH['topic'], payload)
+        if info.rc == mqtt.MQTT_ERR_SUCCESS:
+            logging.debug(f"Batch of {len(batch['dt'])} fixes sent to {brokers['host']}:{brokers['port']}")
+        elif brokers.get('spool'):
+            for data in fixes:
+                brokers['spool'].append(json.dumps(data).encode('utf-8'))
+
+
+def publish_diagnostics(status):
+    # Metrics snapshot as JSON on the diagnostics topic
+    payload = json.dumps(metrics.REGISTRY.snapshot())
+    for brokers in status.brokers:
+        brokers['client'].publish(METRICS['diagnostics_topic'], payload)
+
 
 def main_loop(status):
+    helpers.birth_interval = DISCOVERY['birth_interval']
     status = helpers.connect_brokers(status)
-    speed_limit = 0
-    street = city = country = postcode = ''
     previous_speed = -1
     previous_time = None
+    previous_way_id = None
+    last_diagnostics = time()
+    metrics.gauge('enrichment_pending', 'Enrichment lookups running or waiting', status.enricher.pending)
+    metrics.gauge('batch_depth', 'Fixes waiting in the pending batch',
+                  lambda: len(status.batcher) if status.batcher else 0)
     '''
     # Define the GPIO pin number
     GPIO_PIN = 17
@@ -201,41 +377,62 @@ def main_loop(status):
     # Assign the button_pressed function to the Button object's `when_pressed` event
     button.when_pressed = button_pressed
     '''
-    while True:
-        try:
-            # Wait for new data to be received
-            packet = status.gpsd.get_current()
+    try:
+        for packet in read_packets(status):
             # Check if the data is valid
             if packet.mode >= 2:  # Valid data in 2D or 3D fix
+                fixes_total.inc()
                 if hasattr(packet, 'lat') and hasattr(packet, 'lon'):
                     # Get latitude, longitude, speed, and bearing
 
                     latitude = packet.lat
                     longitude = packet.lon
-                    speed = packet.hspeed * 3.6
+                    gps_time = packet.time
+                    if status.kalman:
+                        # Filtered speed and heading, steadier than the ones of single fixes
+                        state = status.kalman.update(helpers.parse_time(gps_time) or time(), latitude, longitude,
+                                                     packet.position_precision()[0])
+                        speed = state.speed
+                        bearing = state.heading
+                    else:
+                        speed = packet.hspeed * 3.6
+                        # We may have error. Calculate bearing.
+                        bearing = status.calculate_bearing(latitude, longitude)
                     if speed < SPEED_THRESHOLD:
                         speed = 0
-                    # We may have error. Calculate bearing.
-                    bearing = status.calculate_bearing(latitude, longitude)
-                    gps_time = packet.time
                     average_speed, bearing_difference = status.update_buffers(
                         speed, bearing)
 
-                    if ( (bearing_difference >= DEGREE_THRESHOLD and status.last_address_fetch - time() > BEARING_BUFFER_SIZE) or
+                    road = None
+                    if status.map_matcher:
+                        with metrics.timed(stage_seconds['map_matching']):
+                            road = status.map_matcher.update(latitude, longitude, packet.position_precision()[0])
+
+                    if road:
+                        # Enrich the matched way at the snapped position, once per way
+                        if road.way_id != previous_way_id or time() - status.last_address_fetch > STREET_THRESHOLD:
+                            status.enricher.request(road.latitude, road.longitude, bearing, road.way_id)
+                            previous_way_id = road.way_id
+                    elif ( (bearing_difference >= DEGREE_THRESHOLD and status.last_address_fetch - time() > BEARING_BUFFER_SIZE) or
                          (time() - status.last_address_fetch > STREET_THRESHOLD) or
                          (average_speed > 0 and (time() - previous_time >= TIME_THRESHOLD)) or
                          (average_speed < 0) ):
-                        address = helpers.perform_reverse_geocoding(
-                            status, latitude, longitude)
-                        logging.info(f"{address}")
-                        if address:
-                            street = address.get('road', '')
-                            city = address.get('city', '')
-                            postcode = address.get('postcode', '')
-                            country = address.get('country_code', '')
-                            suburb = address.get('suburb')
-                            status.last_address_fetch = time()
-                        speed_limit = helpers.get_speed_limit(latitude, longitude)
+                        status.enricher.request(latitude, longitude, bearing)
+                    if status.prefetcher:
+                        status.prefetcher.update(latitude, longitude, average_speed, bearing)
+
+                    # Merge the newest lookup results, they may be a few fixes old
+                    enrichment = status.enricher.latest()
+                    address = enrichment.get('address') or {}
+                    street = address.get('road', '')
+                    city = address.get('city', '')
+                    postcode = address.get('postcode', '')
+                    country = address.get('country_code', '')
+                    suburb = address.get('suburb')
+                    speed_limit = enrichment.get('speed_limit', 0)
+                    if road:
+                        street = road.name or street
+                        speed_limit = road.speed_limit or speed_limit
 
                     if hasattr(packet, 'alt') and hasattr(packet, 'climb'):
                         altitude = packet.alt
@@ -261,39 +458,87 @@ def main_loop(status):
                         'satellites': packet.sats,
                         'mqtt_fail': status.last_connect_fail,
                         'speed_limit': speed_limit,
-                        'room': 'car'
+                        'enrichment_age': enrichment['age'],
+                        'room': DISCOVERY['room']
                     }
+                    if road:
+                        status.data.update({'way_id': road.way_id, 'matched_latitude': road.latitude,
+                                            'matched_longitude': road.longitude})
+                    if enrichment.get('weather'):
+                        status.data.update(enrichment['weather'])
                     logging.info(f"{status.data}")
+                    if status.triplog:
+                        try:
+                            status.triplog.append(status.data)
+                        except OSError as e:
+                            logging.error(f"Error writing trip log: {e}")
                     # Convert the JSON object to a string
-                    json_data = json.dumps(status.data)
+                    with metrics.timed(stage_seconds['encode']):
+                        json_data = json.dumps(status.data)
+                        messages = []
+                        if PAYLOAD['json_attributes']:
+                            messages.append((status.mqtt_topic, json_data))
+                        if encode_payload:
+                            messages.append((PAYLOAD['binary_topic'], encode_payload(status.data)))
                     previous_time = time()
                     # Publish the JSON data to each MQTT broker
                     logging.debug(f"Brokers: {status.brokers}")
 
-                    if (status.zm_api['enabled'] and round(previous_speed) != round(average_speed)):
-                        status.update_zm(
+                    if status.zm_overlay and round(previous_speed) != round(average_speed):
+                        status.zm_overlay.show(
                             f"{str(round(speed)).rjust(3)} km/h {street} {postcode} {suburb} {city} {country}")
                         previous_speed = average_speed
 
-                    for brokers in status.brokers:
-                        if status.last_connect_fail > 0 and time() - status.last_connect_fail > MQTT_RETRY_CONNECT:
-                            status = helpers.retry_mqtt_connect(status)
-                        logging.debug(f"Topic: {status.mqtt_topic}")
-                        brokers['client'].publish(status.mqtt_topic, json_data)
+                    fix_time = helpers.parse_time(gps_time)
+                    if fix_time:
+                        fix_age.observe(time() - fix_time)
+                    if status.batcher:
+                        # Only the latest fix of each batch is published as the state
+                        batch = status.batcher.add(status.data)
+                        if batch:
+                            publish_batch(status, batch, status.batcher.flushed)
+                            status = publish_fix(status, json_data, messages)
+                    else:
+                        status = publish_fix(status, json_data, messages)
+
+                    if helpers.discovery_requested:
+                        helpers.publish_discovery_config(status, DISCOVERY['room'])
+
+                    if METRICS['diagnostics_interval'] and time() - last_diagnostics >= METRICS['diagnostics_interval']:
+                        publish_diagnostics(status)
+                        last_diagnostics = time()
 
                     if 'DEBUG' in os.environ:
                         helpers.output_display(status)
+                        if status.address_cache:
+                            logging.debug(f"Address cache: {status.address_cache.stats()}, "
+                                          f"speed limit cache: {status.speed_limit_cache.stats()}")
             else:
+                no_fix_total.inc()
                 logging.info(f"Waiting for valid data. ({packet.mode} < 2)")
-            sleep(1)
-        except KeyboardInterrupt:
-            # Exit the loop if Ctrl+C is pressed
-            break
-        # except Exception as e:
-        #    logging.error(f"Unhandled exception {e}")
-        #    sleep(1)
+                if status.batcher and status.batcher.due():
+                    publish_batch(status, status.batcher.flush(), status.batcher.flushed)
+    except KeyboardInterrupt:
+        # Exit the loop if Ctrl+C is pressed
+        pass
+    if status.batcher and len(status.batcher):
+        publish_batch(status, status.batcher.flush(), status.batcher.flushed)
+    status.enricher.shutdown()
+    if status.prefetcher:
+        status.prefetcher.close()
+    if status.zm_overlay:
+        status.zm_overlay.close()
+    if status.triplog:
+        status.triplog.close()
+    for broker in status.brokers:
+        if broker.get('spool'):
+            broker['spool'].close()
 
 
 if __name__ == '__main__':
+    if METRICS['enabled']:
+        metrics.start_http_server(METRICS['port'], METRICS['host'])
+    if PROFILER['enabled']:
+        SignalProfiler(PROFILER['directory'], PROFILER['duration'], PROFILER['interval']).install()
     status = Status()
     main_loop(status)
@@ -0,0 +1,136 @@
+import json
+import logging
+import socket
+import time
+
+import gpsd
+
+WATCH_COMMAND = b'?WATCH={"enable":true,"json":true};\n'
+
+
+class ReportAssembler:
+    """
+    Turns gpsd JSON report lines into gpsd.GpsResponse fixes.
+
+    The assembler does no I/O, so the blocking GpsStream and asyncio readers
+    can share it. SKY reports are remembered and merged into the next TPV.
+
+    Args:
+        decimation (int): Emit only every Nth TPV report.
+        min_interval (float): Minimum seconds between emitted fixes, 0 to disable.
+    """
+
+    def __init__(self, decimation=1, min_interval=0):
+        self.decimation = max(1, int(decimation))
+        self.min_interval = min_interval
+        self.sky = {}
+        self.reports = 0
+        self.emitted = 0
+        self._last_emit = 0
+
+    def feed(self, line):
+        """
+        Parses one report line.
+
+        Args:
+            line (str): A line received from gpsd.
+
+        Returns:
+            gpsd.GpsResponse: The fix built from a TPV report.
+            None: If the line is not a TPV report or was decimated away.
+        """
+        try:
+            report = json.loads(line)
+        except ValueError:
+            logging.debug(f"Ignoring malformed gpsd report: {line!r}")
+            return None
+        if not isinstance(report, dict):
+            return None
+
+        report_class = report.get('class')
+        if report_class == 'SKY':
+            # Newer gpsd versions also send SKY reports without the satellite list
+            if 'satellites' in report:
+                self.sky = report
+            return None
+        if report_class != 'TPV' or 'mode' not in report:
+            return None
+
+        self.reports += 1
+        if self.reports % self.decimation:
+            return None
+        now = time.monotonic()
+        if self.min_interval and now - self._last_emit < self.min_interval:
+            return None
+        self._last_emit = now
+        self.emitted += 1
+
+        try:
+            return gpsd.GpsResponse.from_json({'active': 1, 'tpv': [report], 'sky': [self.sky]})
+        except (KeyError, TypeError) as e:
+            logging.debug(f"Ignoring incomplete gpsd report {report}: {e}")
+            return None
+
+
+class GpsStream:
+    """
+    Reads fixes from the gpsd JSON watch stream as soon as they arrive.
+
+    Unlike gpsd.get_current(), every TPV report is delivered, so 5/10 Hz
+    receivers are not undersampled and there is no polling delay.
+
+    Args:
+        host (str): gpsd host.
+        port (int): gpsd port.
+        decimation (int): Emit only every Nth TPV report.
+        min_interval (float): Minimum seconds between emitted fixes.
+        timeout (float): Socket timeout in seconds.
+    """
+
+    def __init__(self, host='127.0.0.1', port=2947, decimation=1, min_interval=0, timeout=10):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.assembler = ReportAssembler(decimation, min_interval)
+        self._sock = None
+        self._stream = None
+
+    def connect(self):
+        """
+        Opens the gpsd socket and enables JSON watch mode.
+        """
+        self.close()
+        logging.info(f"Connecting to gpsd stream at {self.host}:{self.port}")
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._stream = self._sock.makefile('r', encoding='utf-8', errors='replace', newline='\n')
+        self._sock.sendall(WATCH_COMMAND)
+
+    def close(self):
+        """
+        Closes the gpsd socket if it is open.
+        """
+        for resource in (self._stream, self._sock):
+            if resource is not None:
+                try:
+                    resource.close()
+                except OSError:
+                    pass
+        self._sock = None
+        self._stream = None
+
+    def __iter__(self):
+        """
+        Yields gpsd.GpsResponse fixes until the connection fails.
+
+        Raises:
+            OSError: If the socket times out or gpsd closes the connection.
+        """
+        if self._stream is None:
+            self.connect()
+        while True:
+            line = self._stream.readline()
+            if not line:
+                raise ConnectionError(f"gpsd at {self.host}:{self.port} closed the connection")
+            packet = self.assembler.feed(line)
+            if packet is not None:
+                yield packet
@@ -1,16 +1,52 @@
 #!/usr/bin/env python3
+import hashlib
 import logging
+import threading
 from datetime import datetime
-from time import time
+from time import sleep, time
 
 import paho.mqtt.client as mqtt
 import requests
 import json
 
+import http_client
+from metrics import PublishTracker, counter, histogram, timed
+from speed_limits import parse_maxspeed
+
+connects = counter('mqtt_connects', 'Connections to MQTT brokers')
+disconnects = counter('mqtt_disconnects', 'Disconnections from MQTT brokers')
+reconnect_attempts = counter('mqtt_reconnect_attempts', 'Attempts to reconnect to MQTT brokers')
+discovery_published = counter('discovery_publishes', 'Home Assistant discovery configs published')
+discovery_skipped = counter('discovery_skipped', 'Discovery republishes skipped as unchanged or duplicate')
+publish_tracker = PublishTracker(histogram('mqtt_publish_ack_seconds', 'Seconds from publish to the on_publish callback'))
+
 # Function to perform reverse geocoding
 
 
+@timed(histogram('gps_stage_seconds', 'Seconds spent per pipeline stage', stage='reverse_geocoding'))
 def perform_reverse_geocoding(status, latitude, longitude):
+    if status.address_cache:
+        address = status.address_cache.get(latitude, longitude)
+        if address is not None:
+            return address
+    address = lookup_address(status, latitude, longitude)
+    if address and status.address_cache:
+        status.address_cache.put(latitude, longitude, address)
+    return address
+
+
+def lookup_address(status, latitude, longitude, prefetch=False):
+    # Prefer the offline index, use Nominatim as fallback if it is enabled
+    if status.geocoder:
+        address = status.geocoder.reverse(latitude, longitude)
+        if address:
+            return address
+        logging.debug(f"No offline address for {latitude}, {longitude}")
+    if not status.geolocator:
+        return None
+    if status.prefetcher and not prefetch:
+        # Nominatim allows one request per second, shared with the prefetcher
+        sleep(status.prefetcher.reserve('address'))
     location = status.geolocator.reverse((latitude, longitude))
     if location:
         address = location.raw.get('address', {})
@@ -19,9 +55,31 @@ def perform_reverse_geocoding(status, latitude, longitude):
     return None
 
 
-def get_speed_limit(latitude, longitude):
+@timed(histogram('gps_stage_seconds', 'Seconds spent per pipeline stage', stage='speed_limit'))
+def get_speed_limit(status, latitude, longitude, bearing=None):
+    if status.speed_limits:
+        return status.speed_limits.lookup(latitude, longitude, bearing)
+    if status.speed_limit_cache:
+        speed_limit = status.speed_limit_cache.get(latitude, longitude)
+        if speed_limit is not None:
+            return speed_limit
+    if status.prefetcher:
+        sleep(status.prefetcher.reserve('speed_limit'))
+    speed_limit = fetch_speed_limit(latitude, longitude)
+    if speed_limit is None:
+        return 0
+    if status.speed_limit_cache:
+        status.speed_limit_cache.put(latitude, longitude, speed_limit)
+    return speed_limit
+
+
+def fetch_speed_limit(latitude, longitude):
     url = f"https://overpass-api.de/api/interpreter?data=[out:json];way[maxspeed](around:30,{latitude},{longitude});out;"
-    response = requests.get(url)
+    try:
+        response = http_client.service('overpass').get(url)
+    except requests.RequestException as e:
+        logging.error(f"Error fetching speed limit: {e}")
+        return None
     logging.debug(f"{response}")
     if response.status_code == 200:
         json_data = response.json()
@@ -30,59 +88,25 @@ def get_speed_limit(latitude, longitude):
         speed_limit = 0
         for element in elements:
             tags = element.get('tags', {})
-            maxspeed = tags.get('maxspeed')
+            maxspeed = parse_maxspeed(tags.get('maxspeed'))
             if maxspeed:
                 speed_limit = maxspeed
                 break
         return speed_limit
     else:
-        return 0
-
-
-def convert_umlaut_characters(text):
-    conversion_table = {
-        'Å': 'A', 'Ä': 'A', 'Ö': 'O', 'Ü': 'U',
-        'å': 'a', 'ä': 'a', 'ö': 'o', 'ü': 'u'
-    }
-    return ''.join(conversion_table.get(char, char) for char in text)
-
+        return None
 
-def update_zm(status, text, retry=True):
-    host = status.zm_api['host']
-    port = status.zm_api['port']
 
-    i = 0
-    for m in status.zm_api['monitors']:
-        text = convert_umlaut_characters(text)
-        payload = f"{m[i]}|show||||{text}".encode('utf-8')
-        # Send raw text
-        try:
-            # Sending as ASCII, adding carriage return and newline
-            status.tn.write(payload + b'\r\n')
-            logging.debug(f"Sent: {payload}")
-        except Exception as e:
-            logging.error(f"{e} Reconnecting")
-            if retry == True:
-                status.zm_connect()
-                update_zm(status, text, retry=False)
-                logging.error(f"Unable to send {payload}")
-
-        i += 1
-
-    return status
-
-def publish_discovery_config(room, found_data):
-    """Publish discovery configuration to Home Assistant.
+def discovery_configs(state_topic, room):
+    """Build the retained discovery configuration of the sensors.
 
     Args:
+        state_topic (str): Topic the sensors read their values from.
         room (str): The room identifier.
-        found_data (tuple): Tuple containing room identifier and sensor data.
 
     Returns:
-        None
+        dict: Discovery topic to serialized config.
     """
-    jdata = found_data[1]
-
     sendvals = {
         "latitude": {"class": None, "unit": "°"},
         "longitude": {"class": None, "unit": "°"},
@@ -92,23 +116,23 @@ def publish_discovery_config(room, found_data):
         "bearing": {"class": None, "unit": "°"},
         "gps_accuracy": {"class": None, "unit": "m"},
         "street": {"class": None, "unit": None},
-        "postcode}": {"class": None, "unit": None},
+        "postcode": {"class": None, "unit": None},
         "suburb": {"class": None, "unit": None},
         "city": {"class": None, "unit": None},
         "country": {"class": None, "unit": None},
         "time": {"class": None, "unit": None},
         "satellites": {"class": None, "unit": None},
         "mqtt_fail": {"class": None, "unit": None},
-        "speed_limit": {"class": None, "unit": None},
+        "speed_limit": {"class": None, "unit": "km/h"},
         "room": {"class": None, "unit": None}
     }
 
+    configs = {}
     for s in sendvals:
         payload = {
-            "state_topic": f"home/{room}",
-            "unit_of_measurement": f"{sendvals[s]['unit']}",
+            "state_topic": state_topic,
             "value_template": "{{ value_json." + s + " }}",
-            "unique_id": f"car-gps-0",
+            "unique_id": f"car-gps-{room}-{s}",
             "object_id": f"{room}_{s}",
             "name": f"{s}",
             "device": {
@@ -120,44 +144,136 @@ def publish_discovery_config(room, found_data):
                 "model": "GPS"
             }
         }
+        if sendvals[s]['unit'] is not None:
+            payload.update({"unit_of_measurement": sendvals[s]['unit']})
         if sendvals[s]['class'] is not None:
             payload.update({"device_class": f"{sendvals[s]['class']}"})
-        topic = f"homeassistant/sensor/{room}_{s}/config"
-        my_data = json.dumps(payload).replace("'", '"')
-        logging.info(f"{topic}: {my_data}")
-        for b in brokers:
-            clients[b].publish(topic, my_data)
+        configs[f"homeassistant/sensor/{room}_{s}/config"] = json.dumps(payload, sort_keys=True)
+    return configs
+
+
+def publish_discovery_config(status, room):
+    """Publish retained discovery configuration of the sensors to Home Assistant.
+
+    Each broker remembers the hash of the configs it retains, so a reconnect
+    publishes only the configs that changed. A Home Assistant birth message
+    republishes all of them to the broker it came from.
+
+    Args:
+        status (Status): Tracker status holding the brokers and the topic.
+        room (str): The room identifier.
+
+    Returns:
+        None
+    """
+    global discovery_requested
+    discovery_requested = False
+
+    configs = discovery_configs(status.mqtt_topic, room)
+    for broker in status.brokers:
+        if not broker.get('discovery_requested') or not broker['connected'] or not broker['client']:
+            continue
+        broker['discovery_requested'] = False
+        retained = broker.setdefault('discovery', {})
+        if broker.pop('discovery_birth', False):
+            retained.clear()
+        published = 0
+        for topic, my_data in configs.items():
+            digest = hashlib.sha1(my_data.encode('utf-8')).hexdigest()
+            if retained.get(topic) == digest:
+                discovery_skipped.inc()
+                continue
+            logging.debug(f"{topic}: {my_data}")
+            info = broker['client'].publish(topic, my_data, retain=True)
+            if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                retained[topic] = digest
+                discovery_published.inc()
+                published += 1
+        if published:
+            logging.info(f"Published discovery configuration of {published} sensors to "
+                         f"{broker['host']}:{broker['port']}")
+
+
+# Set on connect and when Home Assistant comes online, the main loop publishes
+# the discovery once for all requests since the previous fix. The callbacks get
+# the broker as userdata and flag it.
+discovery_requested = False
+# Birth messages of a broker within this many seconds of the previous one are ignored
+birth_interval = 10
+
 
 def on_message(client, userdata, msg):
-    global found_ruuvis
+    global discovery_requested
     payload = msg.payload.decode()
     logging.info(f"Received message on topic {msg.topic}: {payload}")
     if payload == "online":
-        found_ruuvis = []
+        if time() - userdata.get('discovery_birth_time', 0) < birth_interval:
+            discovery_skipped.inc()
+            return
+        userdata['discovery_birth_time'] = time()
+        userdata['discovery_birth'] = True
+        userdata['discovery_requested'] = True
+        discovery_requested = True
 
 def on_connect(client, userdata, flags, rc):
     logging.info(f"Connected, returned code {rc}")
     if rc == 0:
         logging.info(f"Connected OK Returned code {rc}")
+        connects.inc()
+        global discovery_requested
+        userdata['discovery_requested'] = True
+        discovery_requested = True
     else:
         logging.error(f"Bad connection Returned code {rc}")
     client.subscribe("homeassistant/status")
 
 def on_publish(client, userdata, mid):
     logging.debug(f"Message published {mid}")
+    publish_tracker.acked(client, mid)
 
 
 def on_disconnect(client, userdata, rc):
+    disconnects.inc()
     if rc != 0:
         logging.error("Unexpected MQTT disconnection.")
 
 
+def replay_spool(broker, topic, batch_size=20, rate=10):
+    # Publish the fixes spooled during an outage, oldest first and rate limited,
+    # while the broker stays connected
+    spool = broker['spool']
+    if not broker['replay_lock'].acquire(blocking=False):
+        return
+    try:
+        logging.info(f"Replaying {len(spool)} spooled fixes to {broker['host']}:{broker['port']}")
+        while broker['client'].is_connected() and len(spool):
+            until, messages = spool.peek(batch_size)
+            info = broker['client'].publish(topic, b'[' + b','.join(messages) + b']', qos=1)
+            info.wait_for_publish(10)
+            if not info.is_published():
+                logging.warning(f"Spool replay to {broker['host']}:{broker['port']} interrupted")
+                break
+            spool.pop(until)
+            sleep(1 / rate)
+    except Exception as e:
+        logging.error(f"Error replaying spool to {broker['host']}:{broker['port']}: {e}")
+    finally:
+        broker['replay_lock'].release()
+
+
+def start_replay(broker, topic, batch_size=20, rate=10):
+    # Replay the spool of a connected broker on a background thread
+    if len(broker['spool']) and not broker['replay_lock'].locked() and broker['client'].is_connected():
+        threading.Thread(target=replay_spool, args=(broker, topic, batch_size, rate), daemon=True).start()
+
+
 def retry_mqtt_connect(status):
     conn_ok = True
     b = 0
     for broker in status.brokers:
         try:
             if not broker['connected']:
+                reconnect_attempts.inc()
                 status.brokers[b]['client'].connect(
                     broker['host'], port=broker['port'])
                 status.brokers[b]['client'].loop_start()
@@ -186,10 +302,11 @@ def connect_brokers(status):
     b = 0
     for broker in status.brokers:
         try:
-            status.brokers[b]['client'] = mqtt.Client()
+            status.brokers[b]['client'] = mqtt.Client(userdata=broker)
             status.brokers[b]['client'].on_connect = on_connect
             status.brokers[b]['client'].on_publish = on_publish
             status.brokers[b]['client'].on_message = on_message
+            status.brokers[b]['client'].on_disconnect = on_disconnect
             status.brokers[b]['client'].connect_async(
                 broker['host'], port=broker['port'])
             status.brokers[b]['client'].loop_start()
@@ -225,6 +342,14 @@ def decimal_to_dms(decimal_degrees, unit='°'):
     return f"{degrees}{unit}{minutes}'{seconds}\""
 
 
+def parse_time(value):
+    # gpsd ISO 8601 time to seconds since epoch, None if it is not valid
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+
 def get_time():
     now = datetime.now()
     current_time = now.strftime("%H:%M:%S")
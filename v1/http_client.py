@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+import logging
+import random
+import threading
+from collections import OrderedDict
+from time import monotonic, perf_counter, sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import counter, gauge, histogram
+
+USER_AGENT = 'gps2mqtt'
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Defaults per service, override them with configure()
+DEFAULTS = {
+    'timeout': (3.05, 10),  # connect, read seconds
+    'retries': 2,
+    'backoff': 0.5,  # seconds before the first retry, doubled for each retry
+    'budget': 20,  # max seconds of a call including retries
+    'failure_threshold': 5,
+    'cool_off': 60,
+    'pool_size': 4,
+    'headers': {}
+}
+
+_config = {}
+_services = {}
+_lock = threading.Lock()
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised instead of calling a service whose circuit is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calling a failing service. After failure_threshold failures in a
+    row the circuit opens and calls fail right away for cool_off seconds.
+    Then one trial call is let through: success closes the circuit, failure
+    opens it again.
+
+    Args:
+        failure_threshold (int): Failures in a row that open the circuit.
+        cool_off (float): Seconds the circuit stays open.
+    """
+
+    def __init__(self, failure_threshold=5, cool_off=60):
+        self.failure_threshold = failure_threshold
+        self.cool_off = cool_off
+        self.failures = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self):
+        return self._opened is not None
+
+    def allow(self):
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or monotonic() - self._opened < self.cool_off:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        """
+        Returns:
+            bool: True if this failure opened the circuit.
+        """
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self._opened is not None:
+                self._opened = monotonic()
+                return False
+            if self.failures >= self.failure_threshold:
+                self._opened = monotonic()
+                return True
+            return False
+
+
+class Service:
+    """
+    HTTP client of one web service. Requests share a keep-alive session, so
+    the TCP and TLS handshakes are paid once instead of on every lookup.
+    Connection errors, timeouts and HTTP 429 and 5xx are retried with
+    exponential backoff within the time budget, and count as failures of the
+    circuit breaker.
+
+    With conditional=True the validators and body of the last 200 response
+    per URL are kept, the request is sent with If-None-Match and
+    If-Modified-Since and a 304 response returns the kept response.
+
+    Args:
+        name (str): Service name in logs and metrics.
+        timeout (float or tuple): Request timeout, or (connect, read) timeouts in seconds.
+        retries (int): Retries after the first attempt.
+        backoff (float): Seconds before the first retry.
+        budget (float): Max seconds of a call including retries.
+        failure_threshold (int): Failed calls in a row that open the circuit.
+        cool_off (float): Seconds calls are rejected while the circuit is open.
+        pool_size (int): Kept connections per host.
+        headers (dict): Headers sent with every request.
+    """
+
+    def __init__(self, name, timeout=(3.05, 10), retries=2, backoff=0.5, budget=20, failure_threshold=5,
+                 cool_off=60, pool_size=4, headers=None):
+        self.name = name
+        self.timeout = tuple(timeout) if isinstance(timeout, list) else timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget
+        self.breaker = CircuitBreaker(failure_threshold, cool_off)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['User-Agent'] = USER_AGENT
+        self.session.headers.update(headers or {})
+        self._validated = OrderedDict()  # url: response with validators
+        self._validated_lock = threading.Lock()
+
+        self._seconds = histogram('http_request_seconds', 'Seconds per HTTP request attempt', service=name)
+        self._results = {result: counter('http_requests', 'HTTP calls by result', service=name, result=result)
+                         for result in ('ok', 'not_modified', 'error', 'rejected')}
+        self._retried = counter('http_retries', 'Retried HTTP requests', service=name)
+        gauge('http_circuit_open', 'Whether calls to the service are rejected',
+              lambda: int(self.breaker.open), service=name)
+
+    def get(self, url, params=None, headers=None, conditional=False):
+        """
+        Sends a GET request.
+
+        Returns:
+            requests.Response: The response. Statuses other than 429 and 5xx
+            are returned without retrying, check status_code.
+
+        Raises:
+            CircuitOpenError: The circuit is open.
+            requests.RequestException: All attempts failed.
+        """
+        if not self.breaker.allow():
+            self._results['rejected'].inc()
+            raise CircuitOpenError(f"{self.name} circuit is open after {self.breaker.failures} failures")
+        headers = dict(headers or {})
+        validated = self._validated.get(url) if conditional else None
+        if validated is not None:
+            if validated.headers.get('ETag'):
+                headers['If-None-Match'] = validated.headers['ETag']
+            if validated.headers.get('Last-Modified'):
+                headers['If-Modified-Since'] = validated.headers['Last-Modified']
+
+        deadline = monotonic() + self.budget
+        delay = self.backoff
+        attempt = 0
+        while True:
+            started = perf_counter()
+            try:
+                response = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+                error = None
+            except requests.RequestException as e:
+                response = None
+                error = e
+            self._seconds.observe(perf_counter() - started)
+
+            if response is not None and response.status_code not in RETRY_STATUSES:
+                break
+            attempt += 1
+            retry_after = self._retry_after(response)
+            wait = max(delay, retry_after) * random.uniform(1.0, 1.25)
+            if attempt > self.retries or monotonic() + wait >= deadline:
+                break
+            logging.debug(f"{self.name}: retrying in {wait:.1f} s after "
+                          f"{error or f'HTTP {response.status_code}'}")
+            self._retried.inc()
+            sleep(wait)
+            delay *= 2
+
+        if error is not None or response.status_code in RETRY_STATUSES:
+            self._results['error'].inc()
+            if self.breaker.failure():
+                logging.error(f"{self.name}: {self.breaker.failures} failures, not called for "
+                              f"{self.breaker.cool_off} s")
+            if error is not None:
+                raise error
+            return response
+
+        self.breaker.success()
+        if response.status_code == 304 and validated is not None:
+            self._results['not_modified'].inc()
+            return validated
+        self._results['ok'].inc()
+        if conditional and response.status_code == 200 and (
+                response.headers.get('ETag') or response.headers.get('Last-Modified')):
+            with self._validated_lock:
+                self._validated[url] = response
+                self._validated.move_to_end(url)
+                if len(self._validated) > 256:
+                    self._validated.popitem(last=False)
+        return response
+
+    @staticmethod
+    def _retry_after(response):
+        if response is None:
+            return 0
+        try:
+            return min(float(response.headers.get('Retry-After', 0)), 60)
+        except ValueError:
+            return 0  # An HTTP date, use the backoff
+
+
+def configure(services):
+    """
+    Sets options of services by name, e.g. {'overpass': {'timeout': [3.05, 15]}}.
+    Call before the services are used.
+    """
+    with _lock:
+        for name, options in services.items():
+            _config[name] = dict(options)
+            _services.pop(name, None)
+
+
+def service(name):
+    """
+    Returns the shared client of a service, created on first use with its
+    configured options.
+    """
+    with _lock:
+        client = _services.get(name)
+        if client is None:
+            client = _services[name] = Service(name, **dict(DEFAULTS, **_config.get(name, {})))
+        return client
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+import logging
+import math
+from collections import OrderedDict, namedtuple
+
+from osm_extract import NodeStore, ROAD_TYPES, log_progress, read_osm, way_segments
+from segment_index import ONEWAY, SegmentIndex, SegmentIndexWriter, project, segment_bearing, snap
+from speed_limits import parse_maxspeed
+
+Road = namedtuple('Road', 'way_id latitude longitude distance name speed_limit oneway bearing')
+
+UNREACHABLE = -math.inf
+
+
+def segment_length(segment):
+    return math.hypot(*project(segment.lat2, segment.lon2, segment.lat1, segment.lon1))
+
+
+def distance(lat1, lon1, lat2, lon2):
+    return math.hypot(*project(lat2, lon2, lat1, lon1))
+
+
+class MapMatcher:
+    """
+    Online map matcher. Fixes are matched to the road graph with a hidden
+    Markov model: the states are the road segments within radius of a fix,
+    a state is more likely the closer the fix is to it, and a transition is
+    more likely the closer the driving distance along the graph is to the
+    straight distance between the fixes. Viterbi keeps the most likely path
+    ending in each candidate, so a fix drifting to a parallel road or across
+    an intersection does not switch the match unless the following fixes
+    confirm it.
+
+    The newest fix is matched without waiting for the next ones, so the
+    match is the most likely one given the fixes so far.
+
+    Args:
+        path (str): Road graph built with build().
+        radius (float): Max distance in metres from a fix to a candidate segment.
+        candidates (int): Max candidate segments per fix.
+        sigma (float): Standard deviation of the GPS error in metres.
+        beta (float): Metres of detour that make a transition e times less likely.
+        cache_size (int): Decoded segments kept in memory.
+    """
+
+    def __init__(self, path, radius=50, candidates=8, sigma=10, beta=10, cache_size=4096):
+        self.index = SegmentIndex(path)
+        self.radius = radius
+        self.candidates = candidates
+        self.sigma = sigma
+        self.beta = beta
+        self.cache_size = cache_size
+        self.breaks = 0
+        self._segments = OrderedDict()  # number: (segment, length)
+        self._previous = None  # (latitude, longitude, {number: match})
+        self._scores = {}  # number: log probability of the best path ending in it
+
+    def segment(self, number):
+        entry = self._segments.get(number)
+        if entry is None:
+            segment = self.index.segment(number)
+            entry = self._segments[number] = (segment, segment_length(segment))
+            if len(self._segments) > self.cache_size:
+                self._segments.popitem(last=False)
+        else:
+            self._segments.move_to_end(number)
+        return entry
+
+    def _candidates(self, latitude, longitude):
+        matches = {}
+        for number in self.index.candidates(latitude, longitude, self.radius):
+            match = snap(self.segment(number)[0], latitude, longitude)
+            if match.distance <= self.radius:
+                matches[number] = match
+        if len(matches) > self.candidates:
+            matches = dict(sorted(matches.items(), key=lambda item: item[1].distance)[:self.candidates])
+        return matches
+
+    def _graph(self, latitude, longitude, reach):
+        # Directed node graph of the segments within reach metres
+        graph = {}
+        for number in self.index.candidates(latitude, longitude, reach):
+            segment, length = self.segment(number)
+            if segment.node1 == segment.node2:
+                continue
+            graph.setdefault(segment.node1, []).append((segment.node2, length))
+            if not segment.flags & ONEWAY:
+                graph.setdefault(segment.node2, []).append((segment.node1, length))
+        return graph
+
+    @staticmethod
+    def _shortest(graph, sources, limit):
+        # Dijkstra from {node: initial distance}, up to limit metres
+        distances = {}
+        heap = [(cost, node) for node, cost in sources.items()]
+        heapq.heapify(heap)
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if node in distances:
+                continue
+            distances[node] = cost
+            for neighbour, length in graph.get(node, ()):
+                total = cost + length
+                if total <= limit and neighbour not in distances:
+                    heapq.heappush(heap, (total, neighbour))
+        return distances
+
+    def _route_distance(self, graph, start, end, limit):
+        # Driving distance from one snapped point to another, None if not reachable
+        segment1, length1 = self.segment(start[0])
+        segment2, length2 = self.segment(end[0])
+        fraction1 = start[1].fraction
+        fraction2 = end[1].fraction
+        if start[0] == end[0]:
+            if fraction2 >= fraction1 or not segment1.flags & ONEWAY:
+                return abs(fraction2 - fraction1) * length1
+            # Slightly backwards on a one way street is GPS noise
+            backwards = (fraction1 - fraction2) * length1
+            return backwards if backwards <= self.sigma else None
+        sources = {segment1.node2: (1 - fraction1) * length1}
+        if not segment1.flags & ONEWAY:
+            sources[segment1.node1] = fraction1 * length1
+        if start[1].fraction in (0.0, 1.0):
+            # Snapped to an end node, the route can start there in any direction
+            node = segment1.node1 if fraction1 == 0.0 else segment1.node2
+            sources[node] = 0.0
+        distances = self._shortest(graph, sources, limit)
+        best = None
+        if segment2.node1 in distances:
+            best = distances[segment2.node1] + fraction2 * length2
+        if not segment2.flags & ONEWAY and segment2.node2 in distances:
+            total = distances[segment2.node2] + (1 - fraction2) * length2
+            best = total if best is None else min(best, total)
+        return best
+
+    def update(self, latitude, longitude, accuracy=None):
+        """
+        Matches a fix.
+
+        Args:
+            accuracy (float): Estimated error of the fix in metres, if known.
+
+        Returns:
+            Road: The matched road and the fix snapped to it, None if no road is within radius.
+        """
+        matches = self._candidates(latitude, longitude)
+        if not matches:
+            self._previous = None
+            self._scores = {}
+            return None
+        sigma = max(self.sigma, accuracy or 0)
+        emissions = {number: -0.5 * (match.distance / sigma) ** 2 for number, match in matches.items()}
+
+        scores = {}
+        if self._previous is not None:
+            previous_latitude, previous_longitude, previous_matches = self._previous
+            straight = distance(previous_latitude, previous_longitude, latitude, longitude)
+            limit = 2 * straight + 2 * self.radius
+            graph = self._graph((previous_latitude + latitude) / 2, (previous_longitude + longitude) / 2,
+                                straight / 2 + 2 * self.radius)
+            for number, match in matches.items():
+                best = UNREACHABLE
+                for previous, previous_match in previous_matches.items():
+                    route = self._route_distance(graph, (previous, previous_match), (number, match), limit)
+                    if route is None:
+                        continue
+                    score = self._scores[previous] - abs(route - straight) / self.beta
+                    best = max(best, score)
+                if best > UNREACHABLE:
+                    scores[number] = best + emissions[number]
+        if not scores:
+            # First fix, or no candidate is reachable from the previous ones
+            if self._previous is not None:
+                self.breaks += 1
+                logging.debug(f"Map matching restarted at {latitude}, {longitude}")
+            scores = emissions
+        # Keep the scores small, only their differences matter
+        top = max(scores.values())
+        self._scores = {number: score - top for number, score in scores.items()}
+        # Candidates not reachable from the previous fix have no score and end no path
+        self._previous = (latitude, longitude, {number: matches[number] for number in self._scores})
+
+        number = max(self._scores, key=self._scores.get)
+        match = matches[number]
+        segment = match.segment
+        return Road(segment.way_id, match.latitude, match.longitude, round(match.distance, 1), segment.name,
+                    int(segment.value), bool(segment.flags & ONEWAY), round(segment_bearing(segment)))
+
+    def close(self):
+        self.index.close()
+
+
+def build(extract, path):
+    """
+    Builds the road graph from the drivable ways of an OSM XML extract. Ways
+    without a name keep their ref, speed limits are 0 where maxspeed is missing.
+    """
+    nodes = NodeStore()
+    index = SegmentIndexWriter(cell_size=100)
+    for element in read_osm(extract):
+        if element[0] == 'node':
+            nodes.add(element[1], element[2], element[3])
+            log_progress('node', len(nodes))
+            continue
+        _, way_id, refs, tags = element
+        if tags.get('highway') not in ROAD_TYPES:
+            continue
+        flags = 0
+        oneway = tags.get('oneway')
+        if oneway in ('yes', 'true', '1') or tags.get('junction') == 'roundabout' or tags['highway'] == 'motorway':
+            flags |= ONEWAY
+        elif oneway == '-1':
+            flags |= ONEWAY
+            refs = refs[::-1]
+        speed_limit = parse_maxspeed(tags.get('maxspeed')) or 0
+        for node1, lat1, lon1, node2, lat2, lon2 in way_segments(nodes, refs):
+            index.add(lat1, lon1, lat2, lon2, way_id, node1, node2,
+                      tags.get('name') or tags.get('ref', ''), tags.get('maxspeed', ''), speed_limit, flags)
+    index.write(path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Build the road graph for map matching from an OSM extract')
+    parser.add_argument('extract', help='OSM XML extract (.osm, .osm.bz2 or .osm.gz)')
+    parser.add_argument('index', help='Output index file')
+    args = parser.parse_args()
+    build(args.extract, args.index)
@@ -0,0 +1,357 @@
+import bisect
+import functools
+import logging
+import math
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Seconds, from a dictionary lookup to a slow web service
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in items) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    """
+    Monotonically increasing count.
+    """
+
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(f"{name}_total{_format_labels(labels)}", self.value)]
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """
+    Value that goes up and down, or is read from a function when collected.
+
+    Args:
+        function (callable): Returns the current value, e.g. a queue length.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, function=None):
+        self.value = 0
+        self.function = function
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def get(self):
+        if self.function is None:
+            return self.value
+        try:
+            return self.function()
+        except Exception as e:
+            logging.debug(f"Error reading gauge: {e}")
+            return math.nan
+
+    def samples(self, name, labels):
+        return [(f"{name}{_format_labels(labels)}", self.get())]
+
+    def snapshot(self):
+        return self.get()
+
+
+class Histogram:
+    """
+    Counts of observed values in fixed buckets, with their sum.
+
+    Args:
+        buckets (tuple): Increasing upper bounds of the buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q):
+        """
+        Estimates a quantile by linear interpolation within its bucket, NaN if empty.
+        """
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return math.nan
+        rank = q * count
+        cumulative = 0
+        for index, bucket_count in enumerate(counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.buckets[-1]
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bucket, bucket_count in zip(self.buckets + (math.inf,), counts):
+            cumulative += bucket_count
+            samples.append((f"{name}_bucket{_format_labels(labels, ('le', _format_value(bucket)))}", cumulative))
+        samples.append((f"{name}_sum{_format_labels(labels)}", total))
+        samples.append((f"{name}_count{_format_labels(labels)}", count))
+        return samples
+
+    def snapshot(self):
+        p50 = self.quantile(0.5)
+        p99 = self.quantile(0.99)
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'p50': None if math.isnan(p50) else round(p50, 6),
+                'p99': None if math.isnan(p99) else round(p99, 6)}
+
+
+class Registry:
+    """
+    Metrics by name and labels. Metrics are created on first use, so modules
+    can declare them at import time without coordination.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # name: (kind, help, {labels: metric})
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, labels, *args):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            kind, _, family = self._metrics.setdefault(name, (cls.kind, help_text, {}))
+            if kind != cls.kind:
+                raise ValueError(f"Metric {name} is a {kind}, not a {cls.kind}")
+            if key not in family:
+                family[key] = cls(*args)
+            return family[key]
+
+    def counter(self, name, help_text, **labels):
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name, help_text, function=None, **labels):
+        gauge = self._get(Gauge, name, help_text, labels)
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS, **labels):
+        return self._get(Histogram, name, help_text, labels, buckets)
+
+    def exposition(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            metrics = [(name, kind, help_text, list(family.items()))
+                       for name, (kind, help_text, family) in sorted(self._metrics.items())]
+        for name, kind, help_text, family in metrics:
+            exposed = f"{name}_total" if kind == 'counter' else name
+            lines.append(f"# HELP {exposed} {help_text}")
+            lines.append(f"# TYPE {exposed} {kind}")
+            for labels, metric in family:
+                for sample, value in metric.samples(name, labels):
+                    lines.append(f"{sample} {_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """
+        Returns all metrics as a JSON serializable dictionary, histograms as
+        count, sum and estimated p50/p99.
+        """
+        snapshot = {}
+        with self._lock:
+            metrics = [(name, list(family.items())) for name, (_, _, family) in self._metrics.items()]
+        for name, family in metrics:
+            for labels, metric in family:
+                key = name + ''.join(f".{value}" for _, value in labels)
+                value = metric.snapshot()
+                snapshot[key] = None if isinstance(value, float) and math.isnan(value) else value
+        return snapshot
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help_text, **labels):
+    return REGISTRY.counter(name, help_text, **labels)
+
+
+def gauge(name, help_text, function=None, **labels):
+    return REGISTRY.gauge(name, help_text, function, **labels)
+
+
+def histogram(name, help_text, buckets=DEFAULT_BUCKETS, **labels):
+    return REGISTRY.histogram(name, help_text, buckets, **labels)
+
+
+class timed:
+    """
+    Observes the seconds spent in a block or function in a histogram:
+
+        with timed(encode_seconds):
+            ...
+
+        @timed(lookup_seconds)
+        def lookup(...):
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self._started)
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.histogram.observe(time.perf_counter() - started)
+        return wrapper
+
+
+class PublishTracker:
+    """
+    Measures the time from an MQTT publish to its on_publish callback and the
+    number of messages in flight. The callback can run before publish()
+    returns the mid, so acknowledgements of unknown mids are kept until sent()
+    is called for them.
+
+    Args:
+        latency (Histogram): Histogram of the acknowledgement latency.
+        max_pending (int): Max tracked messages, the oldest are forgotten.
+    """
+
+    def __init__(self, latency, max_pending=10000):
+        self.latency = latency
+        self.max_pending = max_pending
+        self._pending = {}  # (client id, mid): publish time
+        self._acked = {}  # (client id, mid): acknowledgement time
+        self._lock = threading.Lock()
+
+    def sent(self, client, mid, started):
+        """
+        Records a publish.
+
+        Args:
+            client: The client that published.
+            mid (int): Message id returned by publish().
+            started (float): time.perf_counter() before the publish() call.
+        """
+        key = (id(client), mid)
+        with self._lock:
+            acked = self._acked.pop(key, None)
+            if acked is None:
+                if len(self._pending) >= self.max_pending:
+                    self._pending.pop(next(iter(self._pending)))
+                self._pending[key] = started
+                return
+        self.latency.observe(acked - started)
+
+    def acked(self, client, mid):
+        """
+        Records an on_publish callback.
+        """
+        now = time.perf_counter()
+        key = (id(client), mid)
+        with self._lock:
+            started = self._pending.pop(key, None)
+            if started is None:
+                if len(self._acked) >= self.max_pending:
+                    self._acked.pop(next(iter(self._acked)))
+                self._acked[key] = now
+                return
+        self.latency.observe(now - started)
+
+    def in_flight(self):
+        return len(self._pending)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.registry.exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(f"Metrics request from {self.client_address[0]}: {format % args}")
+
+
+def start_http_server(port, host='0.0.0.0', registry=REGISTRY):
+    """
+    Serves the metrics in the Prometheus text format at /metrics on a
+    background thread.
+
+    Returns:
+        ThreadingHTTPServer: The server, call shutdown() to stop it.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logging.info(f"Metrics served at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+import bz2
+import gzip
+import logging
+import xml.etree.ElementTree as ET
+from array import array
+from bisect import bisect_left
+
+from segment_index import COORD_SCALE
+
+# Highway types a car can drive on
+ROAD_TYPES = {
+    'motorway', 'motorway_link', 'trunk', 'trunk_link', 'primary', 'primary_link',
+    'secondary', 'secondary_link', 'tertiary', 'tertiary_link', 'unclassified',
+    'residential', 'living_street', 'service', 'road'
+}
+
+
+def open_extract(path):
+    if path.endswith('.pbf'):
+        raise ValueError(
+            f"{path}: PBF is not supported, convert it first: osmium cat {path} -o extract.osm.bz2")
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def read_osm(path):
+    """
+    Reads an OSM XML extract (.osm, .osm.bz2 or .osm.gz) element by element.
+
+    Yields:
+        tuple: ('node', id, lat, lon, tags) or ('way', id, node_refs, tags)
+    """
+    with open_extract(path) as f:
+        context = ET.iterparse(f, events=('start', 'end'))
+        _, root = next(context)
+        for event, elem in context:
+            if event != 'end':
+                continue
+            if elem.tag == 'node':
+                tags = {t.get('k'): t.get('v') for t in elem.iter('tag')}
+                yield 'node', int(elem.get('id')), float(elem.get('lat')), float(elem.get('lon')), tags
+            elif elem.tag == 'way':
+                refs = [int(nd.get('ref')) for nd in elem.iter('nd')]
+                tags = {t.get('k'): t.get('v') for t in elem.iter('tag')}
+                yield 'way', int(elem.get('id')), refs, tags
+            elif elem.tag != 'relation':
+                continue
+            root.clear()
+
+
+class NodeStore:
+    """
+    Compact node coordinate store. OSM extracts list nodes sorted by id, so
+    coordinates are kept in flat arrays and found with a binary search.
+    """
+
+    def __init__(self):
+        self._ids = array('q')
+        self._lats = array('i')
+        self._lons = array('i')
+
+    def __len__(self):
+        return len(self._ids)
+
+    def add(self, node_id, latitude, longitude):
+        if self._ids and node_id <= self._ids[-1]:
+            raise ValueError(f"Nodes are not sorted by id at node {node_id}")
+        self._ids.append(node_id)
+        self._lats.append(round(latitude * COORD_SCALE))
+        self._lons.append(round(longitude * COORD_SCALE))
+
+    def get(self, node_id):
+        i = bisect_left(self._ids, node_id)
+        if i == len(self._ids) or self._ids[i] != node_id:
+            return None
+        return self._lats[i] / COORD_SCALE, self._lons[i] / COORD_SCALE
+
+
+def way_segments(nodes, refs):
+    """
+    Yields (node1, lat1, lon1, node2, lat2, lon2) for consecutive way nodes.
+    Nodes missing from the extract split the way.
+    """
+    previous = None
+    for ref in refs:
+        position = nodes.get(ref)
+        if position is None:
+            previous = None
+            continue
+        if previous is not None:
+            yield previous[0], previous[1], previous[2], ref, position[0], position[1]
+        previous = (ref, position[0], position[1])
+
+
+def log_progress(kind, count):
+    if count % 1000000 == 0:
+        logging.info(f"{count} {kind}s read")
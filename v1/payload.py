@@ -0,0 +1,176 @@
+import json
+import math
+import struct
+import timeit
+from datetime import datetime, timezone
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+STRUCT_VERSION = 1
+# version, latitude, longitude, altitude, climb, speed, bearing, gps_accuracy,
+# time (seconds since epoch), satellites, sats_valid
+STRUCT_LAYOUT = struct.Struct('<BddfffffdBB')
+STRUCT_FIELDS = ('latitude', 'longitude', 'altitude', 'climb', 'speed', 'bearing', 'gps_accuracy')
+
+
+def parse_time(value):
+    """
+    Converts a gpsd ISO 8601 time string to seconds since epoch, NaN if it
+    is missing or not valid.
+    """
+    if not value:
+        return math.nan
+    try:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return math.nan
+
+
+def format_time(seconds):
+    """
+    Converts seconds since epoch to a gpsd style ISO 8601 time string.
+    """
+    if math.isnan(seconds):
+        return ''
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+
+def fix_from_packet(packet, host):
+    """
+    Converts a gpsd.GpsResponse with at least a 2D fix to the fix dictionary
+    published on the attributes topic.
+    """
+    return {
+        'latitude': packet.lat,
+        'longitude': packet.lon,
+        'altitude': packet.alt,
+        'climb': packet.climb,
+        'speed': packet.hspeed * 3.6,  # Convert m/s to km/h
+        'bearing': packet.track,
+        'time': packet.time,
+        'satellites': packet.sats,
+        'sats_valid': packet.sats_valid,
+        'gps_accuracy': packet.position_precision()[0],
+        'host': host
+    }
+
+
+def _number(value):
+    return math.nan if value is None else float(value)
+
+
+def encode_json(data):
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def decode_json(payload):
+    return json.loads(payload)
+
+
+def encode_struct(data):
+    """
+    Packs a fix into the fixed binary layout. Fields outside the layout, such
+    as host, are not included.
+    """
+    return STRUCT_LAYOUT.pack(STRUCT_VERSION,
+                              *(_number(data.get(field)) for field in STRUCT_FIELDS),
+                              parse_time(data.get('time')),
+                              min(255, data.get('satellites') or 0),
+                              min(255, data.get('sats_valid') or 0))
+
+
+def decode_struct(payload):
+    if payload[0] != STRUCT_VERSION:
+        raise ValueError(f"Unsupported payload version {payload[0]}")
+    values = STRUCT_LAYOUT.unpack(payload)
+    data = dict(zip(STRUCT_FIELDS, values[1:8]))
+    data['time'] = format_time(values[8])
+    data['satellites'] = values[9]
+    data['sats_valid'] = values[10]
+    return data
+
+
+def encode_cbor(data):
+    return cbor2.dumps(data)
+
+
+def decode_cbor(payload):
+    return cbor2.loads(payload)
+
+
+def encode_msgpack(data):
+    return msgpack.packb(data)
+
+
+def decode_msgpack(payload):
+    return msgpack.unpackb(payload)
+
+
+OPTIONAL_PACKAGES = {'cbor': 'cbor2', 'msgpack': 'msgpack'}
+
+ENCODINGS = {
+    'json': (encode_json, decode_json),
+    'struct': (encode_struct, decode_struct),
+    'cbor': (encode_cbor, decode_cbor),
+    'msgpack': (encode_msgpack, decode_msgpack)
+}
+
+
+def available_encodings():
+    """
+    Returns the names of the encodings whose libraries are installed.
+    """
+    installed = {'cbor': cbor2 is not None, 'msgpack': msgpack is not None}
+    return [name for name in ENCODINGS if installed.get(name, True)]
+
+
+def get_codec(name):
+    """
+    Returns the (encode, decode) functions of an encoding.
+
+    Raises:
+        ValueError: If the encoding is unknown or its library is not installed.
+    """
+    if name not in ENCODINGS:
+        raise ValueError(f"Unknown payload encoding '{name}', choose one of {list(ENCODINGS)}")
+    if name not in available_encodings():
+        raise ValueError(f"Payload encoding '{name}' needs the {OPTIONAL_PACKAGES[name]} package")
+    return ENCODINGS[name]
+
+
+def compare(data, number=10000):
+    """
+    Measures payload size and encode/decode time of each available encoding.
+
+    Returns:
+        dict: Results by encoding name.
+    """
+    results = {}
+    for name in available_encodings():
+        encode, decode = ENCODINGS[name]
+        payload = encode(data)
+        results[name] = {
+            'bytes': len(payload),
+            'encode_us': round(timeit.timeit(lambda: encode(data), number=number) / number * 1e6, 2),
+            'decode_us': round(timeit.timeit(lambda: decode(payload), number=number) / number * 1e6, 2)
+        }
+    return results
+
+
+if __name__ == "__main__":
+    sample = {
+        'latitude': 65.01236, 'longitude': 25.46816, 'altitude': 15.2, 'climb': 0.1,
+        'speed': 52.3, 'bearing': 181.4, 'time': '2024-06-01T12:00:00.000Z',
+        'satellites': 12, 'sats_valid': 9, 'gps_accuracy': 3.4, 'host': 'gps-car'
+    }
+    print(f"{'encoding':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, result in compare(sample).items():
+        print(f"{name:<10}{result['bytes']:>8}{result['encode_us']:>12}{result['decode_us']:>12}")
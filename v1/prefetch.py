@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+import logging
+import math
+import threading
+from collections import deque
+from time import monotonic, time
+
+import helpers
+from metrics import counter
+
+EARTH_RADIUS = 6371000  # metres
+
+
+def destination(latitude, longitude, bearing, distance):
+    """
+    Returns the position distance metres from a position towards bearing
+    (degrees) on a spherical earth.
+    """
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    angle = distance / EARTH_RADIUS
+    theta = math.radians(bearing)
+    lat2 = math.asin(math.sin(lat) * math.cos(angle) + math.cos(lat) * math.sin(angle) * math.cos(theta))
+    lon2 = lon + math.atan2(math.sin(theta) * math.sin(angle) * math.cos(lat),
+                            math.cos(angle) - math.sin(lat) * math.sin(lat2))
+    return math.degrees(lat2), (math.degrees(lon2) + 540) % 360 - 180
+
+
+def cell_size(precision, latitude):
+    """
+    Returns the smaller side in metres of a geohash cell of precision at a latitude.
+    """
+    bits = 5 * precision
+    height = 180 / 2 ** (bits // 2) * 111320
+    width = 360 / 2 ** (bits - bits // 2) * 111320 * math.cos(math.radians(latitude))
+    return min(height, width)
+
+
+class RequestBudget:
+    """
+    Allows at most rate requests per period seconds, and no two requests
+    closer than min_interval seconds. Thread safe, so requests made outside
+    the prefetcher can be counted with reserve().
+    """
+
+    def __init__(self, rate, period=60, min_interval=1):
+        self.rate = rate
+        self.period = period
+        self.min_interval = min_interval
+        self._sent = deque()
+        self._lock = threading.Lock()
+
+    def _wait_time(self, now):
+        while self._sent and now - self._sent[0] >= self.period:
+            self._sent.popleft()
+        wait = 0
+        if self._sent:
+            wait = self.min_interval - (now - self._sent[-1])
+        if len(self._sent) >= self.rate:
+            wait = max(wait, self.period - (now - self._sent[0]))
+        return max(wait, 0)
+
+    def wait_time(self):
+        """
+        Returns seconds until the next request is allowed, 0 if it is allowed now.
+        """
+        with self._lock:
+            return self._wait_time(monotonic())
+
+    def try_spend(self):
+        """
+        Counts a request if it is allowed now.
+
+        Returns:
+            bool: True if the request may be made.
+        """
+        with self._lock:
+            now = monotonic()
+            if self._wait_time(now):
+                return False
+            self._sent.append(now)
+            return True
+
+    def reserve(self):
+        """
+        Counts a request that is made regardless of the rate, min_interval
+        after the previous one.
+
+        Returns:
+            float: Seconds to wait before making the request.
+        """
+        with self._lock:
+            now = monotonic()
+            start = max(now, self._sent[-1] + self.min_interval) if self._sent else now
+            self._sent.append(start)
+            return start - now
+
+
+class Prefetcher:
+    """
+    Warms the address and speed limit caches along the projected path. The
+    path is dead reckoned from the averaged speed and bearing for horizon
+    seconds. Cells that are not cached are looked up on a background thread,
+    nearest first, at most budget lookups per minute per service. A new
+    projection replaces the previous one, so after a turn the old path is
+    dropped. Lookups of the main loop are counted with reserve(), so both
+    together stay within the rate limits of the services.
+
+    Args:
+        status (Status): Tracker status holding the caches.
+        horizon (float): Seconds of travel to project.
+        min_horizon (float): Seconds of travel skipped, the regular lookups cover them.
+        interval (float): Min seconds between projections.
+        budget (int): Max prefetch lookups per minute per service.
+        retry_after (float): Seconds before a cell whose lookup failed is tried again.
+    """
+
+    def __init__(self, status, horizon=120, min_horizon=0, interval=5, budget=20, retry_after=300):
+        self.horizon = horizon
+        self.min_horizon = min_horizon
+        self.interval = interval
+        self.retry_after = retry_after
+        self._lanes = []  # (name, cache, lookup, budget)
+        if status.address_cache and status.geolocator:
+            self._lanes.append(('address', status.address_cache,
+                                lambda latitude, longitude: helpers.lookup_address(status, latitude, longitude,
+                                                                                   prefetch=True),
+                                RequestBudget(budget)))
+        if status.speed_limit_cache and not status.speed_limits:
+            self._lanes.append(('speed_limit', status.speed_limit_cache, helpers.fetch_speed_limit,
+                                RequestBudget(budget)))
+        self._attempted = {}  # (lane, cell): time
+        self._position = None
+        self._projected = 0
+        self._queue = []  # (distance, lane index, cell, latitude, longitude)
+        self._closed = False
+        self._condition = threading.Condition()
+        self._lookups = {name: counter('prefetch_lookups', 'Cache cells looked up ahead of arrival', cache=name)
+                         for name, _, _, _ in self._lanes}
+        self._thread = None
+        if self._lanes:
+            self._thread = threading.Thread(target=self._run, name='prefetch', daemon=True)
+            self._thread.start()
+
+    def update(self, latitude, longitude, speed, bearing):
+        """
+        Sets the current position, speed (km/h) and bearing. Returns immediately.
+        """
+        if speed <= 0 or not self._lanes:
+            return
+        with self._condition:
+            self._position = (latitude, longitude, speed / 3.6, bearing)
+            self._condition.notify()
+
+    def reserve(self, name):
+        """
+        Counts a lookup of the main loop against the budget of a service,
+        'address' or 'speed_limit'.
+
+        Returns:
+            float: Seconds to wait before the lookup, so it is min_interval
+            from the previous lookup of the service.
+        """
+        for lane, _, _, budget in self._lanes:
+            if lane == name:
+                return budget.reserve()
+        return 0
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        if self._thread:
+            self._thread.join(1)
+
+    def project(self, latitude, longitude, speed, bearing):
+        """
+        Returns the cells to look up along the projected path, nearest first.
+
+        Args:
+            speed (float): Speed in m/s.
+
+        Returns:
+            list: (distance, lane index, cell, latitude, longitude) tuples.
+        """
+        now = time()
+        cells = []
+        for index, (name, cache, _, _) in enumerate(self._lanes):
+            # Half a cell between points, so no cell on the path is skipped
+            step = cell_size(cache.precision, latitude) / 2
+            seen = set()
+            distance = speed * self.min_horizon
+            while distance <= speed * self.horizon:
+                point = destination(latitude, longitude, bearing, distance)
+                cell = cache.key(*point)
+                if cell not in seen:
+                    seen.add(cell)
+                    attempted = self._attempted.get((index, cell))
+                    if (attempted is None or now - attempted > self.retry_after) and not cache.contains(*point):
+                        cells.append((distance, index, cell) + point)
+                distance += step
+        cells.sort()
+        return cells
+
+    def _next_wait(self):
+        # Seconds until a queued cell can be looked up, None if nothing is queued
+        lanes = {item[1] for item in self._queue}
+        if not lanes:
+            return None
+        return min(self._lanes[index][3].wait_time() for index in lanes)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    position = None
+                    if self._position and monotonic() - self._projected >= self.interval:
+                        position = self._position
+                        self._position = None
+                        break
+                    wait = self._next_wait()
+                    if wait == 0:
+                        break
+                    if self._position:
+                        until_projection = self.interval - (monotonic() - self._projected)
+                        wait = until_projection if wait is None else min(wait, until_projection)
+                    self._condition.wait(wait)
+            if position:
+                self._projected = monotonic()
+                self._queue = self.project(*position)
+                logging.debug(f"Prefetching {len(self._queue)} cells")
+            self._lookup_next()
+
+    def _lookup_next(self):
+        # Looks up the nearest cell whose service has budget left
+        for n, (distance, index, cell, latitude, longitude) in enumerate(self._queue):
+            name, cache, lookup, budget = self._lanes[index]
+            if not budget.try_spend():
+                continue
+            del self._queue[n]
+            self._attempted[(index, cell)] = time()
+            if len(self._attempted) > 10000:
+                expired = time() - self.retry_after
+                self._attempted = {key: value for key, value in self._attempted.items() if value > expired}
+            try:
+                value = lookup(latitude, longitude)
+            except Exception as e:
+                logging.error(f"Prefetching {name} of {cell} failed: {e}")
+                return
+            self._lookups[name].inc()
+            if value is not None:
+                cache.put(latitude, longitude, value)
+                logging.debug(f"Prefetched {name} of {cell} {distance:.0f} m ahead")
+            return
@@ -0,0 +1,133 @@
+import cProfile
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def _frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SignalProfiler:
+    """
+    Profiles the running process on demand. The first signal starts a
+    sampling profiler over all threads and cProfile on the main thread; after
+    duration seconds, or on the next signal, both are written to directory:
+
+    - profile-<time>.collapsed: sampled stacks per thread in the collapsed
+      format of flamegraph.pl and speedscope
+    - profile-<time>.prof: cProfile statistics of the main thread, for pstats
+      or snakeviz
+
+    Signal handlers run on the main thread, so cProfile is enabled and
+    disabled there. A timer sends the signal again to stop.
+
+    Args:
+        directory (str): Directory of the profile files.
+        duration (float): Seconds to profile.
+        interval (float): Seconds between stack samples.
+    """
+
+    def __init__(self, directory='profiles', duration=30, interval=0.01):
+        self.directory = directory
+        self.duration = duration
+        self.interval = interval
+        self.signum = None
+        self._profile = None
+        self._sampler = None
+        self._stop = threading.Event()
+        self._timer = None
+        self._stacks = Counter()
+        self._samples = 0
+        self._started = 0
+
+    def install(self, signum=signal.SIGUSR1):
+        """
+        Toggles profiling on signum. Must be called from the main thread.
+        """
+        self.signum = signum
+        signal.signal(signum, self._handle)
+        logging.info(f"Send signal {signal.Signals(signum).name} to process {os.getpid()} to profile "
+                     f"for {self.duration} s")
+
+    def _handle(self, signum, frame):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    @property
+    def running(self):
+        return self._profile is not None
+
+    def start(self):
+        """
+        Starts profiling. Call on the main thread.
+        """
+        if self.running:
+            return
+        logging.info(f"Profiling for {self.duration} s")
+        self._stacks = Counter()
+        self._samples = 0
+        self._started = time.time()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._sampler.start()
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+        if self.signum is not None:
+            self._timer = threading.Timer(self.duration, os.kill, (os.getpid(), self.signum))
+            self._timer.name = 'profiler-timer'
+            self._timer.daemon = True
+            self._timer.start()
+
+    def stop(self):
+        """
+        Stops profiling and writes the profile files. Call on the main thread.
+
+        Returns:
+            str: Path of the files without the extension, None if not profiling.
+        """
+        if not self.running:
+            return None
+        self._profile.disable()
+        profile = self._profile
+        self._profile = None
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._stop.set()
+        self._sampler.join()
+
+        os.makedirs(self.directory, exist_ok=True)
+        base = os.path.join(self.directory, f"profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self._started))}")
+        try:
+            profile.dump_stats(f"{base}.prof")
+            with open(f"{base}.collapsed", 'w') as f:
+                for stack, count in self._stacks.most_common():
+                    f.write(f"{stack} {count}\n")
+        except OSError as e:
+            logging.error(f"Error writing profile {base}: {e}")
+            return None
+        logging.info(f"Profile of {time.time() - self._started:.1f} s, {self._samples} samples "
+                     f"written to {base}.collapsed and {base}.prof")
+        return base
+
+    def _sample(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self._stacks[';'.join(reversed(stack))] += 1
+            self._samples += 1
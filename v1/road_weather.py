@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+import argparse
+import heapq
+import json
+import logging
+import math
+import os
+from time import time
+
+import requests
+
+import http_client
+
+STATIONS_URL = "https://tie.digitraffic.fi/api/weather/v1/stations"
+STATION_DATA_URL = "https://tie.digitraffic.fi/api/weather/v1/stations/{station_id}/data"
+HEADERS = {'Digitraffic-User': 'gps2mqtt'}
+EARTH_RADIUS = 6371000  # metres
+# Digitraffic sensor name to fix field
+SENSORS = {
+    'ILMA': 'temperature',
+    'ILMAN_KOSTEUS': 'humidity',
+    'TIE_1': 'road_temperature'
+}
+
+
+def ecef(latitude, longitude):
+    """
+    Converts a position to earth centred x, y, z in metres on a spherical earth.
+    Straight line distances between these points grow monotonically with the
+    great circle distance, unlike distances in raw degrees.
+    """
+    lat = math.radians(latitude)
+    lon = math.radians(longitude)
+    return (EARTH_RADIUS * math.cos(lat) * math.cos(lon),
+            EARTH_RADIUS * math.cos(lat) * math.sin(lon),
+            EARTH_RADIUS * math.sin(lat))
+
+
+def chord_to_distance(chord):
+    """
+    Converts a straight line distance between two ECEF points to metres along the surface.
+    """
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, chord / (2 * EARTH_RADIUS)))
+
+
+class KDTree:
+    """
+    Static 3-d tree for nearest neighbour queries.
+
+    Args:
+        points (list): (x, y, z) tuples. Items are returned as their index in this list.
+    """
+
+    def __init__(self, points):
+        self._root = self._build([(point, n) for n, point in enumerate(points)], 0)
+
+    def _build(self, entries, depth):
+        if not entries:
+            return None
+        axis = depth % 3
+        entries.sort(key=lambda entry: entry[0][axis])
+        median = len(entries) // 2
+        point, index = entries[median]
+        return (point, index, axis,
+                self._build(entries[:median], depth + 1), self._build(entries[median + 1:], depth + 1))
+
+    def nearest(self, point, k=1):
+        """
+        Finds the k nearest points.
+
+        Returns:
+            list: (distance, index) pairs, nearest first.
+        """
+        heap = []  # (-squared distance, index), the farthest of the k nearest on top
+
+        def search(node):
+            if node is None:
+                return
+            node_point, index, axis, left, right = node
+            squared = ((point[0] - node_point[0]) ** 2 + (point[1] - node_point[1]) ** 2
+                       + (point[2] - node_point[2]) ** 2)
+            if len(heap) < k:
+                heapq.heappush(heap, (-squared, index))
+            elif squared < -heap[0][0]:
+                heapq.heapreplace(heap, (-squared, index))
+            difference = point[axis] - node_point[axis]
+            near, far = (left, right) if difference < 0 else (right, left)
+            search(near)
+            if len(heap) < k or difference * difference < -heap[0][0]:
+                search(far)
+
+        search(self._root)
+        return sorted((math.sqrt(-squared), index) for squared, index in heap)
+
+
+class StationList:
+    """
+    Digitraffic road weather station list cached on disk. The cached list is
+    used right away and refreshed with a conditional request when it is older
+    than max_age, so an unchanged list is not downloaded again.
+
+    Args:
+        path (str): Cache file.
+        max_age (float): Seconds before the list is checked for changes.
+    """
+
+    def __init__(self, path, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+        self.stations = []  # (id, latitude, longitude, name)
+        self.tree = None
+        self._etag = None
+        self._last_modified = None
+        self._fetched = 0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+        self._etag = cached.get('etag')
+        self._last_modified = cached.get('last_modified')
+        self._fetched = cached.get('fetched', 0)
+        self._set_stations([tuple(station) for station in cached.get('stations', [])])
+
+    def _save(self):
+        temporary = f"{self.path}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump({'etag': self._etag, 'last_modified': self._last_modified, 'fetched': self._fetched,
+                       'stations': self.stations}, f)
+        os.replace(temporary, self.path)
+
+    def _set_stations(self, stations):
+        self.stations = stations
+        self.tree = KDTree([ecef(latitude, longitude) for _, latitude, longitude, _ in stations]) if stations else None
+
+    def refresh(self):
+        """
+        Downloads the station list if it is older than max_age and has changed.
+        On failure the cached list stays in use.
+        """
+        if time() - self._fetched < self.max_age:
+            return
+        headers = dict(HEADERS)
+        if self.tree and self._etag:
+            headers['If-None-Match'] = self._etag
+        if self.tree and self._last_modified:
+            headers['If-Modified-Since'] = self._last_modified
+        try:
+            response = http_client.service('digitraffic').get(STATIONS_URL, headers=headers)
+        except requests.RequestException as e:
+            logging.error(f"Error fetching road weather stations: {e}")
+            self._fetched = time() - self.max_age + 300  # Retry in 5 minutes
+            return
+        if response.status_code == 304:
+            logging.debug("Road weather station list not modified")
+        elif response.status_code == 200:
+            stations = []
+            for feature in response.json().get('features', []):
+                coordinates = feature['geometry']['coordinates']
+                properties = feature.get('properties', {})
+                stations.append((properties['id'], coordinates[1], coordinates[0], properties.get('name', '')))
+            self._set_stations(stations)
+            self._etag = response.headers.get('ETag')
+            self._last_modified = response.headers.get('Last-Modified')
+            logging.info(f"Road weather station list updated, {len(stations)} stations")
+        else:
+            logging.error(f"Error fetching road weather stations: HTTP {response.status_code}")
+            self._fetched = time() - self.max_age + 300
+            return
+        self._fetched = time()
+        try:
+            self._save()
+        except OSError as e:
+            logging.error(f"Error saving road weather stations to {self.path}: {e}")
+
+    def nearest(self, latitude, longitude, k=1):
+        """
+        Returns up to k (distance in metres, station) pairs, nearest first.
+        """
+        if not self.tree:
+            return []
+        return [(chord_to_distance(chord), self.stations[index])
+                for chord, index in self.tree.nearest(ecef(latitude, longitude), k)]
+
+
+class RoadWeather:
+    """
+    Air and road temperature and humidity from the nearest road weather
+    station. Sensor values are cached per station for ttl seconds, so calling
+    lookup() for every fix costs a tree search and a dictionary lookup.
+    Expired values are fetched again with a conditional request.
+
+    Args:
+        path (str): Station list cache file.
+        ttl (float): Seconds the sensor values of a station are reused.
+        max_distance (float): Max distance in metres to a station.
+        candidates (int): Nearest stations tried if the nearest lacks a sensor.
+        station_list_ttl (float): Seconds before the station list is checked for changes.
+    """
+
+    def __init__(self, path, ttl=300, max_distance=30000, candidates=3, station_list_ttl=86400):
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.candidates = candidates
+        self.stations = StationList(path, station_list_ttl)
+        self.hits = 0
+        self.misses = 0
+        self._observations = {}  # station id: (fetched, values)
+
+    def observations(self, station_id):
+        """
+        Returns the sensor values of a station by fix field, from the cache if fresh.
+        """
+        cached = self._observations.get(station_id)
+        if cached and time() - cached[0] < self.ttl:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        try:
+            response = http_client.service('digitraffic').get(STATION_DATA_URL.format(station_id=station_id),
+                                                              headers=HEADERS, conditional=True)
+        except requests.RequestException as e:
+            logging.error(f"Error fetching road weather of station {station_id}: {e}")
+            return cached[1] if cached else None
+        if response.status_code != 200:
+            logging.error(f"Error fetching road weather of station {station_id}: HTTP {response.status_code}")
+            return cached[1] if cached else None
+        values = {}
+        for sensor in response.json().get('sensorValues', []):
+            field = SENSORS.get(sensor.get('name'))
+            if field and sensor.get('value') is not None:
+                values[field] = sensor['value']
+        self._observations[station_id] = (time(), values)
+        # Drop expired stations so the cache does not grow along a long drive
+        if len(self._observations) > 64:
+            now = time()
+            self._observations = {key: value for key, value in self._observations.items()
+                                  if now - value[0] < self.ttl}
+        return values
+
+    def lookup(self, latitude, longitude):
+        """
+        Returns temperature, humidity and road_temperature of the nearest
+        station that has them, with weather_station and its distance in km.
+
+        Returns:
+            dict: The weather, or None if there is no station within max_distance.
+        """
+        self.stations.refresh()
+        for distance, (station_id, _, _, name) in self.stations.nearest(latitude, longitude, self.candidates):
+            if distance > self.max_distance:
+                break
+            values = self.observations(station_id)
+            if values and 'temperature' in values:
+                return dict(values, weather_station=name, weather_station_distance=round(distance / 1000, 1))
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the road weather at a position')
+    parser.add_argument('latitude', type=float)
+    parser.add_argument('longitude', type=float)
+    parser.add_argument('--stations', default='weather_stations.json', help='Station list cache file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    road_weather = RoadWeather(args.stations)
+    road_weather.stations.refresh()
+    for distance, station in road_weather.stations.nearest(args.latitude, args.longitude, 3):
+        print(f"{station[3]} ({station[0]}): {distance / 1000:.1f} km")
+    print(road_weather.lookup(args.latitude, args.longitude))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import math
+from collections import deque
+
+
+class RollingWindow:
+    """
+    Fixed size window of the latest samples with constant time mean, min and max.
+
+    The sum is updated incrementally and min/max are kept in monotonic queues,
+    so each append is O(1) amortized regardless of the window size.
+
+    Args:
+        size (int): Number of samples in the window.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.count = 0
+        self._values = deque()
+        self._sum = 0.0
+        self._evictions = 0
+        self._min = deque()  # (sample number, value), increasing values
+        self._max = deque()  # (sample number, value), decreasing values
+
+    def __len__(self):
+        return len(self._values)
+
+    def append(self, value):
+        number = self.count
+        self.count += 1
+        self._values.append(value)
+        self._sum += value
+        if len(self._values) > self.size:
+            self._sum -= self._values.popleft()
+            self._evictions += 1
+            if self._evictions >= self.size:
+                # Recompute now and then so float rounding errors do not accumulate
+                self._sum = math.fsum(self._values)
+                self._evictions = 0
+
+        while self._min and self._min[-1][1] >= value:
+            self._min.pop()
+        self._min.append((number, value))
+        while self._max and self._max[-1][1] <= value:
+            self._max.pop()
+        self._max.append((number, value))
+        oldest = self.count - self.size
+        if self._min[0][0] < oldest:
+            self._min.popleft()
+        if self._max[0][0] < oldest:
+            self._max.popleft()
+
+    @property
+    def full(self):
+        return len(self._values) == self.size
+
+    def mean(self):
+        return self._sum / len(self._values) if self._values else 0.0
+
+    def min(self):
+        return self._min[0][1] if self._min else 0.0
+
+    def max(self):
+        return self._max[0][1] if self._max else 0.0
+
+    def values(self):
+        return list(self._values)
+
+
+class BearingWindow:
+    """
+    Fixed size window of bearings (degrees) with circular mean and spread.
+
+    Bearings are unwrapped, each to within 180 degrees of the previous one, so
+    the spread is the arc swept within the window: 355 and 5 degrees are 10
+    degrees apart, not 350.
+
+    Args:
+        size (int): Number of samples in the window.
+    """
+
+    def __init__(self, size):
+        self._window = RollingWindow(size)
+        self._sin = RollingWindow(size)
+        self._cos = RollingWindow(size)
+        self._previous = None
+
+    def __len__(self):
+        return len(self._window)
+
+    @property
+    def count(self):
+        return self._window.count
+
+    @property
+    def full(self):
+        return self._window.full
+
+    def append(self, bearing):
+        if self._previous is None:
+            unwrapped = bearing
+        else:
+            unwrapped = self._previous + (bearing - self._previous + 180) % 360 - 180
+        self._previous = unwrapped
+        self._window.append(unwrapped)
+        self._sin.append(math.sin(math.radians(bearing)))
+        self._cos.append(math.cos(math.radians(bearing)))
+
+    def mean(self):
+        """
+        Returns the circular mean bearing in degrees.
+        """
+        return math.degrees(math.atan2(self._sin.mean(), self._cos.mean())) % 360
+
+    def spread(self):
+        """
+        Returns the arc in degrees covered by the bearings in the window.
+        """
+        return min(360.0, self._window.max() - self._window.min())
+
+    def values(self):
+        return [value % 360 for value in self._window.values()]
+
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+import logging
+import math
+import mmap
+import struct
+from bisect import bisect_left
+from collections import namedtuple
+
+# File layout:
+#   header
+#   cell keys: uint32[cells], sorted numbers (row * cols + col) of non-empty cells
+#   cell starts: uint32[cells + 1], start of each cell in the entry list
+#   entry list: uint32 segment numbers, grouped by cell
+#   segment records
+#   string table: uint32[strings + 1] offsets, followed by the UTF-8 blob
+MAGIC = b'G2MS'
+VERSION = 1
+HEADER = struct.Struct('<4sHHddddIIIII')
+RECORD = struct.Struct('<qqqiiiiIIfI')
+UINT32 = struct.Struct('<I')
+
+EARTH_RADIUS = 6371000  # metres
+METRES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+COORD_SCALE = 10 ** 7
+
+ONEWAY = 1
+
+Segment = namedtuple(
+    'Segment', 'way_id node1 node2 lat1 lon1 lat2 lon2 name extra value flags')
+Match = namedtuple('Match', 'distance segment fraction latitude longitude')
+
+
+def project(latitude, longitude, lat0, lon0):
+    # Equirectangular projection to metres around (lat0, lon0). Accurate enough
+    # for the few hundred metres we search around a fix.
+    x = (longitude - lon0) * METRES_PER_DEGREE * math.cos(math.radians(lat0))
+    y = (latitude - lat0) * METRES_PER_DEGREE
+    return x, y
+
+
+def segment_bearing(segment):
+    x, y = project(segment.lat2, segment.lon2, segment.lat1, segment.lon1)
+    return math.degrees(math.atan2(x, y)) % 360
+
+
+def snap(segment, latitude, longitude):
+    """
+    Projects a point onto a segment.
+
+    Returns:
+        Match: Distance in metres, position along the segment (0..1) and the snapped point.
+    """
+    x1, y1 = project(segment.lat1, segment.lon1, latitude, longitude)
+    x2, y2 = project(segment.lat2, segment.lon2, latitude, longitude)
+    dx = x2 - x1
+    dy = y2 - y1
+    length = dx * dx + dy * dy
+    fraction = 0.0
+    if length > 0:
+        fraction = min(1.0, max(0.0, -(x1 * dx + y1 * dy) / length))
+    x = x1 + fraction * dx
+    y = y1 + fraction * dy
+    return Match(math.hypot(x, y), segment, fraction,
+                 segment.lat1 + fraction * (segment.lat2 - segment.lat1),
+                 segment.lon1 + fraction * (segment.lon2 - segment.lon1))
+
+
+class SegmentIndexWriter:
+    """
+    Collects segments and writes them into a grid index file.
+
+    Args:
+        cell_size (float): Grid cell size in metres.
+    """
+
+    def __init__(self, cell_size=100):
+        self.cell_size = cell_size
+        self._segments = []
+        self._strings = {'': 0}
+
+    def __len__(self):
+        return len(self._segments)
+
+    def _string(self, text):
+        text = text or ''
+        if text not in self._strings:
+            self._strings[text] = len(self._strings)
+        return self._strings[text]
+
+    def add(self, lat1, lon1, lat2, lon2, way_id=0, node1=0, node2=0,
+            name='', extra='', value=0.0, flags=0):
+        self._segments.append((
+            way_id, node1, node2,
+            round(lat1 * COORD_SCALE), round(lon1 * COORD_SCALE),
+            round(lat2 * COORD_SCALE), round(lon2 * COORD_SCALE),
+            self._string(name), self._string(extra), value, flags))
+
+    def add_point(self, latitude, longitude, node_id=0, name='', extra='', value=0.0):
+        self.add(latitude, longitude, latitude, longitude, 0, node_id, node_id, name, extra, value)
+
+    def write(self, path):
+        if not self._segments:
+            raise ValueError("No segments to write")
+
+        lats = [s[3] for s in self._segments] + [s[5] for s in self._segments]
+        lons = [s[4] for s in self._segments] + [s[6] for s in self._segments]
+        min_lat = min(lats) / COORD_SCALE
+        min_lon = min(lons) / COORD_SCALE
+        max_lat = max(lats) / COORD_SCALE
+        max_lon = max(lons) / COORD_SCALE
+        cell_lat = self.cell_size / METRES_PER_DEGREE
+        cell_lon = cell_lat / max(0.01, math.cos(math.radians((min_lat + max_lat) / 2)))
+        rows = int((max_lat - min_lat) / cell_lat) + 1
+        cols = int((max_lon - min_lon) / cell_lon) + 1
+
+        cells = {}
+        for number, s in enumerate(self._segments):
+            row1 = int((min(s[3], s[5]) / COORD_SCALE - min_lat) / cell_lat)
+            row2 = int((max(s[3], s[5]) / COORD_SCALE - min_lat) / cell_lat)
+            col1 = int((min(s[4], s[6]) / COORD_SCALE - min_lon) / cell_lon)
+            col2 = int((max(s[4], s[6]) / COORD_SCALE - min_lon) / cell_lon)
+            for row in range(row1, row2 + 1):
+                for col in range(col1, col2 + 1):
+                    cells.setdefault(row * cols + col, []).append(number)
+
+        strings = [text.encode('utf-8') for text in self._strings]
+        with open(path, 'wb') as f:
+            keys = sorted(cells)
+            f.write(HEADER.pack(MAGIC, VERSION, 0, min_lat, min_lon, cell_lat, cell_lon,
+                                rows, cols, len(keys), len(self._segments), len(strings)))
+            f.write(struct.pack(f'<{len(keys)}I', *keys))
+            start = 0
+            for key in keys:
+                f.write(UINT32.pack(start))
+                start += len(cells[key])
+            f.write(UINT32.pack(start))
+            for key in keys:
+                f.write(struct.pack(f'<{len(cells[key])}I', *cells[key]))
+            for s in self._segments:
+                f.write(RECORD.pack(*s))
+            offset = 0
+            for text in strings:
+                f.write(UINT32.pack(offset))
+                offset += len(text)
+            f.write(UINT32.pack(offset))
+            f.write(b''.join(strings))
+
+        logging.info(f"Wrote {len(self._segments)} segments in {rows}x{cols} cells to {path}")
+
+
+class SegmentIndex:
+    """
+    Read-only, memory-mapped grid index of segments written by SegmentIndexWriter.
+
+    Args:
+        path (str): Index file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, self.min_lat, self.min_lon, self.cell_lat, self.cell_lon,
+         self.rows, self.cols, cells, self.size, strings) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} segment index")
+
+        view = self._view = memoryview(self._map)
+        offset = HEADER.size
+        self._keys = view[offset:offset + cells * 4].cast('I')
+        offset += cells * 4
+        self._starts = view[offset:offset + (cells + 1) * 4].cast('I')
+        offset += (cells + 1) * 4
+        entries = self._starts[-1]
+        self._entries = view[offset:offset + entries * 4].cast('I')
+        offset += entries * 4
+        self._records = offset
+        offset += self.size * RECORD.size
+        self._string_offsets = view[offset:offset + (strings + 1) * 4].cast('I')
+        self._blob = offset + (strings + 1) * 4
+        self._string_cache = {}
+
+    def __len__(self):
+        return self.size
+
+    def string(self, number):
+        text = self._string_cache.get(number)
+        if text is None:
+            start = self._blob + self._string_offsets[number]
+            end = self._blob + self._string_offsets[number + 1]
+            text = self._map[start:end].decode('utf-8')
+            self._string_cache[number] = text
+        return text
+
+    def segment(self, number):
+        (way_id, node1, node2, lat1, lon1, lat2, lon2,
+         name, extra, value, flags) = RECORD.unpack_from(self._map, self._records + number * RECORD.size)
+        return Segment(way_id, node1, node2,
+                       lat1 / COORD_SCALE, lon1 / COORD_SCALE, lat2 / COORD_SCALE, lon2 / COORD_SCALE,
+                       self.string(name), self.string(extra), value, flags)
+
+    def candidates(self, latitude, longitude, radius):
+        """
+        Returns the numbers of all segments in grid cells within radius metres.
+        """
+        reach_lat = radius / METRES_PER_DEGREE
+        reach_lon = reach_lat / max(0.01, math.cos(math.radians(latitude)))
+        row1 = max(0, int((latitude - reach_lat - self.min_lat) / self.cell_lat))
+        row2 = min(self.rows - 1, int((latitude + reach_lat - self.min_lat) / self.cell_lat))
+        col1 = max(0, int((longitude - reach_lon - self.min_lon) / self.cell_lon))
+        col2 = min(self.cols - 1, int((longitude + reach_lon - self.min_lon) / self.cell_lon))
+        found = set()
+        for row in range(row1, row2 + 1):
+            first = bisect_left(self._keys, row * self.cols + col1)
+            last = bisect_left(self._keys, row * self.cols + col2 + 1)
+            if first < last:
+                found.update(self._entries[self._starts[first]:self._starts[last]])
+        return found
+
+    def nearest(self, latitude, longitude, radius, limit=None):
+        """
+        Finds segments within radius metres of a point.
+
+        Args:
+            latitude (float): Latitude of the point.
+            longitude (float): Longitude of the point.
+            radius (float): Search radius in metres.
+            limit (int): Maximum number of matches to return.
+
+        Returns:
+            list: Match tuples sorted by distance.
+        """
+        matches = []
+        for number in self.candidates(latitude, longitude, radius):
+            match = snap(self.segment(number), latitude, longitude)
+            if match.distance <= radius:
+                matches.append(match)
+        matches.sort(key=lambda m: m.distance)
+        return matches[:limit] if limit else matches
+
+    def close(self):
+        self._keys.release()
+        self._starts.release()
+        self._entries.release()
+        self._string_offsets.release()
+        self._view.release()
+        self._map.close()
@@ -6,6 +6,172 @@ MQTT_RETRY_CONNECT = 10 # Seconds to wait for next retry to connect to MQTT brok
 SPEED_BUFFER_SIZE = 3 # Buffer size for speed
 BEARING_BUFFER_SIZE = 5 # Buffer size for bearing
 STREET_THRESHOLD = 30 # Max seconds if no address has been fetched
+ENRICHMENT_WORKERS = 2 # Threads looking up address and speed limit
+
+# Read every fix from the gpsd JSON stream instead of polling once a second.
+# decimation publishes every Nth report, min_interval limits the rate (seconds).
+GPS_STREAM = {
+    'enabled': False,
+    'host': '127.0.0.1',
+    'port': 2947,
+    'decimation': 1,
+    'min_interval': 0
+}
+
+# Offline reverse geocoding. Build the index with:
+#   python3 geocoder.py extract.osm.bz2 geocoder --country-code fi
+# Nominatim is used when index is None, or as fallback if enabled.
+GEOCODER = {
+    'index': None,
+    'nominatim_fallback': True
+}
+
+# Local speed limit index. Build it with:
+#   python3 speed_limits.py extract.osm.bz2 speed_limits.idx
+# Overpass API is used when index is None.
+SPEED_LIMITS = {
+    'index': None,
+    'radius': 30
+}
+
+# Map matching to a local road graph. Build it with:
+#   python3 map_matcher.py extract.osm.bz2 roads.idx
+# The matched way gives the street and speed limit, address lookups are made
+# once per way. sigma is the GPS error and beta the detour tolerance in metres.
+MAP_MATCHER = {
+    'index': None,
+    'radius': 50,
+    'candidates': 8,
+    'sigma': 10,
+    'beta': 10
+}
+
+# Address and speed limit cache keyed by geohash cell, e.g. path 'geocache.sqlite'.
+# None disables it.
+# Precision 7 is a cell of about 150 x 150 m, 8 about 38 x 19 m.
+GEOCACHE = {
+    'path': None,
+    'memory_entries': 1024,
+    'address': {'precision': 7, 'ttl': 30 * 86400, 'max_entries': 100000},
+    'speed_limit': {'precision': 8, 'ttl': 30 * 86400, 'max_entries': 100000}
+}
+
+# Look up addresses and speed limits of the cells on the path dead reckoned
+# horizon seconds ahead, so they are cached on arrival. Needs GEOCACHE. At most
+# budget lookups per minute per service, projected every interval seconds.
+# Lookups of the main loop count against the same budget, and no two lookups
+# of a service are made within a second.
+PREFETCH = {
+    'enabled': False,
+    'horizon': 120,
+    'min_horizon': 0,
+    'interval': 5,
+    'budget': 20
+}
+
+# Air and road temperature and humidity from the nearest Digitraffic road
+# weather station. The station list is cached in stations_path and checked for
+# changes every station_list_ttl seconds, sensor values are reused for ttl seconds.
+ROAD_WEATHER = {
+    'enabled': False,
+    'stations_path': 'weather_stations.json',
+    'station_list_ttl': 86400,
+    'ttl': 300,
+    'max_distance': 30000,  # metres
+    'candidates': 3
+}
+
+# Web services called through http_client. timeout is (connect, read) seconds.
+# Failed requests are retried up to retries times within budget seconds; after
+# failure_threshold failed calls in a row a service is not called for cool_off seconds.
+HTTP = {
+    'overpass': {'timeout': (3.05, 15), 'retries': 1, 'budget': 30, 'failure_threshold': 3, 'cool_off': 120},
+    'digitraffic': {'timeout': (3.05, 10), 'retries': 2, 'budget': 20, 'failure_threshold': 5, 'cool_off': 60,
+                    'headers': {'Digitraffic-User': 'gps2mqtt'}}
+}
+
+# Keep fixes in a ring buffer file per broker while it is unreachable, and
+# replay them to history_topic on reconnect as JSON arrays of up to
+# replay_batch fixes, at most replay_rate messages per second. The file never
+# grows beyond max_bytes, the oldest fixes are dropped when it is full.
+SPOOL = {
+    'enabled': False,
+    'directory': 'spool',
+    'max_bytes': 10 * 1024 * 1024,
+    'slot_size': 2048,
+    'replay_rate': 10,
+    'replay_batch': 20,
+    'history_topic': 'gps_module/history'
+}
+
+# Publish each fix also in a compact form to binary_topic: 'struct' (fixed 47
+# byte layout), 'cbor' or 'msgpack' (need the cbor2 and msgpack packages). With
+# json_attributes False only the compact payload is published.
+PAYLOAD = {
+    'encoding': None,
+    'json_attributes': True,
+    'binary_topic': 'gps_module/binary'
+}
+
+# Collect the fixes of high rate receivers into one columnar JSON message on
+# topic, sent when max_fixes fixes are collected or the oldest has waited
+# max_delay seconds. Only the latest fix of each batch goes to the attributes topic.
+BATCH = {
+    'enabled': False,
+    'max_fixes': 50,
+    'max_delay': 5,
+    'topic': 'gps_module/batch'
+}
+
+# Speed and bearing from a constant velocity Kalman filter over the positions
+# instead of the GPS speed and the bearing between two fixes. acceleration
+# (m/s²) is how quickly the filtered velocity may change, below min_speed (m/s)
+# the bearing is held and after max_gap seconds without fixes the filter restarts.
+KALMAN = {
+    'enabled': False,
+    'acceleration': 1.0,
+    'min_speed': 1.0,
+    'max_gap': 10
+}
+
+# Every published fix is kept in an append-only log in directory, written every
+# flush_interval seconds. Read it with: python3 triplog.py trips --gpx trip.gpx
+TRIPLOG = {
+    'enabled': False,
+    'directory': 'trips',
+    'flush_interval': 5,
+    'fsync_interval': 30,
+    'max_bytes': 256 * 1024 * 1024,
+    'compact_after': 7 * 86400,  # seconds
+    'compact_interval': 10
+}
+
+# Stage timings and counters in the Prometheus text format at
+# http://host:port/metrics. Set diagnostics_interval to also publish them as
+# JSON to diagnostics_topic every that many seconds.
+METRICS = {
+    'enabled': False,
+    'host': '0.0.0.0',
+    'port': 9101,
+    'diagnostics_topic': 'gps_module/diagnostics',
+    'diagnostics_interval': 0
+}
+
+# Send SIGUSR1 to the running tracker to profile it for duration seconds,
+# profiles are written to directory
+PROFILER = {
+    'enabled': True,
+    'directory': 'profiles',
+    'duration': 30,
+    'interval': 0.01
+}
+
+# Home Assistant discovery. room names the device and its sensors, birth
+# messages of a broker within birth_interval seconds of the previous one are ignored
+DISCOVERY = {
+    'room': 'car',
+    'birth_interval': 10
+}
 
 # MQTT brokers details
 _brokers = [
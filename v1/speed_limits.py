@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import re
+
+from osm_extract import NodeStore, log_progress, read_osm, way_segments
+from segment_index import ONEWAY, SegmentIndex, SegmentIndexWriter, segment_bearing
+
+MPH = 1.609344
+KNOTS = 1.852
+
+# Implicit speed limits (km/h) of the zones used in maxspeed tags
+ZONE_LIMITS = {
+    'urban': 50, 'living_street': 20, 'walk': 7,
+    'FI:urban': 50, 'FI:rural': 80, 'FI:motorway': 120, 'FI:living_street': 20,
+    'SE:urban': 50, 'SE:rural': 70, 'SE:motorway': 110,
+    'NO:urban': 50, 'NO:rural': 80, 'NO:motorway': 110,
+    'DK:urban': 50, 'DK:rural': 80, 'DK:motorway': 130,
+    'EE:urban': 50, 'EE:rural': 90,
+    'DE:urban': 50, 'DE:rural': 100, 'DE:living_street': 7,
+    'FR:urban': 50, 'FR:rural': 80, 'FR:motorway': 130,
+    'RU:urban': 60, 'RU:rural': 90, 'RU:motorway': 110,
+    'GB:nsl_single': 60 * MPH, 'GB:nsl_dual': 70 * MPH, 'GB:motorway': 70 * MPH
+}
+
+MAXSPEED_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(km/h|kmh|kph|mph|knots)?\s*$')
+
+
+def parse_maxspeed(value):
+    """
+    Parses an OSM maxspeed value such as "50", "FI:urban" or "30 mph".
+
+    Returns:
+        int: Speed limit in km/h.
+        None: If the value has no numeric limit, e.g. "none" or "signals".
+    """
+    if value is None:
+        return None
+    value = str(value).split(';')[0].strip()
+    match = MAXSPEED_RE.match(value)
+    if match:
+        speed = float(match.group(1))
+        if match.group(2) == 'mph':
+            speed *= MPH
+        elif match.group(2) == 'knots':
+            speed *= KNOTS
+        return round(speed)
+    if value in ZONE_LIMITS:
+        return round(ZONE_LIMITS[value])
+    # Zone of an unknown country, e.g. "XX:urban"
+    zone = value.split(':')[-1]
+    if zone in ZONE_LIMITS:
+        return round(ZONE_LIMITS[zone])
+    return None
+
+
+def heading_difference(bearing1, bearing2):
+    difference = abs(bearing1 - bearing2) % 360
+    return 360 - difference if difference > 180 else difference
+
+
+class SpeedLimitIndex:
+    """
+    Speed limit lookup from a segment index built with build().
+
+    Args:
+        path (str): Index file.
+        radius (float): Search radius in metres.
+        heading_weight (float): Metres added to the distance of a segment per
+            90 degrees of difference between its direction and the bearing.
+    """
+
+    def __init__(self, path, radius=30, heading_weight=20):
+        self.index = SegmentIndex(path)
+        self.radius = radius
+        self.heading_weight = heading_weight
+
+    def lookup(self, latitude, longitude, bearing=None):
+        """
+        Returns the speed limit (km/h) of the nearest way, 0 if none is found.
+        The bearing breaks ties between nearby ways, e.g. at intersections.
+        """
+        best = None
+        best_cost = None
+        for match in self.index.nearest(latitude, longitude, self.radius):
+            cost = match.distance
+            if bearing is not None:
+                difference = heading_difference(segment_bearing(match.segment), bearing)
+                if not match.segment.flags & ONEWAY:
+                    difference = min(difference, 180 - difference)
+                cost += self.heading_weight * difference / 90
+            if best_cost is None or cost < best_cost:
+                best = match
+                best_cost = cost
+        if best is None:
+            return 0
+        return int(best.segment.value)
+
+
+def build(extract, path):
+    """
+    Builds the speed limit index from the maxspeed ways of an OSM XML extract.
+    """
+    nodes = NodeStore()
+    index = SegmentIndexWriter(cell_size=100)
+    for element in read_osm(extract):
+        if element[0] == 'node':
+            nodes.add(element[1], element[2], element[3])
+            log_progress('node', len(nodes))
+            continue
+        _, way_id, refs, tags = element
+        speed_limit = parse_maxspeed(tags.get('maxspeed'))
+        if speed_limit is None:
+            continue
+        flags = 0
+        oneway = tags.get('oneway')
+        if oneway in ('yes', 'true', '1') or tags.get('junction') == 'roundabout':
+            flags |= ONEWAY
+        elif oneway == '-1':
+            flags |= ONEWAY
+            refs = refs[::-1]
+        for node1, lat1, lon1, node2, lat2, lon2 in way_segments(nodes, refs):
+            index.add(lat1, lon1, lat2, lon2, way_id, node1, node2,
+                      tags.get('name', ''), tags['maxspeed'], speed_limit, flags)
+    index.write(path)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description='Build the speed limit index from an OSM extract')
+    parser.add_argument('extract', help='OSM XML extract (.osm, .osm.bz2 or .osm.gz)')
+    parser.add_argument('index', help='Output index file')
+    args = parser.parse_args()
+    build(args.extract, args.index)
@@ -0,0 +1,51 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import helpers  # noqa: E402
+
+
+class Client:
+    def __init__(self):
+        self.published = []
+
+    def publish(self, topic, payload, retain=False):
+        self.published.append(topic)
+        return SimpleNamespace(rc=0, mid=len(self.published))
+
+    def subscribe(self, topic):
+        pass
+
+
+def connect(status, broker):
+    helpers.on_connect(broker['client'], broker, None, 0)
+    helpers.publish_discovery_config(status, 'van')
+    published = broker['client'].published
+    broker['client'].published = []
+    return published
+
+
+def test_reconnect_publishes_only_changed_configs():
+    brokers = [{'host': 'a', 'port': 1883, 'client': Client(), 'connected': True},
+               {'host': 'b', 'port': 1883, 'client': Client(), 'connected': True}]
+    status = SimpleNamespace(brokers=brokers, mqtt_topic='gps_module/attributes')
+    assert len(connect(status, brokers[0])) == 17
+    assert brokers[1]['client'].published == []
+    assert all(topic.startswith('homeassistant/sensor/van_') for topic in connect(status, brokers[1]))
+    assert connect(status, brokers[0]) == []
+
+    status.mqtt_topic = 'test-gps_module/attributes'
+    assert len(connect(status, brokers[0])) == 17
+
+
+def test_birth_republishes_to_its_broker_once():
+    broker = {'host': 'a', 'port': 1883, 'client': Client(), 'connected': True}
+    status = SimpleNamespace(brokers=[broker], mqtt_topic='gps_module/attributes')
+    connect(status, broker)
+    online = SimpleNamespace(topic='homeassistant/status', payload=b'online')
+    helpers.on_message(broker['client'], broker, online)
+    helpers.on_message(broker['client'], broker, online)
+    helpers.publish_discovery_config(status, 'van')
+    assert len(broker['client'].published) == 17
@@ -0,0 +1,55 @@
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from map_matcher import MapMatcher  # noqa: E402
+from segment_index import SegmentIndexWriter  # noqa: E402
+
+LATITUDE = 65.0
+LONGITUDE = 25.5
+METRES_PER_DEGREE = 111195
+
+
+def north(metres):
+    return LATITUDE + metres / METRES_PER_DEGREE
+
+
+@pytest.fixture
+def parallel_roads(tmp_path):
+    # Two unconnected roads running east, 60 m apart, of 10 segments of 50 m
+    path = str(tmp_path / 'roads.idx')
+    writer = SegmentIndexWriter(cell_size=100)
+    step = 50 / METRES_PER_DEGREE / math.cos(math.radians(LATITUDE))
+    for way_id, offset, first_node in ((1, 0, 100), (2, 60, 200)):
+        for n in range(10):
+            writer.add(north(offset), LONGITUDE + n * step, north(offset), LONGITUDE + (n + 1) * step,
+                       way_id, first_node + n, first_node + n + 1, f"Road {way_id}", '', 50)
+    writer.write(path)
+    matcher = MapMatcher(path, radius=50, sigma=10, beta=10)
+    yield matcher, step
+    matcher.close()
+
+
+def test_parallel_unconnected_roads(parallel_roads):
+    matcher, step = parallel_roads
+    road = matcher.update(north(0), LONGITUDE + step)
+    assert road.way_id == 1
+    # Midway between the roads, the other road is a candidate but cannot be reached
+    for n in (2, 3, 4):
+        road = matcher.update(north(30), LONGITUDE + n * step)
+        assert road.way_id == 1
+    # Only the other road is within radius, matching restarts there
+    road = matcher.update(north(60), LONGITUDE + 5 * step)
+    assert road.way_id == 2
+    assert matcher.breaks == 1
+    assert matcher.update(north(60), LONGITUDE + 6 * step).way_id == 2
+
+
+def test_no_road_within_radius(parallel_roads):
+    matcher, step = parallel_roads
+    assert matcher.update(north(200), LONGITUDE + step) is None
+    assert matcher.update(north(0), LONGITUDE + 2 * step).way_id == 1
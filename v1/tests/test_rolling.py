@@ -0,0 +1,110 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rolling import BearingWindow, RollingWindow  # noqa: E402
+
+SPEEDS = [0.0, 12.5, 30.0, 47.5, 52.0, 51.0, 49.5, 20.0, 0.0, 0.0, 8.0, 64.0]
+
+
+def legacy_update_buffers(speed_buffer, bearing_buffer, speed, bearing, speed_size, bearing_size):
+    # The list based Status.update_buffers() the windows replace
+    speed_buffer.append(speed)
+    bearing_buffer.append(bearing)
+    average_speed = -1
+    bearing_difference = -1
+    if len(speed_buffer) > speed_size:
+        speed_buffer.pop(0)
+        average_speed = sum(speed_buffer) / len(speed_buffer)
+    if len(bearing_buffer) > bearing_size:
+        bearing_buffer.pop(0)
+        bearing_difference = abs(max(bearing_buffer) - min(bearing_buffer))
+        if bearing_difference > 180:
+            bearing_difference = 360 - bearing_difference
+    return average_speed, bearing_difference
+
+
+@pytest.mark.parametrize('size', [1, 3, 5])
+def test_speed_matches_legacy_buffers(size):
+    speeds, bearings = [], []
+    window = RollingWindow(size)
+    for speed in SPEEDS:
+        average_speed, _ = legacy_update_buffers(speeds, bearings, speed, 0, size, size)
+        window.append(speed)
+        if window.count > size:
+            assert window.mean() == pytest.approx(average_speed)
+            assert window.min() == min(speeds)
+            assert window.max() == max(speeds)
+            assert window.values() == speeds
+
+
+def test_min_max_after_extremes_leave_the_window():
+    window = RollingWindow(3)
+    for value in (90, 10, 50, 60, 70):
+        window.append(value)
+    assert (window.min(), window.max(), window.mean()) == (50, 70, 60)
+    assert window.full and len(window) == 3
+
+
+def test_empty_window():
+    window = RollingWindow(3)
+    assert (window.mean(), window.min(), window.max(), window.values()) == (0.0, 0.0, 0.0, [])
+    assert not window.full
+
+
+def test_mean_stays_exact_over_many_samples():
+    window = RollingWindow(10)
+    for n in range(100000):
+        window.append(0.1 * (n % 7))
+    assert window.mean() == pytest.approx(sum(0.1 * (n % 7) for n in range(99990, 100000)) / 10, abs=1e-12)
+
+
+@pytest.mark.parametrize('bearings, spread', [
+    ((10, 20, 30, 25, 15, 12), 18),
+    ((180, 170, 190, 185, 175, 180), 20),
+    ((300, 100, 200, 250, 150, 120), 150),
+])
+def test_bearing_spread_matches_legacy_away_from_north(bearings, spread):
+    speeds, legacy = [], []
+    window = BearingWindow(5)
+    for bearing in bearings:
+        _, difference = legacy_update_buffers(speeds, legacy, 0, bearing, 5, 5)
+        window.append(bearing)
+    assert window.spread() == pytest.approx(spread)
+    assert difference == pytest.approx(spread)
+
+
+@pytest.mark.parametrize('bearings, spread, mean', [
+    ((350, 355, 10), 20, 358.3),
+    ((5, 355, 358, 2, 1), 10, 0.2),
+    ((270, 300, 330, 0, 30), 120, 330),
+])
+def test_bearings_wrapping_around_north(bearings, spread, mean):
+    window = BearingWindow(len(bearings))
+    for bearing in bearings:
+        window.append(bearing)
+    assert window.spread() == pytest.approx(spread)
+    assert window.mean() == pytest.approx(mean, abs=0.1)
+    assert window.values() == list(bearings)
+
+
+def test_legacy_spread_is_wrong_across_north():
+    speeds, bearings = [], []
+    for bearing in (0, 350, 10, 90):
+        _, difference = legacy_update_buffers(speeds, bearings, 0, bearing, 3, 3)
+    window = BearingWindow(3)
+    for bearing in (350, 10, 90):
+        window.append(bearing)
+    # Turning right from 350 through north to 90 sweeps 100 degrees
+    assert window.spread() == pytest.approx(100)
+    assert difference == pytest.approx(20)
+
+
+def test_full_turns_are_capped():
+    window = BearingWindow(10)
+    for bearing in range(0, 400, 40):
+        window.append(bearing % 360)
+    assert window.spread() == 360
@@ -0,0 +1,521 @@
+import argparse
+import bisect
+import glob
+import logging
+import mmap
+import os
+import struct
+import time
+from datetime import datetime, timezone
+from xml.sax.saxutils import escape
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = b'G2TL'
+VERSION = 1
+# magic, version, record size, index interval, flags, created (ms since epoch)
+HEADER = struct.Struct('<4sHHIIq')
+HEADER_SIZE = 64
+# time (ms since epoch), latitude and longitude (1e-7 degrees), altitude (m),
+# speed (km/h), bearing (degrees), climb (m/s), accuracy (dm), satellites, reserved
+RECORD = struct.Struct('<qiiffffHBB')
+# time (ms since epoch) of every index interval-th record, record number
+INDEX_ENTRY = struct.Struct('<qQ')
+COORD_SCALE = 10 ** 7
+COMPACTED = 1
+
+SEGMENT_PATTERN = 'trip-*.g2t'
+
+if np is not None:
+    RECORD_DTYPE = np.dtype([('t', '<i8'), ('lat', '<i4'), ('lon', '<i4'), ('altitude', '<f4'), ('speed', '<f4'),
+                             ('bearing', '<f4'), ('climb', '<f4'), ('accuracy', '<u2'), ('satellites', 'u1'),
+                             ('reserved', 'u1')])
+    FIX_DTYPE = np.dtype([('time', '<f8'), ('latitude', '<f8'), ('longitude', '<f8'), ('altitude', '<f4'),
+                          ('speed', '<f4'), ('bearing', '<f4'), ('climb', '<f4'), ('gps_accuracy', '<f4'),
+                          ('satellites', 'u1')])
+
+
+def _milliseconds(value):
+    # Fix time as ms since epoch, from gpsd ISO 8601 time or seconds
+    if isinstance(value, str):
+        return round(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+    return round(value * 1000)
+
+
+def _float(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+    return value
+
+
+def pack_fix(fix):
+    """
+    Packs a fix dictionary into a record. Missing or invalid numbers are
+    stored as NaN.
+    """
+    try:
+        t = _milliseconds(fix['time'])
+    except (KeyError, TypeError, ValueError):
+        t = round(time.time() * 1000)
+    accuracy = _float(fix.get('gps_accuracy'))
+    accuracy = 0xFFFF if accuracy != accuracy else min(0xFFFE, max(0, round(accuracy * 10)))
+    satellites = fix.get('satellites')
+    return RECORD.pack(t, round(fix['latitude'] * COORD_SCALE), round(fix['longitude'] * COORD_SCALE),
+                       _float(fix.get('altitude')), _float(fix.get('speed')), _float(fix.get('bearing')),
+                       _float(fix.get('climb')), accuracy,
+                       min(255, satellites) if isinstance(satellites, int) else 0xFF, 0)
+
+
+def unpack_fix(record):
+    """
+    Unpacks a record into a fix dictionary with time in seconds since epoch.
+    """
+    t, lat, lon, altitude, speed, bearing, climb, accuracy, satellites, _ = record
+    return {
+        'time': t / 1000,
+        'latitude': lat / COORD_SCALE,
+        'longitude': lon / COORD_SCALE,
+        'altitude': altitude,
+        'speed': speed,
+        'bearing': bearing,
+        'climb': climb,
+        'gps_accuracy': None if accuracy == 0xFFFF else accuracy / 10,
+        'satellites': None if satellites == 0xFF else satellites
+    }
+
+
+class Segment:
+    """
+    Read-only view of one trip log file. Records are found with the sparse
+    time index and a binary search within one index interval, so a range
+    query reads a few pages regardless of the file size.
+
+    Args:
+        path (str): Segment file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self.count = 0
+        with open(path, 'rb') as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError(f"{path} is not a trip log")
+            magic, version, record_size, self.index_interval, self.flags, self.created = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+                raise ValueError(f"{path} is not a version {VERSION} trip log")
+            size = os.fstat(f.fileno()).st_size
+            # A partial record left by a crash is ignored
+            self.count = max(0, (size - HEADER_SIZE) // RECORD.size)
+            if self.count:
+                self._map = mmap.mmap(f.fileno(), HEADER_SIZE + self.count * RECORD.size, access=mmap.ACCESS_READ)
+        self._index_times, self._index_numbers = self._read_index()
+
+    def _read_index(self):
+        times = []
+        numbers = []
+        try:
+            with open(index_path(self.path), 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+        for t, number in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+            if number >= self.count:
+                break
+            times.append(t)
+            numbers.append(number)
+        return times, numbers
+
+    def time_at(self, number):
+        return struct.unpack_from('<q', self._map, HEADER_SIZE + number * RECORD.size)[0]
+
+    @property
+    def first_time(self):
+        return self.time_at(0) if self.count else None
+
+    @property
+    def last_time(self):
+        return self.time_at(self.count - 1) if self.count else None
+
+    def bisect(self, t):
+        """
+        Returns the number of the first record at or after t (ms since epoch).
+        """
+        low, high = 0, self.count
+        if self._index_times:
+            # The records of one index interval bound the search
+            position = bisect.bisect_left(self._index_times, t)
+            if position > 0:
+                low = self._index_numbers[position - 1]
+            if position < len(self._index_times):
+                high = self._index_numbers[position]
+        while low < high:
+            middle = (low + high) // 2
+            if self.time_at(middle) < t:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def range(self, start, end):
+        """
+        Returns the record numbers [first, last) from start to end (ms since epoch).
+        """
+        if not self.count:
+            return 0, 0
+        return self.bisect(start), self.bisect(end + 1)
+
+    def raw(self, first, last):
+        return self._map[HEADER_SIZE + first * RECORD.size:HEADER_SIZE + last * RECORD.size]
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def index_path(path):
+    return os.path.splitext(path)[0] + '.idx'
+
+
+class TripLog:
+    """
+    Append-only log of fixes on local storage. Fixes are packed into fixed
+    size records and written to the current segment file in batches: one
+    write every flush_interval seconds and one fsync every fsync_interval
+    seconds, so logging every fix costs a struct pack and a buffer append.
+    Every index_interval-th record is also written to a sparse time index
+    next to the segment.
+
+    Segments are rotated when they reach max_segment_bytes or are
+    rotate_interval seconds old. The oldest are deleted when the log
+    exceeds max_bytes, and segments older than compact_after seconds are
+    thinned to one fix per compact_interval seconds.
+
+    Fixes must arrive in time order, older fixes than the last are skipped.
+
+    Args:
+        directory (str): Directory of the segment files.
+        flush_interval (float): Max seconds fixes are buffered in memory.
+        fsync_interval (float): Min seconds between fsyncs.
+        index_interval (int): Records per sparse index entry.
+        max_segment_bytes (int): Segment size that starts a new segment.
+        rotate_interval (float): Segment age in seconds that starts a new segment.
+        max_bytes (int): Max size of all segments.
+        compact_after (float): Age in seconds of segments to compact, 0 to disable.
+        compact_interval (float): Seconds between the fixes kept by compaction.
+    """
+
+    def __init__(self, directory, flush_interval=5, fsync_interval=30, index_interval=256,
+                 max_segment_bytes=8 * 1024 * 1024, rotate_interval=86400, max_bytes=256 * 1024 * 1024,
+                 compact_after=7 * 86400, compact_interval=10):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.index_interval = index_interval
+        self.max_segment_bytes = max_segment_bytes
+        self.rotate_interval = rotate_interval
+        self.max_bytes = max_bytes
+        self.compact_after = compact_after
+        self.compact_interval = compact_interval
+        self.skipped = 0
+        self._buffer = bytearray()
+        self._index_buffer = bytearray()
+        self._fd = None
+        self._index_fd = None
+        self._path = None
+        self._count = 0
+        self._created = 0
+        self._last_time = None
+        self._flushed = time.monotonic()
+        self._synced = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def segments(self):
+        """
+        Returns the segment paths, oldest first.
+        """
+        return sorted(glob.glob(os.path.join(self.directory, SEGMENT_PATTERN)))
+
+    def _open(self, t):
+        self._path = os.path.join(self.directory, f"trip-{t:013d}.g2t")
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        size = os.fstat(self._fd).st_size
+        if size < HEADER_SIZE:
+            os.ftruncate(self._fd, 0)
+            header = HEADER.pack(MAGIC, VERSION, RECORD.size, self.index_interval, 0, t)
+            os.write(self._fd, header.ljust(HEADER_SIZE, b'\0'))
+            size = HEADER_SIZE
+        elif (size - HEADER_SIZE) % RECORD.size:
+            # Drop a partial record written before a crash
+            size -= (size - HEADER_SIZE) % RECORD.size
+            os.ftruncate(self._fd, size)
+        self._count = (size - HEADER_SIZE) // RECORD.size
+        self._index_fd = os.open(index_path(self._path), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        # Drop index entries of records lost in a crash
+        entries = os.fstat(self._index_fd).st_size // INDEX_ENTRY.size
+        while entries and INDEX_ENTRY.unpack(os.pread(self._index_fd, INDEX_ENTRY.size,
+                                                      (entries - 1) * INDEX_ENTRY.size))[1] >= self._count:
+            entries -= 1
+        os.ftruncate(self._index_fd, entries * INDEX_ENTRY.size)
+        self._created = t
+        logging.debug(f"Trip log segment {self._path} opened with {self._count} records")
+
+    def _resume(self):
+        # Continue the newest segment after a restart if it is not full
+        segments = self.segments()
+        if segments:
+            try:
+                segment = Segment(segments[-1])
+            except (OSError, ValueError) as e:
+                logging.error(f"Not continuing trip log {segments[-1]}: {e}")
+                return
+            self._last_time = segment.last_time
+            full = (os.path.getsize(segment.path) >= self.max_segment_bytes
+                    or time.time() * 1000 - segment.created >= self.rotate_interval * 1000)
+            created = segment.created
+            segment.close()
+            if not full:
+                self._open(created)
+
+    def append(self, fix):
+        """
+        Logs a fix dictionary with at least latitude and longitude.
+        """
+        record = pack_fix(fix)
+        t = struct.unpack_from('<q', record)[0]
+        if self._fd is None and self._last_time is None:
+            self._resume()
+        if self._last_time is not None and t < self._last_time:
+            self.skipped += 1
+            return
+        if self._fd is not None and (self._count * RECORD.size + HEADER_SIZE >= self.max_segment_bytes
+                                     or t - self._created >= self.rotate_interval * 1000):
+            self.rotate()
+        if self._fd is None:
+            self._open(t)
+        if self._count % self.index_interval == 0:
+            self._index_buffer += INDEX_ENTRY.pack(t, self._count)
+        self._buffer += record
+        self._count += 1
+        self._last_time = t
+        if time.monotonic() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def flush(self, sync=False):
+        """
+        Writes the buffered records, and fsyncs if fsync_interval has passed or sync is set.
+        """
+        self._flushed = time.monotonic()
+        if self._fd is None:
+            return
+        if self._buffer:
+            os.write(self._fd, self._buffer)
+            self._buffer.clear()
+        if self._index_buffer:
+            os.write(self._index_fd, self._index_buffer)
+            self._index_buffer.clear()
+        if sync or time.monotonic() - self._synced >= self.fsync_interval:
+            os.fsync(self._fd)
+            os.fsync(self._index_fd)
+            self._synced = time.monotonic()
+
+    def rotate(self):
+        """
+        Closes the current segment, then enforces max_bytes and compacts old segments.
+        """
+        if self._fd is not None:
+            self.flush(sync=True)
+            os.close(self._fd)
+            os.close(self._index_fd)
+            logging.info(f"Trip log segment {self._path} closed with {self._count} records")
+            self._fd = self._index_fd = None
+        self.maintain()
+
+    def maintain(self):
+        """
+        Compacts closed segments older than compact_after and deletes the
+        oldest segments beyond max_bytes.
+        """
+        segments = [path for path in self.segments() if path != self._path or self._fd is None]
+        if self.compact_after:
+            limit = (time.time() - self.compact_after) * 1000
+            for path in segments:
+                try:
+                    self._compact(path, limit)
+                except (OSError, ValueError) as e:
+                    logging.error(f"Error compacting trip log {path}: {e}")
+        total = sum(os.path.getsize(path) for path in self.segments())
+        for path in segments:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+            logging.info(f"Trip log segment {path} deleted, the log exceeds {self.max_bytes} bytes")
+
+    def _compact(self, path, limit):
+        # Keeps one record per compact_interval of a segment whose last fix is older than limit
+        segment = Segment(path)
+        try:
+            if segment.flags & COMPACTED or not segment.count or segment.last_time >= limit:
+                return
+            step = self.compact_interval * 1000
+            kept = bytearray()
+            index = bytearray()
+            count = 0
+            next_time = None
+            for record in RECORD.iter_unpack(segment.raw(0, segment.count)):
+                if next_time is not None and record[0] < next_time:
+                    continue
+                if count % segment.index_interval == 0:
+                    index += INDEX_ENTRY.pack(record[0], count)
+                kept += RECORD.pack(*record)
+                count += 1
+                next_time = record[0] + step
+            header = HEADER.pack(MAGIC, VERSION, RECORD.size, segment.index_interval, segment.flags | COMPACTED,
+                                 segment.created).ljust(HEADER_SIZE, b'\0')
+            removed = segment.count - count
+        finally:
+            segment.close()
+        for target, data in ((index_path(path), index), (path, header + kept)):
+            temporary = f"{target}.tmp"
+            with open(temporary, 'wb') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temporary, target)
+        logging.info(f"Trip log segment {path} compacted, {removed} of {removed + count} fixes removed")
+
+    def _segments_between(self, start, end):
+        # Open segments that may hold fixes from start to end (ms since epoch)
+        paths = self.segments()
+        created = [int(os.path.basename(path)[5:-4]) for path in paths]
+        # The segment created last before start can hold fixes after start
+        first = max(0, bisect.bisect_right(created, start) - 1)
+        for path, segment_created in zip(paths[first:], created[first:]):
+            if segment_created > end:
+                break
+            try:
+                yield Segment(path)
+            except (OSError, ValueError) as e:
+                logging.error(f"Error reading trip log {path}: {e}")
+
+    def read_raw(self, start=0, end=None):
+        """
+        Returns the packed records from start to end, seconds since epoch.
+        Buffered records are written first.
+        """
+        self.flush()
+        start = round(start * 1000)
+        end = round((end if end is not None else time.time() + 86400) * 1000)
+        chunks = []
+        for segment in self._segments_between(start, end):
+            try:
+                first, last = segment.range(start, end)
+                if first < last:
+                    chunks.append(segment.raw(first, last))
+            finally:
+                segment.close()
+        return b''.join(chunks)
+
+    def read(self, start=0, end=None):
+        """
+        Returns the fixes from start to end, seconds since epoch, as dictionaries.
+        """
+        return [unpack_fix(record) for record in RECORD.iter_unpack(self.read_raw(start, end))]
+
+    def to_numpy(self, start=0, end=None):
+        """
+        Returns the fixes from start to end as a NumPy structured array with
+        time in seconds, latitude, longitude, altitude, speed, bearing, climb,
+        gps_accuracy and satellites fields.
+
+        Raises:
+            RuntimeError: If NumPy is not installed.
+        """
+        if np is None:
+            raise RuntimeError("Reading the trip log as an array needs the numpy package")
+        records = np.frombuffer(self.read_raw(start, end), dtype=RECORD_DTYPE)
+        fixes = np.empty(len(records), dtype=FIX_DTYPE)
+        fixes['time'] = records['t'] / 1000
+        fixes['latitude'] = records['lat'] / COORD_SCALE
+        fixes['longitude'] = records['lon'] / COORD_SCALE
+        for field in ('altitude', 'speed', 'bearing', 'climb'):
+            fixes[field] = records[field]
+        fixes['gps_accuracy'] = np.where(records['accuracy'] == 0xFFFF, np.nan, records['accuracy'] / 10)
+        fixes['satellites'] = records['satellites']
+        return fixes
+
+    def write_gpx(self, f, start=0, end=None, name='gps2mqtt'):
+        """
+        Writes the fixes from start to end as a GPX 1.1 track to a text file.
+
+        Returns:
+            int: Number of track points written.
+        """
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" creator="gps2mqtt" xmlns="http://www.topografix.com/GPX/1/1">\n'
+                f'<trk><name>{escape(name)}</name><trkseg>\n')
+        count = 0
+        for t, lat, lon, altitude, _, _, _, _, satellites, _ in RECORD.iter_unpack(self.read_raw(start, end)):
+            point = f'<trkpt lat="{lat / COORD_SCALE:.7f}" lon="{lon / COORD_SCALE:.7f}">'
+            if altitude == altitude:
+                point += f'<ele>{altitude:.1f}</ele>'
+            stamp = datetime.fromtimestamp(t / 1000, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3]
+            point += f'<time>{stamp}Z</time>'
+            if satellites != 0xFF:
+                point += f'<sat>{satellites}</sat>'
+            f.write(point + '</trkpt>\n')
+            count += 1
+        f.write('</trkseg></trk>\n</gpx>\n')
+        return count
+
+    def close(self):
+        if self._fd is not None:
+            self.flush(sync=True)
+            os.close(self._fd)
+            os.close(self._index_fd)
+            self._fd = self._index_fd = None
+
+
+def _parse_time(value):
+    # Seconds since epoch or ISO 8601
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Read the trip log')
+    parser.add_argument('directory', help='Trip log directory')
+    parser.add_argument('--start', type=_parse_time, default=0, help='Seconds since epoch or ISO 8601 time')
+    parser.add_argument('--end', type=_parse_time, default=None, help='Seconds since epoch or ISO 8601 time')
+    parser.add_argument('--gpx', help='Write the fixes to this GPX file')
+    parser.add_argument('--compact', action='store_true', help='Compact and delete old segments')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    log = TripLog(args.directory)
+    if args.compact:
+        log.maintain()
+    if args.gpx:
+        with open(args.gpx, 'w') as gpx_file:
+            print(f"{log.write_gpx(gpx_file, args.start, args.end)} fixes written to {args.gpx}")
+    else:
+        for path in log.segments():
+            segment = Segment(path)
+            first, last = segment.first_time, segment.last_time
+            print(f"{os.path.basename(path)}: {segment.count} fixes"
+                  + (f", {datetime.fromtimestamp(first / 1000)} - {datetime.fromtimestamp(last / 1000)}"
+                     if segment.count else '')
+                  + (' (compacted)' if segment.flags & COMPACTED else ''))
+            segment.close()
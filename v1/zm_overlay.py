@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+import logging
+import random
+import select
+import socket
+import threading
+
+
+def convert_umlaut_characters(text):
+    conversion_table = {
+        'Å': 'A', 'Ä': 'A', 'Ö': 'O', 'Ü': 'U',
+        'å': 'a', 'ä': 'a', 'ö': 'o', 'ü': 'u'
+    }
+    return ''.join(conversion_table.get(char, char) for char in text)
+
+
+class ZmOverlay:
+    """
+    Shows text on ZoneMinder monitors through zmtrigger without blocking the
+    caller. show() only stores the text; a background thread keeps one
+    persistent connection to zmtrigger and sends the latest text to all
+    monitors with a single sendall. Texts shown while a send or reconnect is
+    in progress replace each other, so only the newest one is sent.
+
+    Args:
+        host (str): zmtrigger host.
+        port (int): zmtrigger port.
+        monitors (list): Monitor ids.
+        timeout (float): Connect and send timeout in seconds.
+        max_backoff (float): Max seconds between reconnect attempts.
+    """
+
+    def __init__(self, host, port, monitors, timeout=5, max_backoff=60):
+        self.host = host
+        self.port = int(port)
+        self.monitors = list(monitors)
+        self.timeout = timeout
+        self.max_backoff = max_backoff
+        self.sent = 0
+        self.failures = 0
+        self._text = None
+        self._sent_text = None
+        self._sock = None
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='zm-overlay', daemon=True)
+        self._thread.start()
+
+    def show(self, text):
+        """
+        Sets the overlay text of all monitors. Returns immediately.
+        """
+        with self._condition:
+            self._text = text
+            self._condition.notify()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(self.timeout)
+        self._disconnect()
+
+    def _payload(self, text):
+        text = convert_umlaut_characters(text).replace('|', '/')
+        return ''.join(f"{monitor}|show||||{text}\r\n" for monitor in self.monitors).encode('ascii', 'replace')
+
+    def _connect(self):
+        logging.debug(f"Connecting zmtrigger {self.host}:{self.port}")
+        self._sock = socket.create_connection((self.host, self.port), self.timeout)
+        self._sock.settimeout(self.timeout)
+        logging.info(f"Connected to zmtrigger {self.host}:{self.port}")
+
+    def _disconnect(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _send(self, text):
+        if self._sock is None:
+            self._connect()
+        self._sock.sendall(self._payload(text))
+        # Discard replies so they do not fill the buffers, and notice a closed connection
+        while select.select([self._sock], [], [], 0)[0]:
+            if not self._sock.recv(4096):
+                raise ConnectionError("zmtrigger closed the connection")
+
+    def _run(self):
+        backoff = 1
+        while True:
+            with self._condition:
+                while not self._closed and self._text == self._sent_text:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                text = self._text
+            try:
+                self._send(text)
+                self._sent_text = text
+                self.sent += 1
+                backoff = 1
+                logging.debug(f"Sent overlay to zmtrigger: {text}")
+            except OSError as e:
+                self._disconnect()
+                self.failures += 1
+                if self.failures == 1 or backoff >= self.max_backoff:
+                    logging.error(f"Unable to send overlay to zmtrigger {self.host}:{self.port}: {e}. "
+                                  "Is zmtrigger running?")
+                # Wait before reconnecting unless closed, newer texts wait too
+                with self._condition:
+                    self._condition.wait_for(lambda: self._closed, backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, self.max_backoff)
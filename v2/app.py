@@ -3,9 +3,22 @@ import paho.mqtt.client as mqtt
 import json
 import time
 import logging
+import math
 import socket
+import os
 import signal
 import sys
+import threading
+from batch import FixBatcher
+from compress import DeadbandFilter
+from discovery import DiscoveryManager
+import metrics
+from gps_stream import GpsStream
+from kalman import KalmanFilter
+from payload import fix_from_packet, get_codec, parse_time
+from profiler import SignalProfiler
+from spool import Spool
+from triplog import TripLog
 from settings import brokers
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s [%(funcName)s:%(lineno)d]')
@@ -38,14 +51,67 @@ combined_id = f"{hostname}"
 with open("config.json", "r") as config_file:
     config = json.load(config_file)
 
-# Device tracker configuration data
-device_tracker_config = {
-    "state_topic": config['mqtt_topics']['state'].format(combined_id=combined_id),
-    "name": f"GPS Module {hostname}",
-    "json_attributes_topic": config['mqtt_topics']['attributes'].format(combined_id=combined_id),
-    "unique_id": f"gps-module-{combined_id}",
-    "friendly_name": f"GPS Module {hostname}"
-}
+# Publish only fixes that differ from the dead reckoned position
+compression_config = config.get('compression', {})
+deadband = None
+if compression_config.get('enabled'):
+    deadband = DeadbandFilter(compression_config.get('max_error', 10), compression_config.get('heartbeat', 60))
+
+# Speed and bearing from a constant velocity Kalman filter over the positions
+kalman_config = config.get('kalman', {})
+kalman = None
+if kalman_config.get('enabled'):
+    kalman = KalmanFilter(kalman_config.get('acceleration', 1.0), min_speed=kalman_config.get('min_speed', 1.0),
+                          max_gap=kalman_config.get('max_gap', 10))
+
+# Collect fixes of high rate receivers into batch messages
+batch_config = config.get('batch', {})
+batcher = None
+if batch_config.get('enabled'):
+    batcher = FixBatcher(batch_config.get('max_fixes', 50), batch_config.get('max_delay', 5))
+
+# Local history of every fix, for analysis and backfill
+triplog_config = config.get('triplog', {})
+triplog = None
+if triplog_config.get('enabled'):
+    triplog = TripLog(triplog_config.get('directory', 'trips'), triplog_config.get('flush_interval', 5),
+                      triplog_config.get('fsync_interval', 30), max_segment_bytes=triplog_config.get(
+                          'max_segment_bytes', 8388608), max_bytes=triplog_config.get('max_bytes', 268435456),
+                      compact_after=triplog_config.get('compact_after', 604800),
+                      compact_interval=triplog_config.get('compact_interval', 10))
+
+# Optional compact payload published in parallel to the JSON attributes
+payload_config = config.get('payload', {})
+encode_payload = None
+if payload_config.get('encoding'):
+    encode_payload = get_codec(payload_config['encoding'])[0]
+
+# Stage timings and counters, served for Prometheus and optionally published
+# to the diagnostics topic
+metrics_config = config.get('metrics', {})
+stage_seconds = {stage: metrics.histogram('gps_stage_seconds', 'Seconds spent per pipeline stage', stage=stage)
+                 for stage in ('gpsd', 'encode', 'publish')}
+fix_age = metrics.histogram('gps_fix_age_seconds', 'Seconds from the fix time to publish',
+                            (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60))
+fixes_total = metrics.counter('gps_fixes', 'Reports with a 2D or 3D fix')
+no_fix_total = metrics.counter('gps_no_fix', 'Reports without a fix')
+publish_errors = metrics.counter('mqtt_publish_errors', 'Failed MQTT publishes')
+connects = metrics.counter('mqtt_connects', 'Connections to MQTT brokers')
+disconnects = metrics.counter('mqtt_disconnects', 'Disconnections from MQTT brokers')
+publish_tracker = metrics.PublishTracker(
+    metrics.histogram('mqtt_publish_ack_seconds', 'Seconds from publish to the on_publish callback'))
+metrics.gauge('mqtt_publish_in_flight', 'Published messages not yet acknowledged', publish_tracker.in_flight)
+metrics.gauge('spool_depth', 'Fixes waiting in the spools',
+              lambda: sum(len(broker['spool']) for broker in brokers if broker.get('spool')))
+metrics.gauge('batch_depth', 'Fixes waiting in the pending batch', lambda: len(batcher) if batcher else 0)
+last_diagnostics = 0
+
+# Home Assistant discovery configs of the device tracker and the sensors
+discovery_config = config.get('discovery', {})
+discovery = DiscoveryManager(discovery_config.get('prefix', 'homeassistant'), discovery_config.get('sensors', True),
+                             discovery_config.get('rate', 10), discovery_config.get('jitter', 10))
+discovery.add_device(combined_id, {name: topic.format(combined_id=combined_id)
+                                   for name, topic in config['mqtt_topics'].items()}, f"GPS Module {hostname}")
 
 def on_connect(client, userdata, flags, reason_code, properties=None):
     """
@@ -59,13 +125,15 @@ def on_connect(client, userdata, flags, reason_code, properties=None):
     """
     if reason_code == 0:
         logging.info(f"Connected to MQTT Broker at {client._host}:{client._port}")
+        connects.inc()
         for broker in brokers:
             if broker['client'] == client:
                 broker['connected'] = True
                 client.subscribe(config['mqtt_topics']['homeassistant_status'])
                 logging.info(f"Subscribed to topic '{config['mqtt_topics']['homeassistant_status']}' at {client._host}:{client._port}")
-                client.publish(f"homeassistant/device_tracker/gps_module_{combined_id}/config", json.dumps(device_tracker_config), retain=True)
-                logging.info(f"Published configuration to homeassistant/device_tracker/gps_module_{combined_id}/config")
+                discovery.connected(client)
+                if broker.get('spool'):
+                    threading.Thread(target=replay_spool, args=(broker,), daemon=True).start()
                 break
     else:
         logging.error(f"Failed to connect to MQTT Broker at {client._host}:{client._port}, return code {reason_code}")
@@ -80,6 +148,8 @@ def on_disconnect(client, userdata, flags, reason_code, properties=None):
         rc (int): The disconnection result.
     """
     logging.warning(f"Disconnected from MQTT Broker at {client._host}:{client._port}.")
+    disconnects.inc()
+    discovery.disconnected(client)
     for broker in brokers:
         if broker['client'] == client:
             broker['connected'] = False
@@ -95,30 +165,92 @@ def on_message(client, userdata, msg, properties=None):
         msg (mqtt.MQTTMessage): An instance of MQTTMessage, which contains topic, payload, qos, retain.
     """
     logging.info(f"Message received from topic {msg.topic}: {msg.payload.decode()}")
-    if msg.payload.decode() == "online":
-        logging.info("Received 'online' message, resending device tracker configuration")
-        client.publish(f"homeassistant/device_tracker/gps_module_{combined_id}/config", json.dumps(device_tracker_config), retain=True)
-        logging.info(f"Resent configuration to homeassistant/device_tracker/gps_module_{combined_id}/config")
+    if msg.topic == config['mqtt_topics']['homeassistant_status'] and msg.payload.decode() == "online":
+        logging.info("Received 'online' message, republishing discovery configuration")
+        discovery.birth(client)
+
+def on_publish(client, userdata, mid, reason_code=None, properties=None):
+    """
+    The callback function for when a message has been sent to the broker.
+
+    Args:
+        client (mqtt.Client): The MQTT client instance.
+        userdata: The private user data as set in Client() or userdata_set().
+        mid (int): The message id returned by publish().
+    """
+    publish_tracker.acked(client, mid)
+
+def replay_spool(broker):
+    """
+    Publishes the fixes spooled during an outage to the history topic, oldest
+    first and rate limited, while the broker stays connected.
+
+    Args:
+        broker (dict): The broker whose spool to replay.
+    """
+    spool = broker['spool']
+    if not broker['replay_lock'].acquire(blocking=False):
+        return
+    try:
+        spool_config = config['spool']
+        topic = config['mqtt_topics']['history'].format(combined_id=combined_id)
+        batch_size = spool_config.get('replay_batch', 50)
+        interval = 1 / spool_config.get('replay_rate', 10)
+        if len(spool):
+            logging.info(f"Replaying {len(spool)} spooled fixes to {broker['host']}:{broker['port']}")
+        while broker['connected'] and len(spool):
+            until, messages = spool.peek(batch_size)
+            info = broker['client'].publish(topic, b'[' + b','.join(messages) + b']', qos=1)
+            info.wait_for_publish(10)
+            if not info.is_published():
+                logging.warning(f"Spool replay to {broker['host']}:{broker['port']} interrupted")
+                break
+            spool.pop(until)
+            time.sleep(interval)
+    except Exception as e:
+        logging.error(f"Error replaying spool to {broker['host']}:{broker['port']}: {e}")
+    finally:
+        broker['replay_lock'].release()
+
+def open_spools():
+    """
+    Opens the store-and-forward spool of each broker if spooling is enabled.
+    """
+    spool_config = config.get('spool', {})
+    if not spool_config.get('enabled'):
+        return
+    directory = spool_config.get('directory', 'spool')
+    os.makedirs(directory, exist_ok=True)
+    for broker in brokers:
+        broker['spool'] = Spool(os.path.join(directory, f"{broker['host']}_{broker['port']}.spool"),
+                                spool_config.get('max_bytes', 10 * 1024 * 1024),
+                                spool_config.get('slot_size', 512))
+        broker['replay_lock'] = threading.Lock()
 
 def connect_to_brokers():
     """
     Connects to all MQTT brokers specified in the settings.
     """
+    open_spools()
     for broker in brokers:
         try:
             broker['client'] = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
             broker['client'].on_connect = on_connect
             broker['client'].on_disconnect = on_disconnect
             broker['client'].on_message = on_message
+            broker['client'].on_publish = on_publish
             broker['client'].reconnect_delay_set(min_delay=1, max_delay=120)
             broker['client'].connect_async(broker['host'], broker['port'], 10)
             broker['client'].loop_start()
         except Exception as e:
             logging.error(f"Error connecting to MQTT Broker at {broker['host']}:{broker['port']}: {e}")
 
-def get_gps_data():
+def get_gps_data(packet=None):
     """
-    Retrieves the current GPS data packet from GPSD.
+    Converts a GPS data packet to a dictionary. Polls GPSD if no packet is given.
+
+    Args:
+        packet (gpsd.GpsResponse): A packet received from the gpsd stream.
 
     Returns:
         dict: A dictionary containing GPS data such as latitude, longitude, altitude, etc.
@@ -126,29 +258,20 @@ def get_gps_data():
     """
     global fix, gps_error
     try:
-        packet = gpsd.get_current()
+        if packet is None:
+            with metrics.timed(stage_seconds['gpsd']):
+                packet = gpsd.get_current()
         if gps_error:
             logging.info("GPS active")
             gps_error = False
         if packet.mode < 2:  # 2D fix
+            no_fix_total.inc()
             if packet.mode != fix:
                 logging.warning(f"No GPS fix available (Mode: {packet.mode}).")
                 fix = packet.mode
             return None
-        data = {
-            'latitude': packet.lat,
-            'longitude': packet.lon,
-            'altitude': packet.alt,
-            'climb': packet.climb,
-            'speed': packet.hspeed * 3.6,  # Convert m/s to km/h
-            'bearing': packet.track,
-            'time': packet.time,
-            'satellites': packet.sats,
-            'sats_valid': packet.sats_valid,
-            'gps_accuracy': packet.position_precision()[0],
-            'host': hostname
-        }
-        return data
+        fixes_total.inc()
+        return fix_from_packet(packet, hostname)
     except Exception as e:
         if not gps_error:
             logging.error(f"Error getting GPS data: {e}")
@@ -162,25 +285,174 @@ def send_data_to_mqtt(data):
     Args:
         data (dict): The GPS data to send.
     """
+    fix_time = parse_time(data.get('time'))
+    if not math.isnan(fix_time):
+        fix_age.observe(time.time() - fix_time)
+    with metrics.timed(stage_seconds['encode']):
+        payload = json.dumps(data)
+        messages = []
+        if payload_config.get('json_attributes', True):
+            messages.append((config['mqtt_topics']['attributes'].format(combined_id=combined_id), payload))
+        if encode_payload:
+            messages.append((config['mqtt_topics']['binary'].format(combined_id=combined_id), encode_payload(data)))
     for broker in brokers:
         if broker['connected']:
             try:
                 client = broker['client']
-                client.publish(config['mqtt_topics']['attributes'].format(combined_id=combined_id), json.dumps(data))
-                logging.info(f"Data sent to MQTT at {broker['host']}:{broker['port']}")
+                rc = mqtt.MQTT_ERR_SUCCESS
+                with metrics.timed(stage_seconds['publish']):
+                    for topic, message in messages:
+                        started = time.perf_counter()
+                        info = client.publish(topic, message)
+                        publish_tracker.sent(client, info.mid, started)
+                        if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                            rc = info.rc
+                if rc == mqtt.MQTT_ERR_SUCCESS:
+                    logging.info(f"Data sent to MQTT at {broker['host']}:{broker['port']}")
+                    continue
+                logging.error(f"Error sending data to MQTT at {broker['host']}:{broker['port']}: {mqtt.error_string(rc)}")
             except Exception as e:
                 logging.error(f"Error sending data to MQTT at {broker['host']}:{broker['port']}: {e}")
+            publish_errors.inc()
+        # With batching the fixes are spooled by send_batch_to_mqtt
+        if broker.get('spool') and not batcher:
+            broker['spool'].append(payload.encode('utf-8'))
+
+def send_batch_to_mqtt(batch, fixes):
+    """
+    Sends a batch of fixes to all connected MQTT brokers. The fixes are
+    spooled for the brokers that are disconnected or fail the publish.
+
+    Args:
+        batch (dict): The columnar batch from FixBatcher.
+        fixes (list): The fixes of the batch.
+    """
+    payload = json.dumps(batch, separators=(',', ':'))
+    topic = config['mqtt_topics']['batch'].format(combined_id=combined_id)
+    for broker in brokers:
+        if broker['connected']:
+            try:
+                info = broker['client'].publish(topic, payload)
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    logging.info(f"Batch of {len(batch['dt'])} fixes sent to MQTT at {broker['host']}:{broker['port']}")
+                    continue
+                logging.error(f"Error sending batch to MQTT at {broker['host']}:{broker['port']}: {mqtt.error_string(info.rc)}")
+            except Exception as e:
+                logging.error(f"Error sending batch to MQTT at {broker['host']}:{broker['port']}: {e}")
+            publish_errors.inc()
+        if broker.get('spool'):
+            for data in fixes:
+                broker['spool'].append(json.dumps(data).encode('utf-8'))
+
+def flush_batch(force=False):
+    """
+    Publishes the pending batch and the latest state if the batch deadline
+    has passed.
+
+    Args:
+        force (bool): Publish the pending batch regardless of the deadline.
+    """
+    if batcher and (force or batcher.due()):
+        latest = batcher.latest()
+        batch = batcher.flush()
+        if batch:
+            send_batch_to_mqtt(batch, batcher.flushed)
+            publish_state(latest)
+
+def publish_diagnostics():
+    """
+    Publishes a snapshot of the metrics to the diagnostics topic every
+    metrics.diagnostics_interval seconds, if the interval is set.
+    """
+    global last_diagnostics
+    interval = metrics_config.get('diagnostics_interval', 0)
+    if not interval or time.monotonic() - last_diagnostics < interval:
+        return
+    last_diagnostics = time.monotonic()
+    topic = config['mqtt_topics']['diagnostics'].format(combined_id=combined_id)
+    payload = json.dumps(metrics.REGISTRY.snapshot())
+    for broker in brokers:
+        if broker['connected']:
+            try:
+                broker['client'].publish(topic, payload)
+            except Exception as e:
+                logging.error(f"Error sending diagnostics to MQTT at {broker['host']}:{broker['port']}: {e}")
+
+def process_gps_data(gps_data):
+    """
+    Publishes one GPS data dictionary, or adds it to the pending batch.
+
+    Args:
+        gps_data (dict): The GPS data to publish.
+    """
+    if kalman:
+        kalman.apply(gps_data)
+    if triplog:
+        try:
+            triplog.append(gps_data)
+        except OSError as e:
+            logging.error(f"Error writing trip log: {e}")
+    if batcher:
+        batch = batcher.add(gps_data)
+        if batch is None:
+            return
+        send_batch_to_mqtt(batch, batcher.flushed)
+    publish_state(gps_data)
+
+def publish_state(gps_data):
+    """
+    Publishes the latest state unless the deadband filter skips it.
+
+    Args:
+        gps_data (dict): The GPS data to publish.
+    """
+    if deadband and not deadband.should_publish(gps_data):
+        logging.debug(f"Skipping predictable fix: {gps_data}")
+        return
+    logging.info(f"Sending data: {gps_data}")
+    send_data_to_mqtt(gps_data)
+
+def stream_gps_data():
+    """
+    Publishes every fix from the gpsd JSON stream as soon as it arrives.
+    Reconnects to gpsd if the stream fails.
+    """
+    global gps_error
+    stream_config = config['gps_stream']
+    stream = GpsStream(stream_config.get('host', '127.0.0.1'), stream_config.get('port', 2947),
+                       stream_config.get('decimation', 1), stream_config.get('min_interval', 0))
+    while True:
+        try:
+            stream.connect()
+            for packet in stream:
+                gps_data = get_gps_data(packet)
+                if gps_data:
+                    process_gps_data(gps_data)
+                flush_batch()
+                publish_diagnostics()
+        except OSError as e:
+            if not gps_error:
+                logging.error(f"Error reading gpsd stream: {e}")
+                gps_error = True
+            stream.close()
+            time.sleep(1)
 
 def signal_handler(sig, frame):
     """
     Handles graceful shutdown on receiving SIGINT or SIGTERM signals.
     """
     logging.info('Graceful shutdown initiated...')
+    flush_batch(force=True)
+    discovery.close()
+    if triplog:
+        triplog.close()
     for broker in brokers:
         try:
             if broker['client']:
                 broker['client'].disconnect()
                 broker['client'].loop_stop()
+            if broker.get('spool'):
+                broker['spool'].close()
         except Exception as e:
             logging.error(f"Error during shutdown: {e}")
     sys.exit(0)
@@ -193,6 +465,13 @@ def main():
 
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
+    profiler_config = config.get('profiler', {})
+    if profiler_config.get('enabled'):
+        SignalProfiler(profiler_config.get('directory', 'profiles'), profiler_config.get('duration', 30),
+                       profiler_config.get('interval', 0.01)).install()
+
+    if metrics_config.get('enabled'):
+        metrics.start_http_server(metrics_config.get('port', 9101), metrics_config.get('host', '0.0.0.0'))
 
     # Connect to all brokers
     connect_to_brokers()
@@ -201,14 +480,18 @@ def main():
     while not any(broker['connected'] for broker in brokers):
         time.sleep(1)
 
+    if config.get('gps_stream', {}).get('enabled'):
+        stream_gps_data()
+
     # Connect to the local gpsd
     gpsd.connect()
 
     while True:
         gps_data = get_gps_data()
         if gps_data:
-            logging.info(f"Sending data: {gps_data}")
-            send_data_to_mqtt(gps_data)
+            process_gps_data(gps_data)
+        flush_batch()
+        publish_diagnostics()
         time.sleep(config['sleep_interval'])  # Send data every interval specified in config
 
 if __name__ == "__main__":
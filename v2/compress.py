@@ -0,0 +1,85 @@
+import logging
+import math
+import time
+
+EARTH_RADIUS = 6371000  # metres
+
+
+def distance(lat1, lon1, lat2, lon2):
+    """
+    Returns the haversine distance in metres between two positions.
+    """
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def dead_reckon(latitude, longitude, speed, bearing, seconds):
+    """
+    Predicts a position after travelling seconds at speed (km/h) and bearing (degrees).
+    """
+    travelled = speed / 3.6 * seconds
+    north = travelled * math.cos(math.radians(bearing))
+    east = travelled * math.sin(math.radians(bearing))
+    return (latitude + math.degrees(north / EARTH_RADIUS),
+            longitude + math.degrees(east / (EARTH_RADIUS * math.cos(math.radians(latitude)))))
+
+
+class DeadbandFilter:
+    """
+    Decides which fixes to publish. A fix is published only if the position
+    dead reckoned from the last published fix is off by more than max_error
+    metres, or if heartbeat seconds have passed since the last published fix.
+
+    Args:
+        max_error (float): Allowed prediction error in metres.
+        heartbeat (float): Max seconds between published fixes.
+    """
+
+    def __init__(self, max_error=10, heartbeat=60):
+        self.max_error = max_error
+        self.heartbeat = heartbeat
+        self.received = 0
+        self.published = 0
+        self._last = None
+        self._last_time = 0
+
+    def should_publish(self, data, now=None):
+        """
+        Checks whether a fix needs to be published and remembers it if so.
+
+        Args:
+            data (dict): The GPS data, with latitude, longitude, speed and bearing.
+            now (float): Monotonic time of the fix, defaults to time.monotonic().
+
+        Returns:
+            bool: True if the fix should be published.
+        """
+        if now is None:
+            now = time.monotonic()
+        self.received += 1
+
+        publish = self._last is None or now - self._last_time >= self.heartbeat
+        if not publish:
+            latitude, longitude = dead_reckon(self._last['latitude'], self._last['longitude'],
+                                              self._last['speed'] or 0, self._last['bearing'] or 0,
+                                              now - self._last_time)
+            error = distance(latitude, longitude, data['latitude'], data['longitude'])
+            publish = error > self.max_error
+            if publish:
+                logging.debug(f"Prediction off by {error:.1f} m, publishing")
+        elif self._last is not None:
+            logging.info(f"Compression: {self.received} fixes, {self.published} published ({self.ratio():.1f}:1)")
+
+        if publish:
+            self.published += 1
+            self._last = data
+            self._last_time = now
+        return publish
+
+    def ratio(self):
+        """
+        Returns received fixes per published fix.
+        """
+        return self.received / self.published if self.published else 0
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+
+import metrics
+
+# Fix field: (name, unit, device class, state class) of its Home Assistant sensor
+SENSORS = {
+    'speed': ('Speed', 'km/h', 'speed', 'measurement'),
+    'altitude': ('Altitude', 'm', 'distance', 'measurement'),
+    'climb': ('Climb', 'm/s', 'speed', 'measurement'),
+    'bearing': ('Bearing', '°', None, 'measurement'),
+    'satellites': ('Satellites', None, None, 'measurement'),
+    'gps_accuracy': ('GPS accuracy', 'm', 'distance', 'measurement')
+}
+
+published_total = metrics.counter('discovery_publishes', 'Home Assistant discovery configs published')
+skipped_total = metrics.counter('discovery_skipped', 'Discovery republishes skipped as unchanged or duplicate')
+
+
+def device_configs(device_id, topics, name=None, sensors=True, prefix='homeassistant'):
+    """
+    Builds the Home Assistant discovery configs of a device: a device tracker
+    and a sensor per fix field, all reading the attributes topic.
+
+    Args:
+        device_id (str): Device id, the combined id of the topics.
+        topics (dict): Topic name to topic of this device.
+        name (str): Device name, defaults to "GPS Module <device id>".
+        sensors (bool): Include the sensors.
+        prefix (str): Discovery prefix of Home Assistant.
+
+    Returns:
+        dict: Discovery topic to serialized config.
+    """
+    name = name or f"GPS Module {device_id}"
+    device = {"identifiers": [f"gps-module-{device_id}"], "name": name, "model": "gps2mqtt"}
+    configs = {
+        f"{prefix}/device_tracker/gps_module_{device_id}/config": {
+            "state_topic": topics['state'],
+            "name": name,
+            "json_attributes_topic": topics['attributes'],
+            "unique_id": f"gps-module-{device_id}",
+            "friendly_name": name,
+            "device": device
+        }
+    }
+    if sensors:
+        for field, (sensor_name, unit, device_class, state_class) in SENSORS.items():
+            config = {
+                "state_topic": topics['attributes'],
+                "value_template": f"{{{{ value_json.{field} }}}}",
+                "name": sensor_name,
+                "unique_id": f"gps-module-{device_id}-{field}",
+                "object_id": f"gps_module_{device_id}_{field}",
+                "state_class": state_class,
+                "device": device
+            }
+            if unit:
+                config["unit_of_measurement"] = unit
+            if device_class:
+                config["device_class"] = device_class
+            configs[f"{prefix}/sensor/gps_module_{device_id}_{field}/config"] = config
+    return {topic: json.dumps(config, sort_keys=True, separators=(',', ':')) for topic, config in configs.items()}
+
+
+class DiscoveryManager:
+    """
+    Publishes the retained Home Assistant discovery configs of any number of
+    devices. The configs are serialized once per device and remembered by
+    their hash per broker, so a reconnect publishes only configs that changed,
+    and a Home Assistant birth message republishes all configs to the broker
+    it came from, once. Publishes are delayed by a random jitter, so a fleet
+    restarted with Home Assistant does not publish at the same moment, and a
+    background thread publishes at most rate configs per second.
+
+    Args:
+        prefix (str): Discovery prefix of Home Assistant.
+        sensors (bool): Publish a sensor per fix field besides the device tracker.
+        rate (float): Max configs published per second.
+        jitter (float): Max seconds a republish after a birth message is delayed.
+    """
+
+    def __init__(self, prefix='homeassistant', sensors=True, rate=10, jitter=10):
+        self.prefix = prefix
+        self.sensors = sensors
+        self.rate = rate
+        self.jitter = jitter
+        self._configs = {}  # topic: (payload, hash)
+        self._clients = set()
+        self._published = {}  # (client, topic): hash of the retained config
+        self._due = {}  # (client, topic): monotonic time
+        self._births = {}  # client: monotonic time of the last birth message
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='discovery', daemon=True)
+        self._thread.start()
+
+    def add_device(self, device_id, topics, name=None):
+        """
+        Sets the configs of a device. Configs that differ from the ones
+        published are published to the connected brokers.
+        """
+        configs = device_configs(device_id, topics, name, self.sensors, self.prefix)
+        with self._condition:
+            for topic, payload in configs.items():
+                self._configs[topic] = (payload, hashlib.sha1(payload.encode('utf-8')).hexdigest())
+            self._schedule(self._clients, configs, 0)
+
+    def connected(self, client):
+        """
+        Call from on_connect. Publishes the configs not yet retained by the broker.
+        """
+        with self._condition:
+            self._clients.add(client)
+            self._schedule([client], self._configs, 1)
+
+    def disconnected(self, client):
+        """
+        Call from on_disconnect.
+        """
+        with self._condition:
+            self._clients.discard(client)
+            for key in [key for key in self._due if key[0] is client]:
+                del self._due[key]
+
+    def birth(self, client):
+        """
+        Call when Home Assistant publishes 'online' on the status topic of a
+        broker. Republishes all configs to that broker, birth messages within
+        jitter seconds of the previous one are ignored.
+        """
+        now = time.monotonic()
+        with self._condition:
+            if now - self._births.get(client, -self.jitter) < self.jitter:
+                skipped_total.inc(len(self._configs))
+                return
+            self._births[client] = now
+            for topic in self._configs:
+                self._published.pop((client, topic), None)
+            self._schedule([client], self._configs, self.jitter)
+
+    def _schedule(self, clients, topics, jitter):
+        # Makes changed configs due for the clients, with the lock held
+        now = time.monotonic()
+        for client in clients:
+            delay = random.uniform(0, jitter)
+            for topic in topics:
+                key = (client, topic)
+                if self._published.get(key) == self._configs[topic][1]:
+                    skipped_total.inc()
+                    continue
+                self._due[key] = min(self._due.get(key, now + delay), now + delay)
+        self._condition.notify()
+
+    def _run(self):
+        interval = 1 / self.rate
+        while True:
+            with self._condition:
+                while True:
+                    if self._closed:
+                        return
+                    now = time.monotonic()
+                    wait = min(self._due.values()) - now if self._due else None
+                    if wait is not None and wait <= 0:
+                        break
+                    self._condition.wait(wait)
+                key = min(self._due, key=self._due.get)
+                del self._due[key]
+                client, topic = key
+                payload, digest = self._configs[topic]
+            try:
+                info = client.publish(topic, payload, retain=True)
+                if info.rc == 0:
+                    with self._condition:
+                        self._published[key] = digest
+                    published_total.inc()
+                    logging.debug(f"Published discovery config to {topic}")
+                else:
+                    logging.warning(f"Discovery config to {topic} not published, return code {info.rc}")
+            except Exception as e:
+                logging.error(f"Error publishing discovery config to {topic}: {e}")
+            time.sleep(interval)
+
+    def pending(self):
+        return len(self._due)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join(1)
@@ -0,0 +1,364 @@
+import asyncio
+import json
+import logging
+import random
+import signal
+import time
+
+import paho.mqtt.client as mqtt
+
+from batch import FixBatcher
+from compress import DeadbandFilter
+from discovery import DiscoveryManager
+from gps_stream import WATCH_COMMAND, ReportAssembler
+from kalman import KalmanFilter
+import metrics
+from payload import fix_from_packet, get_codec
+from profiler import SignalProfiler
+from settings import brokers
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s [%(funcName)s:%(lineno)d]')
+
+packet_errors = metrics.counter('gateway_packet_errors', 'Reports dropped after an error handling them')
+
+
+class Source:
+    """
+    State of one gpsd endpoint. Slots keep the memory per source small and
+    flat, so a gateway can serve hundreds of sources.
+
+    Args:
+        source_id (str): Device id used in the topics and discovery.
+        host (str): gpsd host.
+        port (int): gpsd port.
+        assembler (ReportAssembler): Turns the report lines into fixes.
+        topics (dict): Topic name to topic of this device.
+        deadband (DeadbandFilter): Optional filter of predictable fixes.
+        batcher (FixBatcher): Optional batcher of high rate fixes.
+        kalman (KalmanFilter): Optional filter of speed and bearing.
+    """
+
+    __slots__ = ('id', 'host', 'port', 'assembler', 'topics', 'deadband', 'batcher', 'kalman',
+                 'connected', 'fix', 'error', 'fixes')
+
+    def __init__(self, source_id, host, port, assembler, topics, deadband=None, batcher=None, kalman=None):
+        self.id = source_id
+        self.host = host
+        self.port = port
+        self.assembler = assembler
+        self.topics = topics
+        self.deadband = deadband
+        self.batcher = batcher
+        self.kalman = kalman
+        self.connected = False
+        self.fix = 0
+        self.error = False
+        self.fixes = 0
+
+
+class Gateway:
+    """
+    Reads fixes from many gpsd endpoints on one asyncio event loop and
+    publishes them to per-device topics, sharing one MQTT connection per broker.
+
+    Args:
+        config (dict): The configuration with a gateway section.
+        brokers (list): The brokers from settings.py.
+    """
+
+    def __init__(self, config, brokers):
+        self.config = config
+        self.gateway_config = config.get('gateway', {})
+        self.brokers = brokers
+        self.sources = {}
+        discovery_config = config.get('discovery', {})
+        self.discovery = DiscoveryManager(discovery_config.get('prefix', 'homeassistant'),
+                                          discovery_config.get('sensors', True), discovery_config.get('rate', 10),
+                                          discovery_config.get('jitter', 10))
+        payload_config = config.get('payload', {})
+        self.json_attributes = payload_config.get('json_attributes', True)
+        self.encode_payload = None
+        if payload_config.get('encoding'):
+            self.encode_payload = get_codec(payload_config['encoding'])[0]
+        for source_config in self.gateway_config.get('sources', []):
+            self.add_source(source_config)
+        self._stop = None
+
+    def add_source(self, source_config):
+        """
+        Adds a gpsd endpoint.
+
+        Args:
+            source_config (dict): id, host and port, optionally decimation and
+                min_interval overriding the gateway defaults.
+
+        Raises:
+            ValueError: If a source with the same id already exists.
+        """
+        source_id = source_config['id']
+        if source_id in self.sources:
+            raise ValueError(f"Duplicate gateway source id '{source_id}'")
+        assembler = ReportAssembler(
+            source_config.get('decimation', self.gateway_config.get('decimation', 1)),
+            source_config.get('min_interval', self.gateway_config.get('min_interval', 0)))
+        topics = {name: topic.format(combined_id=source_id) for name, topic in self.config['mqtt_topics'].items()}
+        compression_config = self.config.get('compression', {})
+        deadband = None
+        if compression_config.get('enabled'):
+            deadband = DeadbandFilter(compression_config.get('max_error', 10), compression_config.get('heartbeat', 60))
+        batch_config = self.config.get('batch', {})
+        batcher = None
+        if batch_config.get('enabled'):
+            batcher = FixBatcher(batch_config.get('max_fixes', 50), batch_config.get('max_delay', 5))
+        kalman_config = self.config.get('kalman', {})
+        kalman = None
+        if kalman_config.get('enabled'):
+            kalman = KalmanFilter(kalman_config.get('acceleration', 1.0), min_speed=kalman_config.get('min_speed', 1.0),
+                                  max_gap=kalman_config.get('max_gap', 10))
+        self.sources[source_id] = Source(source_id, source_config.get('host', '127.0.0.1'),
+                                         source_config.get('port', 2947), assembler, topics, deadband, batcher,
+                                         kalman)
+        self.discovery.add_device(source_id, topics)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties=None):
+        """
+        The callback function for when the client receives a CONNACK response from the server.
+        """
+        if reason_code == 0:
+            logging.info(f"Connected to MQTT Broker at {client._host}:{client._port}")
+            for broker in self.brokers:
+                if broker['client'] == client:
+                    broker['connected'] = True
+                    client.subscribe(self.config['mqtt_topics']['homeassistant_status'])
+                    self.discovery.connected(client)
+                    break
+        else:
+            logging.error(f"Failed to connect to MQTT Broker at {client._host}:{client._port}, return code {reason_code}")
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties=None):
+        """
+        The callback function for when the client disconnects from the broker.
+        """
+        logging.warning(f"Disconnected from MQTT Broker at {client._host}:{client._port}.")
+        self.discovery.disconnected(client)
+        for broker in self.brokers:
+            if broker['client'] == client:
+                broker['connected'] = False
+                break
+
+    def on_message(self, client, userdata, msg, properties=None):
+        """
+        The callback function for when a PUBLISH message is received from the server.
+        Republishes the discovery when Home Assistant comes online.
+        """
+        if msg.topic == self.config['mqtt_topics']['homeassistant_status'] and msg.payload.decode() == "online":
+            logging.info("Received 'online' message, republishing discovery configuration")
+            self.discovery.birth(client)
+
+    def connect_to_brokers(self):
+        """
+        Connects to all MQTT brokers specified in the settings, one client per broker.
+        """
+        for broker in self.brokers:
+            try:
+                broker['client'] = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+                broker['client'].on_connect = self.on_connect
+                broker['client'].on_disconnect = self.on_disconnect
+                broker['client'].on_message = self.on_message
+                broker['client'].reconnect_delay_set(min_delay=1, max_delay=120)
+                broker['client'].connect_async(broker['host'], broker['port'], 10)
+                broker['client'].loop_start()
+            except Exception as e:
+                logging.error(f"Error connecting to MQTT Broker at {broker['host']}:{broker['port']}: {e}")
+
+    def disconnect_brokers(self):
+        self.discovery.close()
+        for broker in self.brokers:
+            try:
+                if broker['client']:
+                    broker['client'].disconnect()
+                    broker['client'].loop_stop()
+            except Exception as e:
+                logging.error(f"Error during shutdown: {e}")
+
+    def publish(self, source, messages):
+        """
+        Publishes (topic, payload) pairs of a source to all connected brokers.
+        """
+        for broker in self.brokers:
+            if broker['connected']:
+                try:
+                    for topic, message in messages:
+                        broker['client'].publish(topic, message)
+                except Exception as e:
+                    logging.error(f"Error sending data of {source.id} to MQTT at {broker['host']}:{broker['port']}: {e}")
+
+    def publish_state(self, source, data):
+        if source.deadband and not source.deadband.should_publish(data):
+            return
+        messages = []
+        if self.json_attributes:
+            messages.append((source.topics['attributes'], json.dumps(data)))
+        if self.encode_payload:
+            messages.append((source.topics['binary'], self.encode_payload(data)))
+        self.publish(source, messages)
+
+    def publish_batch(self, source, batch):
+        self.publish(source, [(source.topics['batch'], json.dumps(batch, separators=(',', ':')))])
+
+    def handle_packet(self, source, packet):
+        """
+        Publishes one fix of a source, or adds it to the pending batch.
+
+        Args:
+            source (Source): The source the fix came from.
+            packet (gpsd.GpsResponse): The fix.
+        """
+        if packet.mode < 2:
+            if packet.mode != source.fix:
+                logging.warning(f"No GPS fix available from {source.id} (Mode: {packet.mode}).")
+                source.fix = packet.mode
+            return
+        source.fix = packet.mode
+        try:
+            data = fix_from_packet(packet, source.id)
+        except Exception as e:
+            logging.debug(f"Error getting GPS data from {source.id}: {e}")
+            return
+        source.fixes += 1
+        if source.kalman:
+            source.kalman.apply(data)
+        if source.batcher:
+            batch = source.batcher.add(data)
+            if batch is None:
+                return
+            self.publish_batch(source, batch)
+        self.publish_state(source, data)
+
+    def flush_batches(self, force=False):
+        """
+        Publishes the pending batches whose deadline has passed.
+
+        Args:
+            force (bool): Publish all pending batches regardless of the deadline.
+        """
+        for source in self.sources.values():
+            if source.batcher and (force or source.batcher.due()):
+                latest = source.batcher.latest()
+                batch = source.batcher.flush()
+                if batch:
+                    self.publish_batch(source, batch)
+                    self.publish_state(source, latest)
+
+    async def read_source(self, source):
+        """
+        Reads the JSON watch stream of a source, reconnecting with backoff
+        when the connection fails or goes silent.
+        """
+        timeout = self.gateway_config.get('timeout', 30)
+        max_delay = self.gateway_config.get('max_reconnect_delay', 60)
+        delay = 1
+        # Spread the connects of a restarted gateway
+        await asyncio.sleep(random.uniform(0, 1))
+        while True:
+            writer = None
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(source.host, source.port), timeout)
+                writer.write(WATCH_COMMAND)
+                await writer.drain()
+                logging.debug(f"Connected to gpsd of {source.id} at {source.host}:{source.port}")
+                source.connected = True
+                source.error = False
+                delay = 1
+                failed = False
+                while True:
+                    line = await asyncio.wait_for(reader.readline(), timeout)
+                    if not line:
+                        raise ConnectionError("gpsd closed the connection")
+                    try:
+                        packet = source.assembler.feed(line.decode('utf-8', 'replace'))
+                        if packet is not None:
+                            self.handle_packet(source, packet)
+                    except Exception:
+                        # Drop the report and keep the connection, log once per connection
+                        packet_errors.inc()
+                        if not failed:
+                            logging.exception(f"Error handling a report of {source.id}: {line!r}")
+                            failed = True
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                # ValueError if a line exceeds the stream buffer limit
+                if not source.error:
+                    logging.error(f"Error reading gpsd of {source.id} at {source.host}:{source.port}: {e!r}")
+                    source.error = True
+            finally:
+                source.connected = False
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            delay = min(delay * 2, max_delay)
+
+    async def housekeeping(self):
+        """
+        Flushes due batches every second and logs the gateway throughput.
+        """
+        interval = self.gateway_config.get('stats_interval', 60)
+        fixes = 0
+        started = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            self.flush_batches()
+            now = time.monotonic()
+            if now - started >= interval:
+                total = sum(source.fixes for source in self.sources.values())
+                connected = sum(source.connected for source in self.sources.values())
+                logging.info(f"{connected}/{len(self.sources)} sources connected, "
+                             f"{(total - fixes) / (now - started):.1f} fixes/s")
+                fixes = total
+                started = now
+
+    async def run(self):
+        """
+        Serves all sources until SIGINT or SIGTERM.
+        """
+        self._stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self._stop.set)
+        tasks = [asyncio.create_task(self.read_source(source)) for source in self.sources.values()]
+        tasks.append(asyncio.create_task(self.housekeeping()))
+        await self._stop.wait()
+        logging.info('Graceful shutdown initiated...')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.flush_batches(force=True)
+
+
+def main():
+    """
+    Starts the gateway with the sources of config.json.
+    """
+    with open("config.json", "r") as config_file:
+        config = json.load(config_file)
+    gateway = Gateway(config, brokers)
+    if not gateway.sources:
+        logging.error("No sources in the gateway section of config.json")
+        return
+    logging.info(f"Starting GPS to MQTT gateway for {len(gateway.sources)} sources")
+    profiler_config = config.get('profiler', {})
+    if profiler_config.get('enabled'):
+        SignalProfiler(profiler_config.get('directory', 'profiles'), profiler_config.get('duration', 30),
+                       profiler_config.get('interval', 0.01)).install()
+
+    gateway.connect_to_brokers()
+
+    # Wait for at least one MQTT connection
+    while not any(broker['connected'] for broker in brokers):
+        time.sleep(1)
+
+    asyncio.run(gateway.run())
+    gateway.disconnect_brokers()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import math
+from collections import namedtuple
+from datetime import datetime
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+EARTH_RADIUS = 6371000  # metres
+METRES_PER_DEGREE = EARTH_RADIUS * math.pi / 180
+
+State = namedtuple('State', 'latitude longitude speed heading speed_error')
+
+
+def _seconds(value):
+    # Fix time as seconds since epoch, from gpsd ISO 8601 time or seconds
+    if isinstance(value, str):
+        return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+    return float(value)
+
+
+def _process_noise(dt, variance):
+    # Covariance of a white acceleration over dt for one axis: position, velocity
+    return (variance * dt ** 4 / 4, variance * dt ** 3 / 2, variance * dt ** 2)
+
+
+class KalmanFilter:
+    """
+    Constant velocity Kalman filter of a position in a local east/north
+    frame in metres. The state is east, north and their velocities, and the
+    measurements are the positions of the fixes. The gpsd error estimate of
+    a fix, position_precision()[0], is a 95 % bound, so half of it is used as
+    the standard deviation of the measurement.
+
+    Speed and heading come from the filtered velocity, so they do not jump
+    with the noise of single fixes. Below min_speed the heading is held,
+    because the direction of a near zero velocity is noise.
+
+    Args:
+        acceleration (float): Standard deviation of the acceleration in m/s²,
+            how quickly the velocity may change.
+        default_error (float): 95 % position error in metres used when a fix has none.
+        min_speed (float): Speed in m/s below which the heading is held.
+        max_gap (float): Seconds without fixes after which the filter restarts.
+        gate (float): Fixes further than gate standard deviations from the
+            prediction are ignored, unless max_rejects in a row are.
+        max_rejects (int): Rejected fixes in a row that restart the filter.
+    """
+
+    def __init__(self, acceleration=1.0, default_error=10, min_speed=1.0, max_gap=10, gate=5, max_rejects=3):
+        self.acceleration = acceleration
+        self.default_error = default_error
+        self.min_speed = min_speed
+        self.max_gap = max_gap
+        self.gate = gate
+        self.max_rejects = max_rejects
+        self.rejected = 0
+        self.resets = 0
+        self._rejects = 0
+        self._time = None
+        self._origin = None
+        self._x = [0.0, 0.0, 0.0, 0.0]  # east, north, east velocity, north velocity
+        self._p = None  # 4 x 4 covariance
+        self._heading = 0.0
+
+    def _to_local(self, latitude, longitude):
+        lat0, lon0 = self._origin
+        return ((longitude - lon0) * METRES_PER_DEGREE * math.cos(math.radians(lat0)),
+                (latitude - lat0) * METRES_PER_DEGREE)
+
+    def _to_global(self, east, north):
+        lat0, lon0 = self._origin
+        return (lat0 + north / METRES_PER_DEGREE,
+                lon0 + east / (METRES_PER_DEGREE * math.cos(math.radians(lat0))))
+
+    def _shift_origin(self):
+        # Moves the local frame to the filtered position, the velocity and
+        # the covariance stay as they are in metres
+        self._origin = self._to_global(self._x[0], self._x[1])
+        self._x[0] = self._x[1] = 0.0
+
+    def reset(self, t, latitude, longitude, variance):
+        self._time = t
+        self._origin = (latitude, longitude)
+        self._x = [0.0, 0.0, 0.0, 0.0]
+        # Unknown velocity, up to about 30 m/s
+        self._p = [[variance, 0, 0, 0], [0, variance, 0, 0], [0, 0, 900.0, 0], [0, 0, 0, 900.0]]
+        self._rejects = 0
+
+    def _predict(self, dt):
+        x, p = self._x, self._p
+        x[0] += dt * x[2]
+        x[1] += dt * x[3]
+        # P = F P F' + Q with F = [[I, dt I], [0, I]]
+        for i in (0, 1):
+            p[i] = [p[i][k] + dt * p[i + 2][k] for k in range(4)]
+        for row in p:
+            row[0] += dt * row[2]
+            row[1] += dt * row[3]
+        q_pp, q_pv, q_vv = _process_noise(dt, self.acceleration ** 2)
+        for i in (0, 1):
+            p[i][i] += q_pp
+            p[i][i + 2] += q_pv
+            p[i + 2][i] += q_pv
+            p[i + 2][i + 2] += q_vv
+
+    def _correct(self, east, north, variance):
+        x, p = self._x, self._p
+        # Innovation and its covariance S = H P H' + R with H = [I 0]
+        y0 = east - x[0]
+        y1 = north - x[1]
+        s00 = p[0][0] + variance
+        s01 = p[0][1]
+        s10 = p[1][0]
+        s11 = p[1][1] + variance
+        determinant = s00 * s11 - s01 * s10
+        i00, i01, i10, i11 = s11 / determinant, -s01 / determinant, -s10 / determinant, s00 / determinant
+        distance = y0 * (i00 * y0 + i01 * y1) + y1 * (i10 * y0 + i11 * y1)
+        if distance > self.gate ** 2:
+            return False
+        # K = P H' S^-1, x += K y, P -= K H P
+        gain = [(row[0] * i00 + row[1] * i10, row[0] * i01 + row[1] * i11) for row in p]
+        for i in range(4):
+            x[i] += gain[i][0] * y0 + gain[i][1] * y1
+        top = [list(p[0]), list(p[1])]
+        for i in range(4):
+            for k in range(4):
+                p[i][k] -= gain[i][0] * top[0][k] + gain[i][1] * top[1][k]
+        return True
+
+    def update(self, t, latitude, longitude, error=None):
+        """
+        Adds a fix.
+
+        Args:
+            t (float or str): Fix time, seconds since epoch or ISO 8601.
+            error (float): 95 % horizontal error of the fix in metres.
+
+        Returns:
+            State: Filtered position, speed in km/h, heading in degrees and
+            the standard deviation of the speed in km/h.
+        """
+        t = _seconds(t)
+        variance = (max(error or self.default_error, 1.0) / 2) ** 2
+        dt = None if self._time is None else t - self._time
+        if dt is None or dt > self.max_gap or dt < 0:
+            # Restart on the first fix and after a gap
+            if dt is not None:
+                self.resets += 1
+            self.reset(t, latitude, longitude, variance)
+        else:
+            if abs(latitude - self._origin[0]) > 0.1 or abs(longitude - self._origin[1]) > 0.2:
+                # Keep the local frame small, so east/north metres stay accurate
+                self._shift_origin()
+            if dt > 0:
+                self._predict(dt)
+                self._time = t
+            east, north = self._to_local(latitude, longitude)
+            if self._correct(east, north, variance):
+                self._rejects = 0
+            else:
+                self.rejected += 1
+                self._rejects += 1
+                if self._rejects >= self.max_rejects:
+                    self.resets += 1
+                    self.reset(t, latitude, longitude, variance)
+        return self.state()
+
+    def state(self):
+        east, north, east_velocity, north_velocity = self._x
+        speed = math.hypot(east_velocity, north_velocity)
+        if speed >= self.min_speed:
+            self._heading = math.degrees(math.atan2(east_velocity, north_velocity)) % 360
+        latitude, longitude = self._to_global(east, north)
+        # Speed variance along the direction of travel
+        if speed > 0:
+            u0, u1 = east_velocity / speed, north_velocity / speed
+            variance = u0 * u0 * self._p[2][2] + 2 * u0 * u1 * self._p[2][3] + u1 * u1 * self._p[3][3]
+        else:
+            variance = (self._p[2][2] + self._p[3][3]) / 2
+        return State(latitude, longitude, speed * 3.6, self._heading, math.sqrt(max(variance, 0)) * 3.6)
+
+    def apply(self, fix):
+        """
+        Filters a fix dictionary with time, latitude, longitude and
+        gps_accuracy in place: speed and bearing are replaced with the
+        filtered ones. The position is left as measured.
+
+        Returns:
+            dict: The fix.
+        """
+        try:
+            state = self.update(fix['time'], fix['latitude'], fix['longitude'], fix.get('gps_accuracy'))
+        except (KeyError, TypeError, ValueError):
+            return fix
+        fix['speed'] = round(state.speed, 2)
+        fix['bearing'] = round(state.heading, 1)
+        return fix
+
+
+def filter_tracks(times, latitudes, longitudes, errors=None, acceleration=1.0, default_error=10,
+                  smooth=False):
+    """
+    Filters many tracks at once with NumPy, for offline traces. Each row is
+    one track and all tracks are stepped together, so the cost per fix falls
+    with the number of tracks. Missing fixes are NaN; the state is then only
+    predicted. With smooth the Rauch-Tung-Striebel smoother also uses the
+    later fixes of the track for each estimate.
+
+    Args:
+        times (array): Seconds, shape (tracks, fixes) or (fixes,).
+        latitudes (array): Degrees, same shape.
+        longitudes (array): Degrees, same shape.
+        errors (array): 95 % horizontal errors in metres, same shape, optional.
+        acceleration (float): Standard deviation of the acceleration in m/s².
+        default_error (float): Error used where errors is missing or NaN.
+        smooth (bool): Run the smoother after the filter.
+
+    Returns:
+        dict: latitude, longitude, speed (km/h) and heading (degrees) arrays
+        of the input shape.
+
+    Raises:
+        RuntimeError: If NumPy is not installed.
+    """
+    if np is None:
+        raise RuntimeError("Filtering tracks needs the numpy package")
+    shape = np.shape(latitudes)
+    times = np.atleast_2d(np.asarray(times, dtype=float))
+    latitudes = np.atleast_2d(np.asarray(latitudes, dtype=float))
+    longitudes = np.atleast_2d(np.asarray(longitudes, dtype=float))
+    if errors is None:
+        errors = np.full(latitudes.shape, float(default_error))
+    errors = np.atleast_2d(np.asarray(errors, dtype=float))
+    errors = np.where(np.isnan(errors), default_error, np.maximum(errors, 1.0))
+    tracks, steps = latitudes.shape
+
+    # Local frame around the first valid fix of each track
+    valid = ~np.isnan(latitudes) & ~np.isnan(longitudes)
+    first = np.argmax(valid, axis=1)
+    lat0 = latitudes[np.arange(tracks), first]
+    lon0 = longitudes[np.arange(tracks), first]
+    scale = METRES_PER_DEGREE * np.cos(np.radians(lat0))
+    east = (longitudes - lon0[:, None]) * scale[:, None]
+    north = (latitudes - lat0[:, None]) * METRES_PER_DEGREE
+    variance = (errors / 2) ** 2
+
+    identity = np.eye(4)
+    x = np.zeros((tracks, 4))
+    p = np.tile(np.diag([1e6, 1e6, 900.0, 900.0]), (tracks, 1, 1))
+    started = np.zeros(tracks, dtype=bool)
+    states = np.zeros((steps, tracks, 4))
+    covariances = np.zeros((steps, tracks, 4, 4))
+    predicted_states = np.zeros((steps, tracks, 4))
+    predicted_covariances = np.zeros((steps, tracks, 4, 4))
+    transitions = np.zeros((steps, tracks, 4, 4))
+    q_variance = acceleration ** 2
+    previous = times[:, 0]
+    for step in range(steps):
+        dt = np.where(started, np.nan_to_num(times[:, step] - previous), 0.0)
+        dt = np.maximum(dt, 0.0)
+        f = np.tile(identity, (tracks, 1, 1))
+        f[:, 0, 2] = dt
+        f[:, 1, 3] = dt
+        q = np.zeros((tracks, 4, 4))
+        q_pp, q_pv, q_vv = _process_noise(dt, q_variance)
+        for i in (0, 1):
+            q[:, i, i] = q_pp
+            q[:, i, i + 2] = q_pv
+            q[:, i + 2, i] = q_pv
+            q[:, i + 2, i + 2] = q_vv
+        x = np.einsum('nij,nj->ni', f, x)
+        p = f @ p @ f.transpose(0, 2, 1) + q
+        transitions[step] = f
+        predicted_states[step] = x
+        predicted_covariances[step] = p
+
+        measured = valid[:, step]
+        # Start each track at its first fix
+        starting = measured & ~started
+        x[starting] = 0.0
+        x[starting, 0] = east[starting, step]
+        x[starting, 1] = north[starting, step]
+        p[starting] = np.diag([0.0, 0.0, 900.0, 900.0])
+        p[starting, 0, 0] = variance[starting, step]
+        p[starting, 1, 1] = variance[starting, step]
+        predicted_states[step, starting] = x[starting]
+        predicted_covariances[step, starting] = p[starting]
+        started |= measured
+
+        correcting = measured & ~starting
+        if correcting.any():
+            innovation = np.stack([east[correcting, step], north[correcting, step]], axis=1) - x[correcting, :2]
+            pc = p[correcting]
+            s = pc[:, :2, :2] + variance[correcting, step][:, None, None] * np.eye(2)
+            gain = pc[:, :, :2] @ np.linalg.inv(s)
+            x[correcting] += np.einsum('nij,nj->ni', gain, innovation)
+            p[correcting] = pc - gain @ pc[:, :2, :]
+        # Steps without a position were predicted up to their time
+        previous = np.where(np.isnan(times[:, step]), previous, times[:, step])
+        states[step] = x
+        covariances[step] = p
+
+    if smooth:
+        for step in range(steps - 2, -1, -1):
+            following = predicted_covariances[step + 1]
+            gain = covariances[step] @ transitions[step + 1].transpose(0, 2, 1) @ np.linalg.pinv(following)
+            states[step] += np.einsum('nij,nj->ni', gain, states[step + 1] - predicted_states[step + 1])
+            covariances[step] += gain @ (covariances[step + 1] - following) @ gain.transpose(0, 2, 1)
+
+    states = states.transpose(1, 0, 2)
+    result = {
+        'latitude': lat0[:, None] + states[:, :, 1] / METRES_PER_DEGREE,
+        'longitude': lon0[:, None] + states[:, :, 0] / scale[:, None],
+        'speed': np.hypot(states[:, :, 2], states[:, :, 3]) * 3.6,
+        'heading': np.degrees(np.arctan2(states[:, :, 2], states[:, :, 3])) % 360
+    }
+    return {name: values.reshape(shape) for name, values in result.items()}
@@ -0,0 +1,117 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+
+MAGIC = b'G2MQ'
+VERSION = 1
+# magic, version, slot size, slot count, head sequence, tail sequence, dropped
+HEADER = struct.Struct('<4sHIIQQQ')
+HEADER_SIZE = 64
+LENGTH = struct.Struct('<H')
+
+
+class Spool:
+    """
+    Memory-mapped ring buffer of messages waiting for a broker connection.
+
+    The file is a header followed by fixed size slots, so its size never
+    grows past max_bytes. When the ring is full the oldest message is
+    overwritten. Messages survive restarts.
+
+    Args:
+        path (str): Spool file.
+        max_bytes (int): Size of the slot area in bytes.
+        slot_size (int): Bytes per message slot, including a 2 byte length.
+        flush_every (int): Flush the map to disk every N appends.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, slot_size=512, flush_every=50):
+        self.path = path
+        self.flush_every = flush_every
+        self._lock = threading.Lock()
+        self._appends = 0
+        slots = max(1, max_bytes // slot_size)
+        size = HEADER_SIZE + slots * slot_size
+
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE
+        with open(path, 'r+b' if exists else 'w+b') as f:
+            if exists:
+                header = HEADER.unpack(f.read(HEADER.size))
+                if header[0] != MAGIC or header[2] != slot_size or header[3] != slots:
+                    logging.warning(f"Spool {path} has a different layout, discarding it")
+                    exists = False
+            f.truncate(size)
+            self._map = mmap.mmap(f.fileno(), size)
+
+        self.slot_size = slot_size
+        self.slots = slots
+        if exists:
+            _, _, _, _, self._head, self._tail, self.dropped = HEADER.unpack_from(self._map, 0)
+            if self._tail > self._head:
+                logging.info(f"Spool {path} has {self._tail - self._head} messages waiting")
+        else:
+            self._head = self._tail = self.dropped = 0
+            self._write_header()
+
+    def _write_header(self):
+        HEADER.pack_into(self._map, 0, MAGIC, VERSION, self.slot_size, self.slots,
+                         self._head, self._tail, self.dropped)
+
+    def __len__(self):
+        return self._tail - self._head
+
+    def append(self, payload):
+        """
+        Stores a message, overwriting the oldest one if the ring is full.
+
+        Returns:
+            bool: False if the message does not fit into a slot.
+        """
+        if len(payload) > self.slot_size - LENGTH.size:
+            logging.warning(f"Message of {len(payload)} bytes does not fit spool slot of {self.slot_size}")
+            return False
+        with self._lock:
+            if self._tail - self._head >= self.slots:
+                self._head += 1
+                self.dropped += 1
+            offset = HEADER_SIZE + (self._tail % self.slots) * self.slot_size
+            LENGTH.pack_into(self._map, offset, len(payload))
+            self._map[offset + LENGTH.size:offset + LENGTH.size + len(payload)] = payload
+            self._tail += 1
+            self._write_header()
+            self._appends += 1
+            if self._appends % self.flush_every == 0:
+                self._map.flush()
+        return True
+
+    def peek(self, count):
+        """
+        Returns up to count of the oldest messages without removing them.
+
+        Returns:
+            tuple: Sequence number after the last returned message, for pop(),
+                and the list of messages.
+        """
+        with self._lock:
+            messages = []
+            for sequence in range(self._head, min(self._tail, self._head + count)):
+                offset = HEADER_SIZE + (sequence % self.slots) * self.slot_size
+                length = LENGTH.unpack_from(self._map, offset)[0]
+                messages.append(self._map[offset + LENGTH.size:offset + LENGTH.size + length])
+            return self._head + len(messages), messages
+
+    def pop(self, until):
+        """
+        Removes the messages before sequence number until, as returned by peek().
+        Messages already overwritten are skipped.
+        """
+        with self._lock:
+            self._head = max(self._head, min(self._tail, until))
+            self._write_header()
+
+    def close(self):
+        with self._lock:
+            self._map.flush()
+            self._map.close()
@@ -0,0 +1,64 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batch import BATCH_VERSION, FixBatcher  # noqa: E402
+
+
+def fix(n, milliseconds=0):
+    return {'latitude': 65 + n * 1e-5, 'longitude': 25.5, 'altitude': 12.34, 'speed': 36.06, 'bearing': 90.0,
+            'gps_accuracy': None, 'time': f"2024-06-01T10:00:{n:02d}.{milliseconds:03d}Z", 'host': 'car'}
+
+
+def test_max_fixes():
+    batcher = FixBatcher(max_fixes=3, max_delay=60)
+    assert batcher.add(fix(0), now=0) is None
+    assert batcher.add(fix(1), now=1) is None
+    assert len(batcher) == 2
+    batch = batcher.add(fix(2), now=2)
+    assert len(batch['dt']) == 3
+    assert len(batcher) == 0
+    assert batcher.flush() is None
+
+
+def test_max_delay():
+    batcher = FixBatcher(max_fixes=50, max_delay=5)
+    assert batcher.add(fix(0), now=100) is None
+    assert not batcher.due(now=104.9)
+    assert batcher.due(now=105)
+    # A fix arriving after the deadline completes the batch
+    batch = batcher.add(fix(6), now=106)
+    assert len(batch['dt']) == 2
+    assert not batcher.due(now=1000)
+
+
+def test_time_deltas_in_milliseconds():
+    batcher = FixBatcher(max_fixes=4)
+    for n, milliseconds in ((0, 0), (0, 250), (1, 0), (3, 100)):
+        batch = batcher.add(fix(n, milliseconds), now=0)
+    assert batch['v'] == BATCH_VERSION
+    assert batch['host'] == 'car'
+    assert batch['t0'] == 1717236000000
+    assert batch['dt'] == [0, 250, 750, 2100]
+    assert batch['lat'] == [65.0, 65.0, 65.00001, 65.00003]
+    assert batch['alt'] == [12.3] * 4
+    assert batch['speed'] == [36.1] * 4
+    assert batch['acc'] == [None] * 4
+
+
+def test_flushed_matches_the_batch():
+    batcher = FixBatcher(max_fixes=10)
+    fixes = [fix(n) for n in range(4)]
+    for data in fixes:
+        batcher.add(data, now=0)
+    assert batcher.latest() is fixes[-1]
+    batch = batcher.flush()
+    assert batcher.flushed == fixes
+    assert batch['lat'] == [data['latitude'] for data in batcher.flushed]
+    assert batcher.latest() is None
+
+    batcher.add(fix(9), now=0)
+    batch = batcher.flush()
+    assert batcher.flushed == [fix(9)]
+    assert len(batch['dt']) == 1
@@ -0,0 +1,59 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gateway  # noqa: E402
+
+TOPICS = {
+    'state': 'gps_module/{combined_id}/state',
+    'attributes': 'gps_module/{combined_id}/attributes',
+    'homeassistant_status': 'homeassistant/status'
+}
+
+
+def tpv(n):
+    return json.dumps({"class": "TPV", "mode": 3, "time": f"2024-06-01T10:00:{n:02d}.000Z",
+                       "lat": 65 + n * 1e-4, "lon": 25.5, "speed": 10.0, "track": 0.0}).encode('utf-8') + b'\n'
+
+
+def test_source_survives_an_error_handling_a_report():
+    published = []
+
+    async def serve(reader, writer):
+        await reader.readline()
+        writer.write(tpv(0) + tpv(1) + tpv(2))
+        await writer.drain()
+        await asyncio.sleep(5)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(serve, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        config = {'mqtt_topics': TOPICS, 'discovery': {'rate': 1000},
+                  'gateway': {'sources': [{'id': 'car', 'port': port}], 'timeout': 5}}
+        instance = gateway.Gateway(config, [])
+
+        def publish_state(source, data):
+            if data['time'].endswith(':01.000Z'):
+                raise TypeError('odd report')
+            published.append(data['time'])
+
+        instance.publish_state = publish_state
+        errors = gateway.packet_errors.value
+        task = asyncio.create_task(instance.read_source(instance.sources['car']))
+        for _ in range(100):
+            if len(published) == 2:
+                break
+            await asyncio.sleep(0.05)
+        assert instance.sources['car'].connected
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        instance.discovery.close()
+        server.close()
+        return gateway.packet_errors.value - errors
+
+    assert asyncio.run(run()) == 1
+    assert published == ["2024-06-01T10:00:00.000Z", "2024-06-01T10:00:02.000Z"]
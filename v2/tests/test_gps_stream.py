@@ -0,0 +1,125 @@
+import json
+import os
+import socket
+import sys
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gps_stream  # noqa: E402
+from gps_stream import WATCH_COMMAND, GpsStream  # noqa: E402
+
+SKY = {"class": "SKY", "satellites": [{"PRN": 1, "used": True}, {"PRN": 2, "used": True}, {"PRN": 3, "used": False}]}
+
+
+def tpv(n):
+    return {"class": "TPV", "mode": 3, "time": f"2024-06-01T10:00:{n:02d}.000Z", "lat": 65 + n * 1e-4,
+            "lon": 25.5, "alt": 10.0, "speed": 12.5, "track": 90.0, "epx": 3.0, "epy": 4.0}
+
+
+def lines(*reports):
+    return b''.join(json.dumps(report).encode('utf-8') + b'\n' for report in reports)
+
+
+class FakeGpsd:
+    """
+    Local gpsd stand-in. Each accepted connection reads the WATCH command and
+    is sent the next script of lines, then closed.
+    """
+
+    def __init__(self, *scripts):
+        self.scripts = list(scripts)
+        self.commands = []
+        self._server = socket.create_server(('127.0.0.1', 0))
+        self.port = self._server.getsockname()[1]
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        for script in self.scripts:
+            connection, _ = self._server.accept()
+            with connection:
+                self.commands.append(connection.recv(len(WATCH_COMMAND)))
+                connection.sendall(script)
+
+    def close(self):
+        self._server.close()
+
+
+@pytest.fixture
+def gpsd_server():
+    servers = []
+
+    def start(*scripts):
+        server = FakeGpsd(*scripts)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def seconds(packets):
+    return [int(packet.time[17:19]) for packet in packets]
+
+
+def read_all(stream):
+    packets = []
+    with pytest.raises(ConnectionError):
+        for packet in stream:
+            packets.append(packet)
+    return packets
+
+
+def test_assembles_tpv_and_sky_reports(gpsd_server):
+    server = gpsd_server(lines({"class": "VERSION"}, SKY, tpv(0)) + b'not json\n' + lines(tpv(1)))
+    stream = GpsStream(port=server.port, timeout=5)
+    packets = read_all(stream)
+    stream.close()
+
+    assert server.commands == [WATCH_COMMAND]
+    assert [packet.lat for packet in packets] == [65.0, 65.0001]
+    packet = packets[0]
+    assert (packet.mode, packet.lon, packet.hspeed, packet.track) == (3, 25.5, 12.5, 90.0)
+    assert packet.time == "2024-06-01T10:00:00.000Z"
+    assert (packet.sats, packet.sats_valid) == (3, 2)
+
+
+def test_decimation(gpsd_server):
+    server = gpsd_server(lines(*[tpv(n) for n in range(9)]))
+    stream = GpsStream(port=server.port, decimation=3, timeout=5)
+    packets = read_all(stream)
+    stream.close()
+
+    assert seconds(packets) == [2, 5, 8]
+    assert (stream.assembler.reports, stream.assembler.emitted) == (9, 3)
+
+
+def test_min_interval(gpsd_server, monkeypatch):
+    clock = iter([100.0, 100.4, 101.0, 101.5, 102.2])
+    monkeypatch.setattr(gps_stream, 'time', SimpleNamespace(monotonic=lambda: next(clock)))
+    server = gpsd_server(lines(*[tpv(n) for n in range(5)]))
+    stream = GpsStream(port=server.port, min_interval=1, timeout=5)
+    packets = read_all(stream)
+    stream.close()
+
+    assert seconds(packets) == [0, 2, 4]
+
+
+def test_reconnects_after_gpsd_closes(gpsd_server):
+    server = gpsd_server(lines(SKY, tpv(0), tpv(1)), lines(tpv(2)))
+    stream = GpsStream(port=server.port, timeout=5)
+    packets = read_all(stream)
+    stream.close()
+    # Iterating again connects again, as read_packets and stream_gps_data do
+    packets += read_all(stream)
+    stream.close()
+
+    assert server.commands == [WATCH_COMMAND, WATCH_COMMAND]
+    assert seconds(packets) == [0, 1, 2]
+    # The SKY report of the first connection is kept
+    assert packets[-1].sats == 3
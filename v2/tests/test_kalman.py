@@ -0,0 +1,114 @@
+import math
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kalman import METRES_PER_DEGREE, KalmanFilter, filter_tracks  # noqa: E402
+
+
+def drive(seconds, speed, bearing, noise=0.0, start=(65.0, 25.5), seed=1):
+    # Fixes once a second along a constant bearing at speed m/s
+    rng = random.Random(seed)
+    latitude, longitude = start
+    for t in range(seconds):
+        yield (t, latitude + rng.gauss(0, noise) / METRES_PER_DEGREE,
+               longitude + rng.gauss(0, noise) / (METRES_PER_DEGREE * math.cos(math.radians(latitude))))
+        latitude += speed * math.cos(math.radians(bearing)) / METRES_PER_DEGREE
+        longitude += speed * math.sin(math.radians(bearing)) / (METRES_PER_DEGREE * math.cos(math.radians(latitude)))
+
+
+def test_long_drive_keeps_its_speed():
+    # 108 km/h for 800 s covers 24 km, so the local frame is shifted
+    kalman = KalmanFilter()
+    states = [kalman.update(t, latitude, longitude, 5) for t, latitude, longitude in drive(800, 30, 45)]
+    assert kalman.resets == 0
+    for state in states[30:]:
+        assert state.speed == pytest.approx(108, abs=1)
+        assert state.heading == pytest.approx(45, abs=1)
+    assert states[-1].latitude == pytest.approx(65 + 799 * 30 * math.cos(math.radians(45)) / METRES_PER_DEGREE,
+                                                abs=1e-5)
+
+
+def test_noisy_fixes():
+    kalman = KalmanFilter()
+    states = [kalman.update(t, latitude, longitude, 6) for t, latitude, longitude in drive(300, 15, 200, noise=3)]
+    assert sum(abs(state.speed - 54) for state in states[30:]) / 270 < 5
+    assert sum(abs(state.heading - 200) for state in states[30:]) / 270 < 5
+
+
+def test_heading_is_held_when_stopped():
+    kalman = KalmanFilter()
+    for t, latitude, longitude in drive(60, 10, 90):
+        kalman.update(t, latitude, longitude, 5)
+    for t in range(60, 120):
+        state = kalman.update(t, latitude, longitude, 5)
+    assert state.speed < 3.6
+    assert state.heading == pytest.approx(90, abs=5)
+
+
+def test_restarts_after_a_gap():
+    kalman = KalmanFilter(max_gap=10)
+    for t, latitude, longitude in drive(60, 20, 0):
+        kalman.update(t, latitude, longitude, 5)
+    state = kalman.update(100, latitude + 0.01, longitude, 5)
+    assert kalman.resets == 1
+    assert state.speed == 0
+
+
+def test_outlier_is_rejected():
+    kalman = KalmanFilter()
+    fixes = list(drive(60, 20, 0))
+    for t, latitude, longitude in fixes[:40]:
+        kalman.update(t, latitude, longitude, 5)
+    t, latitude, longitude = fixes[40]
+    state = kalman.update(t, latitude + 500 / METRES_PER_DEGREE, longitude, 5)
+    assert kalman.rejected == 1
+    assert state.speed == pytest.approx(72, abs=2)
+
+
+def test_apply_replaces_speed_and_bearing():
+    kalman = KalmanFilter()
+    for t, latitude, longitude in drive(30, 10, 180):
+        fix = {'time': f"2024-06-01T10:00:{t:02d}.000Z", 'latitude': latitude, 'longitude': longitude,
+               'gps_accuracy': 5, 'speed': 0, 'bearing': 0}
+        kalman.apply(fix)
+    assert fix['speed'] == pytest.approx(36, abs=1)
+    assert fix['bearing'] == pytest.approx(180, abs=1)
+    assert fix['latitude'] == latitude
+    assert kalman.apply({'time': None, 'latitude': 1.0, 'longitude': 2.0}) == {'time': None, 'latitude': 1.0,
+                                                                               'longitude': 2.0}
+
+
+def test_filter_tracks_matches_the_scalar_filter():
+    np = pytest.importorskip('numpy')
+    fixes = list(drive(120, 15, 300, noise=2))
+    times, latitudes, longitudes = (np.array(column, dtype=float) for column in zip(*fixes))
+    latitudes[:3] = np.nan
+    result = filter_tracks(np.tile(times, (3, 1)), np.tile(latitudes, (3, 1)), np.tile(longitudes, (3, 1)))
+
+    kalman = KalmanFilter(gate=math.inf)
+    speeds = [kalman.update(t, latitude, longitude).speed
+              for t, latitude, longitude in zip(times[3:], latitudes[3:], longitudes[3:])]
+    assert not np.isnan(result['speed']).any()
+    assert result['speed'][:, :3] == pytest.approx(0)
+    for row in result['speed']:
+        assert row[3:] == pytest.approx(speeds, abs=1e-6)
+
+    smoothed = filter_tracks(times, latitudes, longitudes, smooth=True)
+    assert np.abs(smoothed['speed'][10:] - 54).mean() < np.abs(result['speed'][0, 10:] - 54).mean()
+
+
+def test_filter_tracks_gap_with_times():
+    # Fixes 20 to 29 have a time but no position, each step predicts one second
+    np = pytest.importorskip('numpy')
+    times, latitudes, longitudes = (np.array(column, dtype=float) for column in zip(*drive(60, 10, 0)))
+    measured = latitudes.copy()
+    measured[20:30] = np.nan
+    result = filter_tracks(times, measured, longitudes)
+    errors = (result['latitude'] - latitudes) * METRES_PER_DEGREE
+    assert np.abs(errors[20:]).max() < 3
+    assert result['speed'][20:] == pytest.approx(36, abs=1)
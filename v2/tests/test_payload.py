@@ -0,0 +1,61 @@
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import payload  # noqa: E402
+from batch import FixBatcher  # noqa: E402
+
+FIX = {'latitude': 65.0123456, 'longitude': 25.4712345, 'altitude': 18.5, 'climb': -0.25, 'speed': 54.5,
+       'bearing': 271.5, 'gps_accuracy': 4.75, 'time': '2024-06-01T10:00:05.250Z', 'satellites': 11,
+       'sats_valid': 9, 'host': 'car'}
+
+
+@pytest.mark.parametrize('name,package', [('json', None), ('cbor', 'cbor2'), ('msgpack', 'msgpack')])
+def test_round_trip(name, package):
+    if package:
+        pytest.importorskip(package)
+    encode, decode = payload.get_codec(name)
+    assert decode(encode(FIX)) == FIX
+
+
+def test_struct_round_trip():
+    encode, decode = payload.get_codec('struct')
+    encoded = encode(FIX)
+    assert len(encoded) == payload.STRUCT_LAYOUT.size == 47
+    data = decode(encoded)
+    assert 'host' not in data
+    assert data['latitude'] == FIX['latitude']
+    assert data['longitude'] == FIX['longitude']
+    for field in ('altitude', 'climb', 'speed', 'bearing', 'gps_accuracy'):
+        assert data[field] == pytest.approx(FIX[field], rel=1e-6)
+    assert data['time'] == FIX['time']
+    assert (data['satellites'], data['sats_valid']) == (11, 9)
+
+
+def test_struct_missing_values():
+    data = payload.decode_struct(payload.encode_struct({'latitude': 65.0, 'longitude': 25.5, 'time': None}))
+    assert math.isnan(data['altitude'])
+    assert data['time'] == ''
+    assert data['satellites'] == 0
+
+
+def test_unknown_encoding():
+    with pytest.raises(ValueError):
+        payload.get_codec('xml')
+
+
+@pytest.mark.parametrize('value', [None, '', 'garbage', 12])
+def test_bad_time_is_nan(value):
+    assert math.isnan(payload.parse_time(value))
+
+
+def test_bad_time_is_encoded_and_batched():
+    fix = dict(FIX, time='not a time')
+    assert payload.decode_struct(payload.encode_struct(fix))['time'] == ''
+    batcher = FixBatcher()
+    batcher.add(fix)
+    assert len(batcher.flush()['dt']) == 1
@@ -0,0 +1,74 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from triplog import COMPACTED, HEADER_SIZE, INDEX_ENTRY, RECORD, Segment, TripLog, index_path  # noqa: E402
+
+START = 1717236000  # 2024-06-01T10:00:00Z
+
+
+def fix(t):
+    return {'time': t, 'latitude': 65 + t % 1000 * 1e-5, 'longitude': 25.5, 'speed': 36.0, 'satellites': 9}
+
+
+def test_range_across_rotation(tmp_path):
+    log = TripLog(str(tmp_path), flush_interval=0, index_interval=4,
+                  max_segment_bytes=HEADER_SIZE + 10 * RECORD.size, compact_after=0)
+    for n in range(25):
+        log.append(fix(START + n))
+    assert len(log.segments()) == 3
+    fixes = log.read(START + 5, START + 17)
+    assert [f['time'] for f in fixes] == [START + n for n in range(5, 18)]
+    assert fixes[0]['latitude'] == 65 + (START + 5) % 1000 * 1e-5
+    assert len(log.read()) == 25
+    log.close()
+
+
+def test_open_drops_a_partial_record_and_its_index_entries(tmp_path):
+    now = int(time.time())
+    log = TripLog(str(tmp_path), index_interval=4, compact_after=0)
+    for n in range(10):
+        log.append(fix(now + n))
+    log.close()
+    path, = log.segments()
+    # Crash halfway through the eighth record, the index has an entry for the ninth
+    with open(path, 'r+b') as f:
+        f.truncate(HEADER_SIZE + 7 * RECORD.size + 5)
+    assert os.path.getsize(index_path(path)) == 3 * INDEX_ENTRY.size
+
+    log = TripLog(str(tmp_path), index_interval=4, compact_after=0)
+    log.append(fix(now + 20))
+    log.close()
+    assert os.path.getsize(path) == HEADER_SIZE + 8 * RECORD.size
+    with open(index_path(path), 'rb') as f:
+        assert [number for _, number in INDEX_ENTRY.iter_unpack(f.read())] == [0, 4]
+    assert [f['time'] for f in log.read()] == [now + n for n in range(7)] + [now + 20]
+
+
+def test_compaction_keeps_one_fix_per_interval(tmp_path):
+    old = int(time.time()) - 2 * 86400
+    log = TripLog(str(tmp_path), flush_interval=0, compact_after=86400, compact_interval=10)
+    for n in range(0, 60, 3):
+        log.append(fix(old + n))
+    log.rotate()
+    path, = log.segments()
+    segment = Segment(path)
+    assert segment.flags & COMPACTED
+    segment.close()
+    assert [f['time'] - old for f in log.read()] == [0, 12, 24, 36, 48]
+    # A compacted segment is left as it is
+    log.maintain()
+    assert len(log.read()) == 5
+
+
+def test_out_of_order_fixes_are_skipped(tmp_path):
+    log = TripLog(str(tmp_path), compact_after=0)
+    log.append(fix(START + 10))
+    log.append(fix(START + 5))
+    log.append(fix(START + 10))
+    log.append(fix(START + 11))
+    assert log.skipped == 1
+    assert [f['time'] for f in log.read()] == [START + 10, START + 10, START + 11]
+    log.close()